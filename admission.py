@@ -0,0 +1,81 @@
+from heapq import heapify, heappop, heappush
+from itertools import count
+
+import asyncio
+
+
+#  lower number is admitted first
+PRIORITY_READ = 0
+PRIORITY_WRITE = 1
+PRIORITY_HEAVY = 2
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str):
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Limit number of requests running at once. Excess requests wait in bounded
+    priority queue not longer than timeout, request is rejected when queue is full
+    and it can't displace waiting request of lower priority
+    """
+    def __init__(self, concurrency: int, queue_size: int, timeout: float):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = count()
+
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: int):
+        """Wait for free slot, raise Rejected if request is not admitted in time"""
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            return
+
+        if len(self._waiters) >= self.queue_size:
+            worst = max(self._waiters)
+            if worst[0] <= priority:
+                raise Rejected("queue_full")
+            self._remove(worst)
+            worst[2].set_exception(Rejected("displaced"))
+
+        waiter = (priority, next(self._order), asyncio.get_running_loop().create_future())
+        heappush(self._waiters, waiter)
+        future = waiter[2]
+        try:
+            await asyncio.wait((future,), timeout=self.timeout)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                #  slot was handed over right before cancellation
+                self.release()
+            else:
+                self._remove(waiter)
+            raise
+
+        if not future.done():
+            self._remove(waiter)
+            future.cancel()
+            raise Rejected("timeout")
+        future.result()
+
+    def release(self):
+        """Hand slot over to the first waiting request or free it"""
+        while self._waiters:
+            _, _, future = heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def _remove(self, waiter: tuple[int, int, asyncio.Future]):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            return
+        heapify(self._waiters)
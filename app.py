@@ -1,22 +1,104 @@
 from asyncpg import create_pool
+from base64 import urlsafe_b64decode
 from asyncpg.exceptions import PostgresError
-from fastapi import FastAPI, BackgroundTasks, File
+from fastapi import FastAPI, Query, WebSocket
+from admission import AdmissionController, Rejected, PRIORITY_HEAVY, PRIORITY_READ, PRIORITY_WRITE
 from fastapi.responses import JSONResponse
-from database.queries import init_database
+from math import ceil
+from profiling import SamplingProfiler, SlowRequests, TimedRoute
+from ratelimit import TokenBuckets
+from database.queries import init_connection, init_database, request_scope, reset_connection, use_replicas
+from database.replicas import ReplicaSet
+from database.statements import PreparedConnection
 from starlette.authentication import AuthenticationBackend, AuthCredentials, AuthenticationError
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.requests import Request, HTTPConnection
-from typing import Optional
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from starlette.websockets import WebSocketClose
+from time import perf_counter
+from typing import Callable, Hashable, Optional
 
+import asyncio
+import hmac
 import uvicorn
 import config
 import handlers
+import metrics
 import models
 import my_exceptions
+import os
+import profiling
+import sys
+import time
 
 
 app = FastAPI()
+#  routes time validation, endpoint and serialization of requests
+app.router.route_class = TimedRoute
 local_storage = {}
+admission_controller = AdmissionController(
+    concurrency=config.ADMISSION_CONCURRENCY, queue_size=config.ADMISSION_QUEUE_SIZE, timeout=config.ADMISSION_TIMEOUT
+)
+#  requests of devices, users, client addresses of public methods and of authorized ones
+rate_limits = {
+    "device": TokenBuckets(rate=config.RATE_LIMIT_DEVICE, burst=config.RATE_LIMIT_DEVICE_BURST),
+    "user": TokenBuckets(rate=config.RATE_LIMIT_USER, burst=config.RATE_LIMIT_USER_BURST),
+    "address": TokenBuckets(rate=config.RATE_LIMIT_ADDRESS, burst=config.RATE_LIMIT_ADDRESS_BURST),
+    "client": TokenBuckets(rate=config.RATE_LIMIT_CLIENT, burst=config.RATE_LIMIT_CLIENT_BURST),
+}
+
+
+async def sweep_rate_limits():
+    """Periodically remove refilled buckets, so only recently active keys are kept"""
+    while True:
+        await asyncio.sleep(config.RATE_LIMIT_SWEEP_INTERVAL)
+        for buckets in rate_limits.values():
+            buckets.sweep()
+
+
+def rate_limit(kind: str, key: Hashable, path: str):
+    """Take cost of route from bucket of key, reject request if there are not enough tokens"""
+    if not config.RATE_LIMITS:
+        return
+    retry_after = rate_limits[kind].take(key, config.RATE_LIMIT_COSTS.get(path, 1))
+    if retry_after:
+        metrics.rate_limited.inc(kind)
+        raise my_exceptions.RateLimited("Too many requests, try again later", retry_after)
+
+
+def rate_limited_response(exc: my_exceptions.RateLimited) -> JSONResponse:
+    return JSONResponse(
+        status_code=429, headers={"Retry-After": str(ceil(exc.retry_after))},
+        content={"status": False, "detail": exc.message}
+    )
+
+
+class ClientRateLimit:
+    """
+    Limit requests of client address before admission, so requests which get 429 never take
+    places of admitted or queued ones. Public methods have their own buckets, ids of credentials
+    of other methods are not verified yet, so only address bounds checks of them in database
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        path = scope.get("path", "")
+        if scope["type"] not in ("http", "websocket") or path.startswith(config.PUBLIC_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        address = scope["client"][0] if scope.get("client") else ""
+        try:
+            rate_limit("address" if path in config.PUBLIC_METHODS else "client", address, path)
+        except my_exceptions.RateLimited as exc:
+            if scope["type"] == "websocket":
+                await WebSocketClose(code=1008)(scope, receive, send)
+            else:
+                await rate_limited_response(exc)(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
 
 
 class Authentication(AuthenticationBackend):
@@ -24,46 +106,362 @@ class Authentication(AuthenticationBackend):
     async def authenticate(self, request: HTTPConnection) -> Optional[tuple[AuthCredentials, models.User]]:
 
         #  check authenticate only in marked methods in config"
-        if request.url.path in config.PUBLIC_METHODS:
+        path = request.url.path
+        if path.startswith(config.PUBLIC_PREFIXES) or path in config.PUBLIC_METHODS:
             return
+        started = perf_counter()
         try:
-            token, user_id, device_id = request.headers["Authorization"].split(".")
+            token, user_id, device_id = self.credentials(request).split(".")
             await handlers.check_auth(
                 db_pool=local_storage["db_pool"], user_id=user_id,
                 device_id=device_id, token=token
             )
         except (my_exceptions.AuthError, ValueError, KeyError):
+            metrics.auth_seconds.observe(perf_counter() - started, "rejected")
+            profiling.add_time("auth", perf_counter() - started)
             raise AuthenticationError()
+        metrics.auth_seconds.observe(perf_counter() - started, "ok")
+        profiling.add_time("auth", perf_counter() - started)
+        #  buckets of device and user are taken only with valid credentials, so nobody can empty them for others
+        rate_limit("device", (user_id, device_id), path)
+        rate_limit("user", user_id, path)
 
         return AuthCredentials(["authenticated"]), models.User(user_id=user_id, device_id=device_id, token=token)
 
+    @staticmethod
+    def credentials(request: HTTPConnection) -> str:
+        """
+        Authorization header, browsers can't set it for websocket, so there it may be passed
+        in subprotocol. Query string would get it into access logs
+        """
+        if request.scope["type"] == "websocket" and "Authorization" not in request.headers:
+            for protocol in request.scope.get("subprotocols", ()):
+                if protocol.startswith(config.EVENTS_AUTH_PREFIX):
+                    encoded = protocol[len(config.EVENTS_AUTH_PREFIX):]
+                    return urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)).decode()
+        return request.headers["Authorization"]
 
-def auth_exception_handler(_: Request, _exc: AuthenticationError) -> JSONResponse:
-    """Return Json response with message if user is not authenticated"""
+
+def auth_exception_handler(_: Request, exc: AuthenticationError) -> JSONResponse:
+    """Return Json response with message if user is not authenticated or exceeded rate limit"""
+    if isinstance(exc, my_exceptions.RateLimited):
+        return rate_limited_response(exc)
     return JSONResponse(
         status_code=200,
         content={"status": False, "detail": "User is not authorized"}
     )
 
 
+class RequestConnection:
+    """
+    Share one database connection between auth middleware and handler queries.
+    Connection is released as soon as response is sent, before background tasks,
+    websocket releases it once it is accepted or closed
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        async with request_scope(db_pool=local_storage["db_pool"]) as db_scope:
+
+            async def send_wrapper(message: Message):
+                await send(message)
+                if message["type"] == "http.response.body" and not message.get("more_body", False):
+                    await db_scope.close()
+                elif message["type"] in ("websocket.accept", "websocket.close"):
+                    await db_scope.close()
+
+            await self.app(scope, receive, send_wrapper)
+
+
+class AdmissionControl:
+    """
+    Admit limited number of requests at once, so pool is never oversubscribed.
+    Excess requests wait in queue and get 503 with Retry-After when they can't be served in time
+    """
+    def __init__(self, app: ASGIApp, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    @staticmethod
+    def priority(scope: Scope) -> int:
+        if not config.ADMISSION_PRIORITIES:
+            return PRIORITY_WRITE
+        if scope["path"] in config.HEAVY_METHODS:
+            return PRIORITY_HEAVY
+        if scope["path"] in config.WRITE_METHODS:
+            return PRIORITY_WRITE
+        if scope["method"] in ("GET", "HEAD"):
+            return PRIORITY_READ
+        return PRIORITY_WRITE
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path.startswith(config.PUBLIC_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        priority = self.priority(scope)
+        started = perf_counter()
+        try:
+            await self.controller.acquire(priority)
+        except Rejected as exc:
+            metrics.admission_rejected.inc(exc.reason)
+            response = JSONResponse(
+                status_code=503, headers={"Retry-After": str(config.ADMISSION_RETRY_AFTER)},
+                content={"status": False, "detail": "Server is overloaded, try again later"}
+            )
+            await response(scope, receive, send)
+            return
+        metrics.admission_wait_seconds.observe(perf_counter() - started, priority)
+        profiling.add_time("admission", perf_counter() - started)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release()
+
+
+route_paths: dict[Callable, str] = {}
+#  methods of requests are observed as is, others as one label value
+KNOWN_METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+
+def route_path(scope: Scope) -> str:
+    """Route template of request, so paths with ids are observed together"""
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        #  rejected by authentication or not found
+        return "unmatched"
+    if endpoint not in route_paths:
+        for route in app.routes:
+            route_paths[route.endpoint] = route.path
+    return route_paths.get(endpoint, "unmatched")
+
+
+#  started by admin route, samples are attributed to routes of requests
+profiler = SamplingProfiler(route=route_path)
+slow_requests = SlowRequests(size=config.SLOW_REQUESTS)
+
+
+class RequestMetrics:
+    """
+    Observe latency of every request by route template and status, keep the slowest
+    requests with time of their phases. Response phase is sending of response,
+    background is the rest of request after its last byte is sent
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = perf_counter()
+        status = 500
+        sent: Optional[float] = None
+        timings = profiling.start_timings()
+
+        async def send_wrapper(message: Message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                sent = perf_counter()
+
+        frame = sys._getframe()
+        if profiler.running:
+            profiler.requests[frame] = scope
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.requests.pop(frame, None)
+            profiling.stop_timings()
+            finished = perf_counter()
+            route = route_path(scope)
+            method = scope["method"] if scope["method"] in KNOWN_METHODS else "other"
+            metrics.request_seconds.observe(finished - started, method, route, status)
+            if slow_requests.admits(finished - started):
+                if sent is not None:
+                    if timings.route_finished is not None:
+                        timings.add("response", sent - timings.route_finished)
+                    timings.add("background", finished - sent)
+                slow_requests.add(finished - started, {
+                    "method": scope["method"], "route": route, "path": scope["path"], "status": status,
+                    "finished_at": time.time(), "seconds": round(finished - started, 6),
+                    "phases": {phase: round(seconds, 6) for phase, seconds in timings.phases.items()}
+                })
+
+
 app.add_middleware(AuthenticationMiddleware, backend=Authentication(), on_error=auth_exception_handler)
+app.add_middleware(RequestConnection)
+app.add_middleware(AdmissionControl, controller=admission_controller)
+app.add_middleware(ClientRateLimit)
+app.add_middleware(RequestMetrics)
 
 
 @app.on_event("startup")
 async def on_startup():
     """Do this when stating application"""
-    db_pool = await create_pool(config.DB_DESTINATION)
+    db_pool = await create_pool(
+        config.DB_DESTINATION, connection_class=PreparedConnection, init=init_connection, reset=reset_connection,
+        min_size=config.DB_POOL_MIN_SIZE, max_size=config.DB_POOL_MAX_SIZE,
+        max_queries=config.DB_MAX_QUERIES,
+        max_inactive_connection_lifetime=config.DB_MAX_INACTIVE_LIFETIME
+    )
     await init_database(db_pool=db_pool)
     local_storage["db_pool"] = db_pool
+    if config.DB_REPLICAS:
+        #  replica which is down on startup connects when it is checked
+        replica_set = ReplicaSet(
+            primary=db_pool, max_lag=config.DB_REPLICA_MAX_LAG, check_timeout=config.DB_REPLICA_CHECK_INTERVAL,
+            replicas={
+                host: await create_pool(
+                    destination, connection_class=PreparedConnection, init=init_connection, reset=reset_connection,
+                    min_size=0, max_size=config.DB_POOL_MAX_SIZE, max_queries=config.DB_MAX_QUERIES,
+                    max_inactive_connection_lifetime=config.DB_MAX_INACTIVE_LIFETIME
+                )
+                for host, destination in config.DB_REPLICAS.items()
+            }
+        )
+        await replica_set.check()
+        use_replicas(replica_set)
+        local_storage["replica_set"] = replica_set
+        local_storage["replicas_check"] = asyncio.create_task(replica_set.run(config.DB_REPLICA_CHECK_INTERVAL))
+    #  index and nicknames are loaded by events listener once it listens, so no event is missed
+    events_loaded = asyncio.get_running_loop().create_future()
+    local_storage["events_listener"] = asyncio.create_task(
+        handlers.listen_events(db_pool=db_pool, loaded=events_loaded)
+    )
+    await events_loaded
+    local_storage["index_refresh"] = asyncio.create_task(handlers.refresh_profile_index(db_pool=db_pool))
+    handlers.start_photo_processing()
+    local_storage["blobs_collector"] = asyncio.create_task(handlers.collect_photo_blobs(db_pool=db_pool))
+    local_storage["revoked_tokens_sync"] = asyncio.create_task(handlers.sync_revoked_tokens(db_pool=db_pool))
+    local_storage["sessions_reaper"] = asyncio.create_task(handlers.reap_sessions(db_pool=db_pool))
+    await handlers.start_ratings(db_pool=db_pool)
+    local_storage["ratings_flush"] = asyncio.create_task(handlers.flush_ratings(db_pool=db_pool))
+    local_storage["loop_lag"] = asyncio.create_task(metrics.watch_loop_lag())
+    local_storage["rate_limits_sweep"] = asyncio.create_task(sweep_rate_limits())
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
     """Run when application is turning off"""
+    local_storage["index_refresh"].cancel()
+    local_storage["blobs_collector"].cancel()
+    local_storage["revoked_tokens_sync"].cancel()
+    local_storage["sessions_reaper"].cancel()
+    local_storage["loop_lag"].cancel()
+    profiler.stop()
+    local_storage["ratings_flush"].cancel()
+    local_storage["events_listener"].cancel()
+    local_storage["rate_limits_sweep"].cancel()
+    if handlers.nicknames_reload is not None:
+        handlers.nicknames_reload.cancel()
+    await handlers.file_writer.stop()
+    await handlers.photo_processor.stop()
+    handlers.static_photos.close()
     db_pool = local_storage["db_pool"]
+    await handlers.stop_ratings(db_pool=db_pool)
+    if "replica_set" in local_storage:
+        local_storage["replicas_check"].cancel()
+        await local_storage["replica_set"].close()
     await db_pool.close()
 
 
+@app.api_route(f"/{config.STATIC_FILES}/{{name:path}}", methods=["GET", "HEAD"], include_in_schema=False)
+async def static_photo(request: Request, name: str) -> Response:
+    """Serve uploaded photo, clients revalidate it by etag"""
+    return handlers.static_photos.response(request=request, name=name)
+
+
+def is_admin(request: Request) -> bool:
+    """Admin token in X-Admin-Token header, or as bearer token, which scrapers of metrics can send"""
+    token = request.headers.get("X-Admin-Token", "")
+    if not token and request.headers.get("Authorization", "").startswith("Bearer "):
+        token = request.headers["Authorization"][len("Bearer "):]
+    return bool(config.ADMIN_TOKEN) and hmac.compare_digest(token.encode(), config.ADMIN_TOKEN.encode())
+
+
+def admin_forbidden() -> JSONResponse:
+    return JSONResponse(status_code=403, content={"status": False, "detail": "Admin token is required"})
+
+
+@app.get(f"{config.ADMIN_PREFIX}metrics", include_in_schema=False)
+async def get_metrics(request: Request) -> Response:
+    """Metrics in prometheus text format, scraped with admin token"""
+    if not is_admin(request):
+        return admin_forbidden()
+    metrics.observe_pool(local_storage["db_pool"])
+    metrics.photo_queue_size.set(handlers.photo_processor.queued())
+    metrics.file_write_queue_size.set(handlers.file_writer.queued())
+    metrics.admission_requests.set(admission_controller.active, "active")
+    metrics.admission_requests.set(admission_controller.queued(), "queued")
+    metrics.events_connections.set(handlers.events_hub.connections())
+    for kind, buckets in rate_limits.items():
+        metrics.rate_limit_buckets.set(len(buckets), kind)
+    stats = handlers.session_cache.stats()
+    metrics.session_cache_size.set(stats["size"])
+    metrics.session_cache_requests.set(stats["hits"], "hit")
+    metrics.session_cache_requests.set(stats["misses"], "miss")
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.post(f"{config.ADMIN_PREFIX}profiler/start", include_in_schema=False)
+async def start_profiler(request: Request, interval: float = Query(config.PROFILER_INTERVAL, ge=0.001, le=1)):
+    """Start sampling stacks of this worker, samples of previous run are dropped"""
+    if not is_admin(request):
+        return admin_forbidden()
+    profiler.reset()
+    profiler.start(interval)
+    return {"status": True, "worker": os.getpid(), "interval": profiler.interval}
+
+
+@app.post(f"{config.ADMIN_PREFIX}profiler/stop", include_in_schema=False)
+async def stop_profiler(request: Request):
+    if not is_admin(request):
+        return admin_forbidden()
+    profiler.stop()
+    return {"status": True, "worker": os.getpid()}
+
+
+@app.get(f"{config.ADMIN_PREFIX}profiler", include_in_schema=False)
+async def get_profile(request: Request) -> Response:
+    """Collected samples as collapsed stacks, input of flamegraph.pl or speedscope"""
+    if not is_admin(request):
+        return admin_forbidden()
+    return Response(
+        content=profiler.collapsed(), media_type="text/plain",
+        headers={"Content-Disposition": f'attachment; filename="profile-{os.getpid()}.collapsed"'}
+    )
+
+
+@app.get(f"{config.ADMIN_PREFIX}slow_requests", include_in_schema=False)
+async def get_slow_requests(request: Request, reset: bool = False):
+    """The slowest requests of this worker with time of their phases"""
+    if not is_admin(request):
+        return admin_forbidden()
+    requests = slow_requests.requests()
+    if reset:
+        slow_requests.reset()
+    return {"status": True, "worker": os.getpid(), "requests": requests}
+
+
+@app.websocket("/ws")
+async def events(websocket: WebSocket):
+    """Push matches of new profiles and moves of opponents, client should reconnect when closed"""
+    #  subprotocol with credentials is never sent back
+    subprotocol = config.EVENTS_PROTOCOL if config.EVENTS_PROTOCOL in websocket.scope.get("subprotocols", ()) else None
+    await handlers.stream_events(websocket=websocket, user_id=websocket.user.user_id, subprotocol=subprotocol)
+
+
 @app.post("/registration")
 async def registration(user: models.RegUser):
     """New user registration method"""
@@ -75,38 +473,90 @@ async def registration(user: models.RegUser):
         return {"status": True, "user_id": user_id}
 
 
+@app.get("/check_nicknames")
+async def check_nicknames(
+    nickname: list[str] = Query(...), suggestions: int = Query(3, ge=0, le=config.NICKNAME_SUGGESTIONS)
+):
+    """Check several nicknames at once, taken ones get free variants"""
+    try:
+        nicknames = await handlers.check_nicknames(
+            db_pool=local_storage["db_pool"], nicknames=nickname, suggestions=suggestions
+        )
+    except my_exceptions.WrongNickname as exc:
+        return {"status": False, "detail": exc.message}
+    return {"status": True, "nicknames": nicknames}
+
+
 @app.get("/authorization")
 async def authorization(user: models.AskForAuthUser):
     """User authorization method"""
     try:
         token = await handlers.authorization(db_pool=local_storage["db_pool"], user=user)
-    except PostgresError:
+    except (my_exceptions.AuthError, PostgresError):
         return {"status": False, "detail": "Authorization error. Check user_id, device_id or hashed_password"}
     return {"status": True, "token": token}
 
 
-@app.post("/upload_photo")
-async def upload_photo(
-    subject_id: str, photo_type: models.PhotoType,
-    background_tasks: BackgroundTasks,
-    photos: list[bytes] = File(..., media_type="image/jpeg", max_length=524288)
-):
+@app.post("/logout")
+async def logout(request: Request):
+    """Close session of current device, its token stops working in all workers at once"""
+    await handlers.logout(
+        db_pool=local_storage["db_pool"], user_id=request.user.user_id,
+        device_id=request.user.device_id, token=request.user.token
+    )
+    return {"status": True}
+
+
+#  body of upload is parsed by handlers as it is received, so it is only documented here
+UPLOAD_PHOTO_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object", "required": ["photos"],
+            "properties": {"photos": {"type": "array", "items": {"type": "string", "format": "binary"}}}
+        }}}
+    }
+}
+
+
+@app.post("/upload_photo", openapi_extra=UPLOAD_PHOTO_BODY)
+async def upload_photo(request: Request, subject_id: str, photo_type: models.PhotoType):
     """
     Can upload from 1 to 5 photos in one time.
-    If user already have many photos, return error message
+    If user already have many photos, return error message.
+    Too large photos are rejected with 413 before the whole body is received
     """
     try:
-        photo_url = await handlers.upload_photos(
+        photo_id, photo_url = await handlers.upload_photos(
             db_pool=local_storage["db_pool"],
-            subject_id=subject_id, photo_type=photo_type,
-            photos=photos, background_tasks=background_tasks
+            subject_id=subject_id, photo_type=photo_type.value,
+            request=request
         )
-    except my_exceptions.TooManyPhotos as exc:
+    except my_exceptions.PhotoTooLarge as exc:
+        return JSONResponse(status_code=413, content={"status": False, "detail": exc.message})
+    except (
+        my_exceptions.TooManyPhotos, my_exceptions.WrongPhoto, my_exceptions.ServerBusy, my_exceptions.PhotoNotSaved
+    ) as exc:
         return {"status": False, "detail": exc.message}
     except PostgresError:
         return {"status": False, "detail": "Wrong subject_id"}
 
-    return {"status": True, "photo_url": photo_url}
+    return {"status": True, "photo_id": photo_id, "photo_url": photo_url}
+
+
+@app.post("/delete_photo")
+async def delete_photo(request: Request, photo_id: str, photo_type: models.PhotoType):
+    """Delete user's photo, file is removed when no photo refers to it"""
+    try:
+        await handlers.delete_photo(
+            db_pool=local_storage["db_pool"], user_id=request.user.user_id,
+            photo_id=photo_id, photo_type=photo_type.value
+        )
+    except my_exceptions.PhotoNotFound as exc:
+        return {"status": False, "detail": exc.message}
+    except PostgresError:
+        return {"status": False, "detail": "Wrong photo_id"}
+    return {"status": True}
 
 
 @app.post("/create_profile")
@@ -114,12 +564,102 @@ async def create_profile(profile: models.NewProfile):
     """Create new profile for searching opponent"""
     try:
         await handlers.create_profile(db_pool=local_storage["db_pool"], profile=profile)
-    except my_exceptions.ProfileAlreadyExists as exc:
+    except (my_exceptions.ProfileAlreadyExists, my_exceptions.WrongLocation) as exc:
         return {"status": False, "detail": exc.message}
     except PostgresError as e:
         return {"status": False, "detail": "Wrong user_id", "debug": str(e)}
     return {"status": True}
 
 
+@app.post("/update_location")
+async def update_location(request: Request, location: models.ProfileLocation):
+    """Move user's profile to new coordinates"""
+    try:
+        await handlers.update_location(db_pool=local_storage["db_pool"], user_id=request.user.user_id, location=location)
+    except my_exceptions.ProfileNotFound as exc:
+        return {"status": False, "detail": exc.message}
+    return {"status": True}
+
+
+@app.post("/rate")
+async def rate(request: Request, rating: models.NewRating):
+    """Rate other user from 1 to 5, rating is updated within a second"""
+    try:
+        await handlers.rate_user(user_id=request.user.user_id, rating=rating)
+    except my_exceptions.WrongRating as exc:
+        return {"status": False, "detail": exc.message}
+    return {"status": True}
+
+
+@app.get("/rating")
+async def rating(user_id: str):
+    """Average rate of user and count of rates"""
+    try:
+        user_rating = await handlers.get_rating(db_pool=local_storage["db_pool"], user_id=user_id)
+    except my_exceptions.UserNotFound as exc:
+        return {"status": False, "detail": exc.message}
+    return {"status": True, **user_rating}
+
+
+def page_response(etag: str, page: Optional[dict]) -> Response:
+    """Page of listing or 304 if client has the same version, clients always revalidate"""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if page is None:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content={"status": True, **page}, headers=headers)
+
+
+@app.get("/profiles")
+async def profiles(
+    request: Request, user_id: str, cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=config.LIST_LIMIT)
+):
+    """User's profiles with their photos, next page is requested with next_cursor"""
+    try:
+        etag, page = await handlers.list_profiles(
+            db_pool=local_storage["db_pool"], user_id=user_id, cursor=cursor, limit=limit,
+            if_none_match=request.headers.get("if-none-match")
+        )
+    except my_exceptions.WrongPage as exc:
+        return {"status": False, "detail": exc.message}
+    return page_response(etag, page)
+
+
+@app.get("/photos")
+async def photos(
+    request: Request, subject_id: str, photo_type: models.PhotoType, cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=config.LIST_LIMIT)
+):
+    """Photos of user or profile, next page is requested with next_cursor"""
+    try:
+        etag, page = await handlers.list_photos(
+            db_pool=local_storage["db_pool"], subject_id=subject_id, photo_type=photo_type.value,
+            cursor=cursor, limit=limit, if_none_match=request.headers.get("if-none-match")
+        )
+    except my_exceptions.WrongPage as exc:
+        return {"status": False, "detail": exc.message}
+    return page_response(etag, page)
+
+
+@app.get("/search")
+async def search(
+    request: Request, profile_id: str,
+    limit: int = Query(20, ge=1, le=config.SEARCH_LIMIT),
+    radius_km: float = Query(config.GEO_SEARCH_RADIUS, gt=0, le=config.GEO_MAX_RADIUS)
+):
+    """
+    Find opponents for user's profile, both sides preferences must match.
+    If profile has location, only nearest opponents within radius are returned
+    """
+    try:
+        profiles = handlers.search_opponents(
+            user_id=request.user.user_id, profile_id=profile_id,
+            limit=limit, radius_km=radius_km
+        )
+    except my_exceptions.ProfileNotFound as exc:
+        return {"status": False, "detail": exc.message}
+    return {"status": True, "profiles": profiles}
+
+
 if __name__ == "__main__":
     uvicorn.run("app:app")
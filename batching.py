@@ -0,0 +1,79 @@
+from asyncpg import Pool
+from contextvars import Context
+from typing import Any, Awaitable, Callable, Optional
+
+import asyncio
+
+
+Flush = Callable[[Pool, list], Awaitable[list]]
+
+
+class _Batch:
+    def __init__(self):
+        self.pending: list[tuple[Any, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.running = False
+
+
+class WriteBatcher:
+    """
+    Group commit of concurrent writes. Items are collected for max_delay seconds
+    and written by one flush call in one transaction, writes coming during flush
+    are collected for the next one. flush returns result for every item,
+    exception in results is raised to the caller of that item
+    """
+    def __init__(self, flush: Flush, max_batch: int, max_delay: float):
+        self.flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._batches: dict[Pool, _Batch] = {}
+
+    async def submit(self, db_pool: Pool, item: Any) -> Any:
+        """Queue item for writing and wait for its result"""
+        loop = asyncio.get_running_loop()
+        batch = self._batches.get(db_pool)
+        if batch is None:
+            batch = self._batches[db_pool] = _Batch()
+
+        future = loop.create_future()
+        batch.pending.append((item, future))
+        if not batch.running and batch.timer is None:
+            #  flush runs in empty context, not in request scope of the first caller
+            delay = 0 if len(batch.pending) >= self.max_batch else self.max_delay
+            batch.timer = loop.call_later(delay, self._start, db_pool, batch, context=Context())
+        return await future
+
+    def _start(self, db_pool: Pool, batch: _Batch):
+        batch.timer = None
+        batch.running = True
+        asyncio.create_task(self._flush_pending(db_pool, batch))
+
+    async def _flush_pending(self, db_pool: Pool, batch: _Batch):
+        try:
+            while batch.pending:
+                entries = batch.pending[:self.max_batch]
+                del batch.pending[:self.max_batch]
+                await self._flush_entries(db_pool, entries)
+        finally:
+            batch.running = False
+            if not batch.pending:
+                self._batches.pop(db_pool, None)
+
+    async def _flush_entries(self, db_pool: Pool, entries: list[tuple[Any, asyncio.Future]]):
+        try:
+            results = await self.flush(db_pool, [item for item, _ in entries])
+        except Exception as exc:
+            if len(entries) > 1:
+                #  find out which items failed, the rest is written one by one
+                for entry in entries:
+                    await self._flush_entries(db_pool, [entry])
+                return
+            results = [exc]
+
+        for (_, future), result in zip(entries, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
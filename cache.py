@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Bounded LRU cache with per-entry time to live.
+    Least recently used entries are evicted when cache is full,
+    expired entries are dropped on access. on_evict is called
+    with every value which leaves the cache
+    """
+    def __init__(self, maxsize: int, ttl: float, on_evict: Optional[Callable[[Any], None]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return cached value or None if key is missing or expired"""
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        expire_at, value = item
+        if expire_at <= monotonic():
+            del self._data[key]
+            self._evicted(value)
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Put value to cache, evict least recently used entry if cache is full"""
+        if ttl is None:
+            ttl = self.ttl
+        previous = self._data.get(key)
+        self._data[key] = (monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        if previous is not None and previous[1] is not value:
+            self._evicted(previous[1])
+        while len(self._data) > self.maxsize:
+            self._evicted(self._data.popitem(last=False)[1][1])
+
+    def invalidate(self, key: Hashable):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._evicted(item[1])
+
+    def clear(self):
+        while self._data:
+            self._evicted(self._data.popitem()[1][1])
+
+    def _evicted(self, value: Any):
+        if self.on_evict is not None:
+            self.on_evict(value)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,238 @@
+from asyncpg import Connection
+from typing import NamedTuple
+
+
+#  key of advisory lock, only one worker applies migrations at a time
+MIGRATIONS_LOCK_KEY = 5318008
+
+
+#  tables as they were created by version 1, later versions change them by their own statements
+INITIAL_TABLES = (
+    '''CREATE TABLE IF NOT EXISTS "users"
+        (
+            "user_id" UUID NOT NULL UNIQUE PRIMARY KEY,
+            "nickname" VARCHAR(35) NULL UNIQUE,
+            "first_name" VARCHAR(100) NOT NULL,
+            "reg_time" TIMESTAMP NOT NULL,
+            "born_date" DATE,
+            "gender" VARCHAR(6),
+            "hashed_password" VARCHAR(128)
+        )''',
+    '''CREATE TABLE IF NOT EXISTS "profiles"
+        (
+            "profile_id" UUID NOT NULL UNIQUE PRIMARY KEY,
+            "user_id" UUID NOT NULL REFERENCES "users" ("user_id") ON DELETE CASCADE,
+            "status" BOOL DEFAULT true,
+            "desired_gender" VARCHAR(6),
+            "min_age" SMALLINT,
+            "max_age" SMALLINT,
+            "type" VARCHAR(8),
+            "vehicle_type" VARCHAR(8)
+        )''',  # type 0 - driver, 1 - companion, 2 - together
+    '''CREATE TABLE IF NOT EXISTS "user_rating"
+        (
+            "rating_id" UUID NOT NULL UNIQUE PRIMARY KEY,
+            "user_id" UUID NOT NULL REFERENCES "users" ("user_id") ON DELETE CASCADE,
+            "rate" INT DEFAULT 0,
+            "rate_count" INT DEFAULT 0
+        )''',
+    '''CREATE TABLE IF NOT EXISTS "sessions"
+        (
+            "session_id" UUID NOT NULL UNIQUE PRIMARY KEY,
+            "user_id" UUID NOT NULL REFERENCES "users" ("user_id") ON DELETE CASCADE,
+            "device_id" VARCHAR(32) NOT NULL,
+            "start_time" TIMESTAMP NOT NULL,
+            "token" VARCHAR(100) NOT NULL
+        )''',
+    '''CREATE TABLE IF NOT EXISTS "user_photos"
+        (
+            "photo_id" UUID NOT NULL UNIQUE PRIMARY KEY,
+            "user_id" UUID NOT NULL REFERENCES "users" ("user_id") ON DELETE CASCADE
+        )''',
+    '''CREATE TABLE IF NOT EXISTS "profile_photos"
+        (
+            "photo_id" UUID NOT NULL UNIQUE PRIMARY KEY,
+            "profile_id" UUID NOT NULL REFERENCES "profiles" ("profile_id") ON DELETE CASCADE
+        )''',
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: tuple[str, ...]
+
+
+migrations = (
+    Migration(1, "initial tables", INITIAL_TABLES),
+    Migration(2, "indexes for session, profile, nickname and photo lookups", (
+        '''CREATE INDEX IF NOT EXISTS sessions_user_id_device_id_idx ON sessions (user_id, device_id)''',
+        '''CREATE INDEX IF NOT EXISTS profiles_user_id_type_idx ON profiles (user_id, type)''',
+        '''CREATE INDEX IF NOT EXISTS users_lower_nickname_idx ON users (LOWER(nickname))''',
+        '''CREATE INDEX IF NOT EXISTS user_photos_user_id_idx ON user_photos (user_id)''',
+        '''CREATE INDEX IF NOT EXISTS profile_photos_profile_id_idx ON profile_photos (profile_id)''',
+    )),
+    Migration(3, "fit 'companion' into profiles.type", (
+        '''ALTER TABLE profiles ALTER COLUMN type TYPE VARCHAR(10)''',
+    )),
+    Migration(4, "profiles location mirrored from geo grid", (
+        '''ALTER TABLE profiles
+            ADD COLUMN IF NOT EXISTS "latitude" DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS "longitude" DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS "geo_cell" BIGINT''',
+        '''CREATE INDEX IF NOT EXISTS profiles_geo_cell_idx ON profiles (geo_cell) WHERE status''',
+    )),
+    Migration(5, "sizes of processed photo thumbnails", (
+        '''ALTER TABLE user_photos ADD COLUMN IF NOT EXISTS "variants" SMALLINT[]''',
+        '''ALTER TABLE profile_photos ADD COLUMN IF NOT EXISTS "variants" SMALLINT[]''',
+    )),
+    Migration(6, "content addressed photo blobs with reference counting", (
+        '''CREATE TABLE IF NOT EXISTS "photo_blobs"
+            (
+                "hash" CHAR(64) NOT NULL PRIMARY KEY,
+                "ref_count" INT NOT NULL DEFAULT 0,
+                "variants" SMALLINT[]
+            )''',
+        '''CREATE INDEX IF NOT EXISTS photo_blobs_orphans_idx ON photo_blobs (hash) WHERE ref_count <= 0''',
+        #  variants belong to blobs now
+        '''ALTER TABLE user_photos
+            DROP COLUMN IF EXISTS "variants",
+            ADD COLUMN IF NOT EXISTS "blob_hash" CHAR(64) REFERENCES "photo_blobs" ("hash")''',
+        '''ALTER TABLE profile_photos
+            DROP COLUMN IF EXISTS "variants",
+            ADD COLUMN IF NOT EXISTS "blob_hash" CHAR(64) REFERENCES "photo_blobs" ("hash")''',
+        '''CREATE INDEX IF NOT EXISTS user_photos_blob_hash_idx ON user_photos (blob_hash)''',
+        '''CREATE INDEX IF NOT EXISTS profile_photos_blob_hash_idx ON profile_photos (blob_hash)''',
+        '''CREATE OR REPLACE FUNCTION count_photo_blob_refs() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    UPDATE photo_blobs SET ref_count = ref_count + 1 WHERE hash = NEW.blob_hash;
+                    RETURN NEW;
+                END IF;
+                UPDATE photo_blobs SET ref_count = ref_count - 1 WHERE hash = OLD.blob_hash;
+                RETURN OLD;
+            END
+            $$ LANGUAGE plpgsql''',
+        '''DROP TRIGGER IF EXISTS user_photos_blob_refs ON user_photos''',
+        '''CREATE TRIGGER user_photos_blob_refs AFTER INSERT OR DELETE ON user_photos
+            FOR EACH ROW EXECUTE PROCEDURE count_photo_blob_refs()''',
+        '''DROP TRIGGER IF EXISTS profile_photos_blob_refs ON profile_photos''',
+        '''CREATE TRIGGER profile_photos_blob_refs AFTER INSERT OR DELETE ON profile_photos
+            FOR EACH ROW EXECUTE PROCEDURE count_photo_blob_refs()''',
+    )),
+    Migration(7, "revoked signed session tokens", (
+        '''CREATE TABLE IF NOT EXISTS "revoked_tokens"
+            (
+                "token_id" VARCHAR(32) NOT NULL PRIMARY KEY,
+                "expires_at" TIMESTAMP NOT NULL,
+                "revoked_at" TIMESTAMP NOT NULL DEFAULT now()
+            )''',
+        '''CREATE INDEX IF NOT EXISTS revoked_tokens_revoked_at_idx ON revoked_tokens (revoked_at)''',
+    )),
+    Migration(8, "expired sessions lookup", (
+        '''CREATE INDEX IF NOT EXISTS sessions_start_time_idx ON sessions (start_time)''',
+    )),
+    Migration(9, "write-behind ratings", (
+        '''CREATE INDEX IF NOT EXISTS user_rating_user_id_idx ON user_rating (user_id)''',
+        '''CREATE TABLE IF NOT EXISTS "applied_rating_journals"
+            (
+                "journal_id" UUID NOT NULL PRIMARY KEY,
+                "applied_at" TIMESTAMP NOT NULL DEFAULT now()
+            )''',
+    )),
+    Migration(10, "keyset pagination of profiles and photos", (
+        '''CREATE INDEX IF NOT EXISTS profiles_user_id_profile_id_idx ON profiles (user_id, profile_id)''',
+        '''CREATE INDEX IF NOT EXISTS user_photos_user_id_photo_id_idx ON user_photos (user_id, photo_id)''',
+        '''CREATE INDEX IF NOT EXISTS profile_photos_profile_id_photo_id_idx
+            ON profile_photos (profile_id, photo_id)''',
+        #  covered by the new indexes
+        '''DROP INDEX IF EXISTS user_photos_user_id_idx''',
+        '''DROP INDEX IF EXISTS profile_photos_profile_id_idx''',
+    )),
+    Migration(11, "nicknames unique case-insensitively", (
+        #  duplicates registered by racing requests get the first free _<number> suffix in order
+        #  of registration, the earliest user keeps nickname as it is
+        '''DO $$
+            DECLARE
+                duplicate RECORD;
+                number INT;
+                renamed VARCHAR(35);
+            BEGIN
+                FOR duplicate IN
+                    SELECT user_id, nickname FROM (
+                        SELECT
+                            user_id, nickname,
+                            ROW_NUMBER() OVER (PARTITION BY LOWER(nickname) ORDER BY reg_time, user_id) AS position
+                        FROM users WHERE nickname IS NOT NULL
+                    ) AS ranked
+                    WHERE position > 1
+                    ORDER BY LOWER(nickname), position
+                LOOP
+                    number := 1;
+                    LOOP
+                        number := number + 1;
+                        renamed := LEFT(duplicate.nickname, 35 - LENGTH('_' || number)) || '_' || number;
+                        EXIT WHEN NOT EXISTS (SELECT 1 FROM users WHERE LOWER(nickname) = LOWER(renamed));
+                    END LOOP;
+                    UPDATE users SET nickname = renamed WHERE user_id = duplicate.user_id;
+                END LOOP;
+            END
+        $$''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS users_lower_nickname_key ON users (LOWER(nickname))''',
+        #  implied by the new index, which is the only conflict target of registrations
+        '''ALTER TABLE users DROP CONSTRAINT IF EXISTS users_nickname_key''',
+        '''DROP INDEX IF EXISTS users_lower_nickname_idx''',
+    )),
+    Migration(12, "processed blobs of uploaded photos", (
+        #  blobs are named by hash of processed content, upload is found by hash of its own content
+        '''CREATE TABLE IF NOT EXISTS "photo_sources"
+            (
+                "hash" CHAR(64) NOT NULL PRIMARY KEY,
+                "blob_hash" CHAR(64) NOT NULL REFERENCES "photo_blobs" ("hash") ON DELETE CASCADE
+            )''',
+        '''CREATE INDEX IF NOT EXISTS photo_sources_blob_hash_idx ON photo_sources (blob_hash)''',
+        #  existing blobs were processed in place under hash of upload, ones without variants never were
+        '''INSERT INTO photo_sources (hash, blob_hash)
+            SELECT hash, hash FROM photo_blobs WHERE variants IS NOT NULL
+            ON CONFLICT DO NOTHING''',
+    )),
+)
+
+create_migrations_table = '''CREATE TABLE IF NOT EXISTS "schema_migrations"
+                (
+                    "version" INT NOT NULL PRIMARY KEY,
+                    "name" VARCHAR(100) NOT NULL,
+                    "applied_at" TIMESTAMP NOT NULL DEFAULT now()
+                )'''
+
+select_version = '''SELECT COALESCE(MAX(version), 0) FROM schema_migrations'''
+
+insert_version = '''INSERT INTO schema_migrations (version, name) VALUES ($1, $2)'''
+
+
+async def current_version(conn: Connection) -> int:
+    """Return version of the last applied migration, 0 for empty database"""
+    if await conn.fetchval('''SELECT to_regclass('schema_migrations')''') is None:
+        return 0
+    return await conn.fetchval(select_version)
+
+
+async def migrate(conn: Connection):
+    """
+    Apply all pending migrations in one transaction.
+    Up to date database is detected without taking the lock
+    """
+    latest = migrations[-1].version
+    if await current_version(conn) >= latest:
+        return
+
+    async with conn.transaction():
+        await conn.execute('''SELECT pg_advisory_xact_lock($1)''', MIGRATIONS_LOCK_KEY)
+        await conn.execute(create_migrations_table)
+        applied = await conn.fetchval(select_version)
+        for migration in migrations:
+            if migration.version <= applied:
+                continue
+            for statement in migration.statements:
+                await conn.execute(statement)
+            await conn.execute(insert_version, migration.version, migration.name)
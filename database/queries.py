@@ -1,89 +1,417 @@
-from asyncpg import Connection, Pool
+from asyncpg import Connection, Pool, Record
+from asyncpg.connection import LoggedQuery
+from asyncpg.exceptions import (
+    CannotConnectNowError, PostgresConnectionError, TooManyConnectionsError, TransactionRollbackError
+)
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import date, datetime
+from functools import wraps
+from time import perf_counter
+from typing import AsyncIterator, Awaitable, Callable, Optional
 
+import asyncio
+import metrics
 import my_exceptions
-from .sql import tables
+import profiling
 from my_exceptions import TooManyPhotos
 
-from . import sql
+from . import migrations, statements
+from .replicas import ReplicaSet
+from .statements import PreparedConnection
+
+
+#  replica is taken out of reads until it passes the next check
+REPLICA_DOWN_ERRORS = (
+    OSError, asyncio.TimeoutError, PostgresConnectionError, CannotConnectNowError, TooManyConnectionsError
+)
+#  query canceled by conflict with recovery is read again from primary
+REPLICA_ERRORS = REPLICA_DOWN_ERRORS + (TransactionRollbackError,)
+
+
+class RequestScope:
+    """
+    Connection shared by all queries of one request.
+    Connection is acquired on first query and released by close().
+    Queries of request must not run concurrently, asyncpg connection
+    runs one query at a time, so gathered queries need their own connections
+    """
+    def __init__(self, db_pool: Pool):
+        self.db_pool = db_pool
+        self.conn: Optional[Connection] = None
+        self.closed = False
+        #  reads after write are not sent to replicas
+        self.wrote = False
+        #  concurrent first queries acquire one connection, and close waits for acquire in progress
+        self._lock = asyncio.Lock()
+
+    async def connection(self) -> Connection:
+        async with self._lock:
+            if self.conn is None:
+                started = perf_counter()
+                self.conn = await self.db_pool.acquire()
+                metrics.pool_acquire_seconds.observe(perf_counter() - started)
+                profiling.add_time("pool", perf_counter() - started)
+            return self.conn
+
+    async def release(self):
+        """Give connection back to pool, next query of request acquires it again"""
+        async with self._lock:
+            if self.conn is not None:
+                conn, self.conn = self.conn, None
+                await self.db_pool.release(conn)
+
+    async def close(self):
+        self.closed = True
+        await self.release()
+
+
+_request_scope: ContextVar[Optional[RequestScope]] = ContextVar("request_scope", default=None)
+
+
+@asynccontextmanager
+async def request_scope(db_pool: Pool) -> AsyncIterator[RequestScope]:
+    """
+    Bind request scope to current context, all queries
+    with the same pool inside will use one connection
+    """
+    scope = RequestScope(db_pool)
+    token = _request_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _request_scope.reset(token)
+        await scope.close()
+
+
+async def release_request_connection():
+    """Release connection of current request before long work without queries"""
+    scope = _request_scope.get()
+    if scope is not None:
+        await scope.release()
+
+
+@asynccontextmanager
+async def acquire(db_pool: Pool) -> AsyncIterator[Connection]:
+    """Take connection of current request scope or acquire new one from pool"""
+    scope = _request_scope.get()
+    if scope is not None and scope.db_pool is db_pool and not scope.closed:
+        yield await scope.connection()
+    else:
+        started = perf_counter()
+        async with db_pool.acquire() as conn:
+            metrics.pool_acquire_seconds.observe(perf_counter() - started)
+            profiling.add_time("pool", perf_counter() - started)
+            yield conn
+
+
+_replica_sets: dict[Pool, ReplicaSet] = {}
+
+
+def use_replicas(replica_set: ReplicaSet):
+    """Send reads of primary pool to its replicas"""
+    _replica_sets[replica_set.primary] = replica_set
+
+
+def has_replicas(db_pool: Pool) -> bool:
+    return db_pool in _replica_sets
+
+
+def read_pool(db_pool: Pool) -> Pool:
+    """Pool for read, request which wrote reads its writes from primary"""
+    replica_set = _replica_sets.get(db_pool)
+    if replica_set is None:
+        return db_pool
+    scope = _request_scope.get()
+    if scope is not None and scope.db_pool is db_pool and scope.wrote:
+        return db_pool
+    return replica_set.choose()
+
+
+async def run_read(db_pool: Pool, primary: bool, read: Callable[[Connection], Awaitable]):
+    """Run read on replica, on primary if replica is not available or fails"""
+    pool = db_pool if primary else read_pool(db_pool)
+    if pool is not db_pool:
+        try:
+            async with acquire(pool) as conn:
+                result = await read(conn)
+        except REPLICA_ERRORS as exc:
+            if isinstance(exc, REPLICA_DOWN_ERRORS):
+                _replica_sets[db_pool].mark_down(pool)
+        else:
+            metrics.db_reads.inc("replica")
+            return result
+
+    metrics.db_reads.inc("primary")
+    async with acquire(db_pool) as conn:
+        return await read(conn)
 
 
 def conn_transaction(func):
     """
     Take connection pool, acquire new connection and wrapped all queries in transaction
     """
+    @wraps(func)
     async def wrapper(db_pool: Pool, *args, **kwargs):
-        async with db_pool.acquire() as conn:
+        scope = _request_scope.get()
+        if scope is not None and scope.db_pool is db_pool:
+            scope.wrote = True
+        async with acquire(db_pool) as conn:
             async with conn.transaction():
                 return await func(conn=conn, *args, **kwargs)
     return wrapper
 
 
-@conn_transaction
-async def init_database(conn: Connection):
+def conn_read(func):
     """
-    Init tables in database. Run on startup application
+    Take connection pool, acquire connection and run query without explicit transaction.
+    Use only for single read statements. Read goes to replica unless primary is requested
     """
-    for table in tables:
-        await conn.execute(tables[table])
+    @wraps(func)
+    async def wrapper(db_pool: Pool, *args, primary: bool = False, **kwargs):
+        return await run_read(db_pool, primary, lambda conn: func(conn=conn, *args, **kwargs))
+    return wrapper
 
 
-@conn_transaction
-async def is_nickname_free(conn: Connection, nickname: str) -> bool:
+def conn_read_transaction(func):
+    """Several reads from one snapshot in read only transaction, routed like conn_read"""
+    @wraps(func)
+    async def wrapper(db_pool: Pool, *args, primary: bool = False, **kwargs):
+        async def read(conn: Connection):
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                return await func(conn=conn, *args, **kwargs)
+        return await run_read(db_pool, primary, read)
+    return wrapper
+
+
+#  statements sent by asyncpg itself, pool resets connection on release
+SERVICE_STATEMENTS = (
+    ("BEGIN", "begin"), ("COMMIT", "commit"), ("ROLLBACK", "rollback"),
+    ("SELECT pg_advisory_unlock_all()", "pool_reset"),
+)
+
+
+def statement_name(query: str) -> str:
+    name = statements.names.get(query)
+    if name is not None:
+        return name
+    for prefix, name in SERVICE_STATEMENTS:
+        if query.startswith(prefix):
+            return name
+    return "other"
+
+
+def log_query(query: LoggedQuery):
+    profiling.add_time("db", query.elapsed)
+    metrics.query_seconds.observe(
+        query.elapsed, statement_name(query.query), "error" if query.exception is not None else "ok"
+    )
+
+
+async def init_connection(conn: PreparedConnection):
+    """Called by pool for every new connection, pool has to be created with PreparedConnection class"""
+    conn.add_query_logger(log_query)
+
+
+async def reset_connection(conn: PreparedConnection):
+    """
+    Called by pool on release instead of default reset. Statements of new connection are
+    prepared on its first release, so only connections which were never prepared pay for it,
+    and idle connections are never taken just to be checked
     """
-    Check nickname in database for free
+    if not conn.prepared:
+        #  preparing isn't a query of any request
+        conn.remove_query_logger(log_query)
+        try:
+            await conn.prepare_statements()
+        finally:
+            conn.add_query_logger(log_query)
+    reset_query = conn.get_reset_query()
+    if reset_query:
+        await conn.execute(reset_query)
+
+
+async def prepare_connections(db_pool: Pool):
+    """Prepare statements of connections opened on start, they are prepared when they are released"""
+    connections = []
+    try:
+        for _ in range(db_pool.get_idle_size()):
+            connections.append(await db_pool.acquire())
+    finally:
+        await asyncio.gather(*(db_pool.release(conn) for conn in connections))
+
+
+async def init_database(db_pool: Pool):
     """
-    if await conn.fetchval(sql.select_nickname, nickname):
-        return False
-    return True
+    Apply pending migrations to database and prepare statements
+    of connections opened on start. Run on startup application
+    """
+    async with db_pool.acquire() as conn:
+        await migrations.migrate(conn)
+    await prepare_connections(db_pool)
+
+
+@conn_read
+async def select_taken_nicknames(conn: Connection, nicknames: list[str]) -> set[str]:
+    """Taken nicknames of batch in lower case"""
+    return {record[0] for record in await conn.statements["select_taken_nicknames"].fetch(nicknames)}
+
+
+@conn_read
+async def count_users(conn: Connection) -> int:
+    return await conn.statements["count_users"].fetchval()
+
+
+@conn_read_transaction
+async def select_nicknames(conn: Connection, callback: Callable[[str], None]):
+    """Stream nicknames of all users to callback"""
+    async for record in conn.statements["select_nicknames"].cursor(prefetch=5000):
+        callback(record[0])
 
 
 @conn_transaction
-async def create_user(
-    conn: Connection, user_id: str, nickname: str, first_name: str,
-    reg_time: datetime, born_date: date, gender: str,
-    hashed_password: str, rating_uuid: str
-):
+async def create_users(conn: Connection, users: list[tuple]) -> set[str]:
     """
-    create new user in database
+    Insert batch of users with their ratings. Users are (user_id, nickname, first_name,
+    reg_time, born_date, gender, hashed_password, rating_id), users with taken nickname
+    are skipped. Return ids of created users
     """
-    await conn.execute(
-        sql.create_user, user_id, nickname, first_name,
-        reg_time, born_date, gender, hashed_password, rating_uuid
-    )
+    records = await conn.statements["insert_users"].fetch(*zip(*users))
+    return {str(record["user_id"]) for record in records}
 
 
 @conn_transaction
-async def create_or_get_session(
-    conn: Connection, session_id: str, user_id: str,
-    device_id: str, start_time: datetime, token: str,
-    hashed_password: str
-) -> str:
+async def create_sessions(conn: Connection, sessions: list[tuple], valid_since: datetime) -> dict[str, str]:
     """
-    Checking existing sessions on this device, return if exists or create new
+    Create sessions or take existing sessions of devices started after valid_since
+    for batch of authorizations. Sessions are (session_id, user_id, device_id,
+    start_time, token, hashed_password). Return session_id -> token for authorized requests
     """
-    exists_token = await conn.fetchval(sql.get_session_token_by_device, user_id, device_id, hashed_password)
-    if exists_token:
-        return exists_token
-    await conn.execute(sql.insert_session, user_id, hashed_password, session_id, device_id, start_time, token)
-    return token
+    records = await conn.statements["insert_sessions"].fetch(*zip(*sessions), valid_since)
+    return {str(record["session_id"]): record["token"] for record in records}
+
+
+@conn_transaction
+async def update_session_token(conn: Connection, user_id: str, device_id: str, token: str, start_time: datetime):
+    """Replace expired or legacy token of device session"""
+    await conn.statements["update_session_token"].execute(user_id, device_id, token, start_time)
 
 
 @conn_transaction
-async def his_authorized(conn: Connection, user_id: str, device_id: str, token: str) -> bool:
+async def delete_session(conn: Connection, user_id: str, device_id: str, revoked: Optional[tuple[str, int]] = None):
+    """Delete device session, id and expiry of signed token are saved to revoked tokens"""
+    await conn.statements["delete_session"].execute(user_id, device_id)
+    if revoked is not None:
+        await conn.statements["insert_revoked_token"].execute(*revoked)
+
+
+@conn_transaction
+async def select_revoked_tokens(conn: Connection, since: datetime) -> list[Record]:
+    """Tokens revoked after since, expired ones are deleted"""
+    await conn.statements["delete_expired_revoked_tokens"].execute()
+    return await conn.statements["select_revoked_tokens"].fetch(since)
+
+
+@conn_read
+async def session_start_time(
+    conn: Connection, user_id: str, device_id: str, token: str, valid_since: datetime
+) -> Optional[datetime]:
     """
-    Check user authorization
+    Check user authorization, return start of session or None if there is no
+    session with the token started after valid_since
     """
-    return await conn.fetchval(sql.select_session_token, user_id, device_id) == token
+    return await conn.statements["select_session_start"].fetchval(user_id, device_id, token, valid_since)
+
+
+@conn_transaction
+async def delete_expired_sessions(conn: Connection, started_before: datetime, limit: int) -> int:
+    """Delete batch of expired sessions, sessions locked by other workers are skipped"""
+    status = await conn.statements["delete_expired_sessions"].execute(started_before, limit)
+    return int(status.split()[-1])
+
+
+@conn_transaction
+async def apply_ratings(conn: Connection, journal_id: str, deltas: dict[str, tuple[int, int]], keep_days: int):
+    """Add sums of rates to users ratings, journal which is already applied is skipped"""
+    if await conn.statements["insert_rating_journal"].execute(journal_id) == "INSERT 0 0":
+        return
+    user_ids = sorted(deltas)
+    await conn.statements["lock_ratings"].execute(user_ids)
+    await conn.statements["update_ratings"].execute(
+        user_ids,
+        [deltas[user_id][0] for user_id in user_ids], [deltas[user_id][1] for user_id in user_ids]
+    )
+    await conn.statements["delete_old_rating_journals"].execute(keep_days)
+
+
+@conn_read
+async def select_rating(conn: Connection, user_id: str) -> Optional[Record]:
+    """Sum and count of user's rates written to database, None if user doesn't exist"""
+    return await conn.statements["select_rating"].fetchrow(user_id)
+
+
+@conn_transaction
+async def notify(conn: Connection, channel: str, payload: str):
+    """Send message to listeners of channel in all workers"""
+    await conn.statements["notify"].execute(channel, payload)
+
+
+@conn_read
+async def select_photo_sources(conn: Connection, hashes: list[str]) -> dict[str, str]:
+    """Blobs of uploads which were processed before, by hash of upload"""
+    records = await conn.statements["select_photo_sources"].fetch(hashes)
+    return {record["hash"]: record["blob_hash"] for record in records}
 
 
 @conn_transaction
-async def add_photo(conn: Connection, photos: tuple[tuple[str, str]], photo_type: str, subject_id: str):
-    """Check user's uploaded photo count, if greater than 5 raise exception"""
-    photos_count = await conn.fetchval(sql.select_photo_count.format(photo_type=photo_type), subject_id)
+async def add_photo(
+    conn: Connection, photos: tuple[tuple[str, str, str]], photo_type: str, subject_id: str,
+    sources: dict[str, str],
+    store: Callable[[set[str]], Awaitable[dict[str, list[int]]]],
+    discard: Callable[[list[str]], None]
+):
+    """
+    Check user's uploaded photo count, if greater than 5 raise exception. Photos are
+    (photo_id, subject_id, blob_hash), sources are hashes of uploads processed to blobs.
+    Files of blobs created by this upload are stored while their rows are locked, so photos
+    are committed only after their files exist. Store returns sizes of thumbnails of stored blobs.
+    If upload fails or is cancelled before commit, stored files are discarded
+    """
+    photos_count = await conn.statements[f"select_photo_count.{photo_type}"].fetchval(subject_id)
     if (photos_count + len(photos)) > 5:
         raise TooManyPhotos("Max count of photos 5!")
-    await conn.executemany(sql.insert_photo.format(photo_type=photo_type), photos)
+
+    new_blobs = set()
+    #  the same order of locks in all transactions
+    for blob_hash in sorted({photo[2] for photo in photos}):
+        if await conn.statements["upsert_photo_blob"].fetchval(blob_hash):
+            new_blobs.add(blob_hash)
+    try:
+        variants = await store(new_blobs)
+        await conn.statements["update_blob_variants"].executemany(sorted(variants.items()))
+        await conn.statements[f"insert_photo.{photo_type}"].executemany(photos)
+        await conn.statements["insert_photo_source"].executemany(sorted(sources.items()))
+    except BaseException:
+        #  rows are still locked, so concurrent upload of the same blob waits and stores it again
+        discard(sorted(new_blobs))
+        raise
+
+
+@conn_transaction
+async def delete_photo(conn: Connection, photo_id: str, photo_type: str, user_id: str) -> bool:
+    """Delete user's photo, blob reference is released by trigger"""
+    return await conn.statements[f"delete_photo.{photo_type}"].execute(photo_id, user_id) == "DELETE 1"
+
+
+@conn_transaction
+async def delete_orphan_blobs(conn: Connection, limit: int, remove_blobs: Callable[[list[str]], None]) -> int:
+    """
+    Delete blobs without references. Files are removed before commit while rows
+    are locked, so concurrent upload of the same photo waits and writes it again
+    """
+    hashes = [record[0] for record in await conn.statements["delete_orphan_blobs"].fetch(limit)]
+    remove_blobs(hashes)
+    return len(hashes)
 
 
 @conn_transaction
@@ -95,15 +423,66 @@ async def create_profile(
     min_age: int,
     max_age: int,
     profile_type: str,
-    vehicle_type: str
-):
-    """Create new profile for user with appropriate profile type"""
-    db_profile_id = await conn.fetchval(sql.check_profile, user_id, profile_type)
+    vehicle_type: str,
+    latitude: Optional[float],
+    longitude: Optional[float],
+    geo_cell: Optional[int]
+) -> Record:
+    """Create new profile for user with appropriate profile type, return user's gender and born date"""
+    db_profile_id = await conn.statements["check_profile"].fetchval(user_id, profile_type)
     if db_profile_id:
         raise my_exceptions.ProfileAlreadyExists("User is already have active profile with the same type")
 
-    await conn.execute(sql.insert_profile,
-                       profile_id, user_id,
-                       desired_gender,
-                       min_age, max_age,
-                       profile_type, vehicle_type)
+    return await conn.statements["insert_profile"].fetchrow(
+        profile_id, user_id,
+        desired_gender,
+        min_age, max_age,
+        profile_type, vehicle_type,
+        latitude, longitude, geo_cell
+    )
+
+
+@conn_transaction
+async def update_location(
+    conn: Connection, profile_id: str, user_id: str,
+    latitude: float, longitude: float, geo_cell: int
+) -> bool:
+    """Move user's profile to new location, return False if profile doesn't exist"""
+    status = await conn.statements["update_location"].execute(profile_id, user_id, latitude, longitude, geo_cell)
+    return status == "UPDATE 1"
+
+
+@conn_read_transaction
+async def select_user_profiles(
+    conn: Connection, user_id: str, after: Optional[str], limit: int
+) -> tuple[list[Record], list[Record]]:
+    """
+    Page of user's profiles after cursor and photos of all profiles of the page.
+    One profile after the page is selected too, it tells if there is the next page
+    """
+    profiles = await conn.statements["select_user_profiles"].fetch(user_id, after, limit + 1)
+    photos = await conn.statements["select_profiles_photos"].fetch(
+        [profile["profile_id"] for profile in profiles[:limit]]
+    )
+    return profiles, photos
+
+
+@conn_read
+async def select_photos(
+    conn: Connection, subject_id: str, photo_type: str, after: Optional[str], limit: int
+) -> list[Record]:
+    """Page of photos of user or profile after cursor, with one photo of the next page"""
+    return await conn.statements[f"select_photos.{photo_type}"].fetch(subject_id, after, limit + 1)
+
+
+@conn_read_transaction
+async def select_active_profiles(conn: Connection, callback: Callable[[Record], None]):
+    """Stream all active profiles with their owners data to callback"""
+    async for record in conn.statements["select_active_profiles"].cursor(prefetch=5000):
+        callback(record)
+
+
+@conn_read
+async def search_opponents(conn: Connection, profile_id: str, today: date) -> list[str]:
+    """Find matching opponents with plain SQL, used to compare with in-memory index"""
+    return [record[0] for record in await conn.statements["search_opponents"].fetch(profile_id, today)]
@@ -0,0 +1,92 @@
+from asyncpg import Pool
+from itertools import count
+from typing import Optional
+
+import asyncio
+import logging
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class Replica:
+    def __init__(self, name: str, pool: Pool):
+        self.name = name
+        self.pool = pool
+        #  replica gets reads only after the first successful check
+        self.healthy = False
+        self.lag: Optional[float] = None
+
+
+class ReplicaSet:
+    """
+    Read replicas of primary pool. Replicas are checked periodically, reads go
+    to the least busy healthy replica which lags behind primary less than max_lag,
+    or to primary if there is no such replica. Replica which doesn't stream
+    from primary is not healthy, as its lag only grows
+    """
+    def __init__(self, primary: Pool, replicas: dict[str, Pool], max_lag: float, check_timeout: float):
+        self.primary = primary
+        self.replicas = [Replica(name, pool) for name, pool in replicas.items()]
+        self.max_lag = max_lag
+        self.check_timeout = check_timeout
+        self._turn = count()
+
+    def choose(self) -> Pool:
+        available = [replica for replica in self.replicas if replica.healthy and replica.lag <= self.max_lag]
+        if not available:
+            return self.primary
+        #  rotate start, so equally busy replicas are taken in turn
+        start = next(self._turn) % len(available)
+        available = available[start:] + available[:start]
+        return min(available, key=lambda replica: replica.pool.get_size() - replica.pool.get_idle_size()).pool
+
+    def mark_down(self, pool: Pool):
+        """Stop reads from replica until the next successful check"""
+        for replica in self.replicas:
+            if replica.pool is pool and replica.healthy:
+                replica.healthy = False
+                logger.warning("Replica %s is down", replica.name)
+
+    async def _primary_lsn(self) -> Optional[int]:
+        try:
+            async with self.primary.acquire(timeout=self.check_timeout) as conn:
+                return await conn.statements["select_primary_lsn"].fetchval(timeout=self.check_timeout)
+        except Exception as exc:
+            logger.warning("Position of primary is not checked: %r", exc)
+            return None
+
+    async def _check(self, replica: Replica, primary_lsn: Optional[int]):
+        try:
+            if primary_lsn is None:
+                raise RuntimeError("lag can't be measured without position of primary")
+            async with replica.pool.acquire(timeout=self.check_timeout) as conn:
+                state = await conn.statements["select_replica_lag"].fetchrow(primary_lsn, timeout=self.check_timeout)
+            if not state["streaming"]:
+                raise RuntimeError("not streaming from primary")
+            if state["lag"] is None:
+                raise RuntimeError("behind primary with nothing replayed")
+        except Exception as exc:
+            if replica.healthy:
+                logger.warning("Replica %s failed check: %r", replica.name, exc)
+            replica.healthy = False
+            replica.lag = None
+            return
+        replica.healthy = True
+        replica.lag = state["lag"]
+        metrics.replica_lag_seconds.set(replica.lag, replica.name)
+
+    async def check(self):
+        """Lag of replicas is measured against position of primary taken before them"""
+        primary_lsn = await self._primary_lsn()
+        await asyncio.gather(*(self._check(replica, primary_lsn) for replica in self.replicas))
+
+    async def run(self, interval: float):
+        """Periodically check health and lag of replicas"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.check()
+
+    async def close(self):
+        await asyncio.gather(*(replica.pool.close() for replica in self.replicas))
@@ -1,121 +1,255 @@
-tables = {
-    "users": '''CREATE TABLE IF NOT EXISTS "users"
-                (
-                    "user_id" UUID NOT NULL UNIQUE PRIMARY KEY,
-                    "nickname" VARCHAR(35) NULL UNIQUE,
-                    "first_name" VARCHAR(100) NOT NULL,
-                    "reg_time" TIMESTAMP NOT NULL,
-                    "born_date" DATE,
-                    "gender" VARCHAR(6),
-                    "hashed_password" VARCHAR(128)
-                )''',
-
-    "profiles": '''CREATE TABLE IF NOT EXISTS "profiles"
-                (
-                    "profile_id" UUID NOT NULL UNIQUE PRIMARY KEY,
-                    "user_id" UUID NOT NULL REFERENCES "users" ("user_id") ON DELETE CASCADE,
-                    "status" BOOL DEFAULT true,
-                    "desired_gender" VARCHAR(6),
-                    "min_age" SMALLINT,
-                    "max_age" SMALLINT,
-                    "type" VARCHAR(8),
-                    "vehicle_type" VARCHAR(8)
-                )''',  # type 0 - driver, 1 - companion, 2 - together
-
-    "user_rating": '''CREATE TABLE IF NOT EXISTS "user_rating"
-                (
-                    "rating_id" UUID NOT NULL UNIQUE PRIMARY KEY,
-                    "user_id" UUID NOT NULL REFERENCES "users" ("user_id") ON DELETE CASCADE,
-                    "rate" INT DEFAULT 0,
-                    "rate_count" INT DEFAULT 0
-                )''',
-
-    "sessions": '''CREATE TABLE IF NOT EXISTS "sessions"
-                (
-                    "session_id" UUID NOT NULL UNIQUE PRIMARY KEY,
-                    "user_id" UUID NOT NULL REFERENCES "users" ("user_id") ON DELETE CASCADE,
-                    "device_id" VARCHAR(32) NOT NULL,
-                    "start_time" TIMESTAMP NOT NULL,
-                    "token" VARCHAR(100) NOT NULL
-                )''',
-
-    "user_photos": '''CREATE TABLE IF NOT EXISTS "user_photos"
-                (   
-                    "photo_id" UUID NOT NULL UNIQUE PRIMARY KEY,
-                    "user_id" UUID NOT NULL REFERENCES "users" ("user_id") ON DELETE CASCADE
-                )''',
-
-    "profile_photos": '''CREATE TABLE IF NOT EXISTS "profile_photos"
-                (   
-                    "photo_id" UUID NOT NULL UNIQUE PRIMARY KEY,
-                    "profile_id" UUID NOT NULL REFERENCES "profiles" ("profile_id") ON DELETE CASCADE
-                )'''
-}
+#  nicknames of batch which are taken, in lower case
+select_taken_nicknames = '''SELECT LOWER(nickname) FROM users WHERE LOWER(nickname) = ANY($1::varchar[])'''
+
+count_users = '''SELECT count(*) FROM users'''
+
+select_nicknames = '''SELECT nickname FROM users'''
+
+#  batch of users in arrays, nicknames taken case-insensitively by previous users of
+#  the same batch or by existing users, committed or concurrent, are skipped by unique index
+insert_users = '''
+WITH requested AS (
+    SELECT DISTINCT ON (LOWER(nickname)) *
+    FROM unnest(
+        $1::uuid[], $2::varchar[], $3::varchar[], $4::timestamp[],
+        $5::date[], $6::varchar[], $7::varchar[], $8::uuid[]
+    ) WITH ORDINALITY AS requested (
+        user_id, nickname, first_name, reg_time, born_date, gender, hashed_password, rating_id, position
+    )
+    ORDER BY LOWER(nickname), position
+), new_users AS (
+    INSERT INTO users (user_id, nickname, first_name, reg_time, born_date, gender, hashed_password)
+    SELECT user_id, nickname, first_name, reg_time, born_date, gender, hashed_password FROM requested
+    ON CONFLICT ((LOWER(nickname))) DO NOTHING
+    RETURNING user_id
+)
+INSERT INTO user_rating (rating_id, user_id)
+SELECT requested.rating_id, requested.user_id FROM requested JOIN new_users USING (user_id)
+RETURNING user_id
+'''
+
+#  batch of session requests in arrays, existing session of device is returned,
+#  otherwise new one is created. Result has token for every authorized request
+insert_sessions = '''
+WITH requested AS (
+    SELECT *
+    FROM unnest(
+        $1::uuid[], $2::uuid[], $3::varchar[], $4::timestamp[], $5::varchar[], $6::varchar[]
+    ) WITH ORDINALITY AS requested (session_id, user_id, device_id, start_time, token, hashed_password, position)
+), authorized AS (
+    SELECT DISTINCT ON (requested.user_id, requested.device_id) requested.*
+    FROM requested
+    JOIN users ON users.user_id = requested.user_id AND users.hashed_password = requested.hashed_password
+    ORDER BY requested.user_id, requested.device_id, requested.position
+), existing AS (
+    SELECT DISTINCT ON (authorized.user_id, authorized.device_id)
+        authorized.user_id, authorized.device_id, sessions.token
+    FROM authorized
+    JOIN sessions ON sessions.user_id = authorized.user_id AND sessions.device_id = authorized.device_id
+    WHERE sessions.start_time > $7
+    ORDER BY authorized.user_id, authorized.device_id, sessions.start_time DESC
+), inserted AS (
+    INSERT INTO sessions (session_id, user_id, device_id, start_time, token)
+    SELECT session_id, user_id, device_id, start_time, token
+    FROM authorized
+    WHERE NOT EXISTS (
+        SELECT 1 FROM existing
+        WHERE existing.user_id = authorized.user_id AND existing.device_id = authorized.device_id
+    )
+    RETURNING user_id, device_id, token
+), tokens AS (
+    SELECT user_id, device_id, token FROM existing
+    UNION ALL
+    SELECT user_id, device_id, token FROM inserted
+)
+SELECT requested.session_id, tokens.token
+FROM requested
+JOIN tokens ON tokens.user_id = requested.user_id AND tokens.device_id = requested.device_id
+JOIN users ON users.user_id = requested.user_id AND users.hashed_password = requested.hashed_password
+'''
 
+select_session_start = '''
+SELECT MAX(start_time) FROM sessions WHERE user_id=$1 AND device_id=$2 AND token=$3 AND start_time > $4
+'''
 
-select_nickname = '''SELECT nickname FROM users WHERE LOWER(nickname)=LOWER($1)'''
+update_session_token = '''UPDATE sessions SET token=$3, start_time=$4 WHERE user_id=$1 AND device_id=$2'''
 
-create_user = '''WITH new_user  AS (
-                    INSERT INTO users (user_id, nickname, first_name, reg_time, born_date, gender, hashed_password)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7))
-                    INSERT INTO user_rating (rating_id, user_id)
-                    VALUES ($8, $1)'''
+delete_session = '''DELETE FROM sessions WHERE user_id=$1 AND device_id=$2'''
 
-get_session_token_by_device = '''
-    SELECT token 
-    FROM sessions
-    LEFT JOIN users ON users.user_id = sessions.user_id
-    WHERE 
-        users.user_id=$1
-        AND device_id=$2
-        AND users.hashed_password=$3
+delete_expired_sessions = '''
+DELETE FROM sessions WHERE session_id IN (
+    SELECT session_id FROM sessions WHERE start_time < $1 ORDER BY start_time LIMIT $2 FOR UPDATE SKIP LOCKED
+)
 '''
 
-insert_session = '''
-WITH found_user_id as (
-    SELECT user_id 
-    FROM users 
-    WHERE 
-        user_id = $1
-        AND hashed_password = $2
-)
-INSERT INTO sessions VALUES ($3, (SELECT user_id FROM found_user_id), $4, $5, $6)
+insert_revoked_token = '''
+INSERT INTO revoked_tokens (token_id, expires_at) VALUES ($1, to_timestamp($2) AT TIME ZONE 'UTC')
+ON CONFLICT DO NOTHING
 '''
 
-select_session_token = '''SELECT token FROM sessions WHERE user_id=$1 AND device_id=$2'''
+#  recently revoked tokens are selected again, so rows committed late are not missed
+select_revoked_tokens = '''
+SELECT token_id, EXTRACT(EPOCH FROM expires_at AT TIME ZONE 'UTC')::BIGINT AS expires_at, revoked_at
+FROM revoked_tokens
+WHERE revoked_at > $1::TIMESTAMP - INTERVAL '1 minute' AND expires_at > now() AT TIME ZONE 'UTC'
+'''
+
+delete_expired_revoked_tokens = '''
+DELETE FROM revoked_tokens WHERE expires_at < now() AT TIME ZONE 'UTC'
+'''
+
+insert_rating_journal = '''
+INSERT INTO applied_rating_journals (journal_id) VALUES ($1) ON CONFLICT DO NOTHING
+'''
+
+delete_old_rating_journals = '''
+DELETE FROM applied_rating_journals WHERE applied_at < now() - $1::INT * INTERVAL '1 day'
+'''
+
+#  rows are locked in the same order by all workers
+lock_ratings = '''
+SELECT 1 FROM user_rating WHERE user_id = ANY($1::uuid[]) ORDER BY user_id FOR UPDATE
+'''
+
+#  sums of rates in arrays
+update_ratings = '''
+UPDATE user_rating
+SET rate = user_rating.rate + delta.rate, rate_count = user_rating.rate_count + delta.rate_count
+FROM unnest($1::uuid[], $2::int[], $3::int[]) AS delta (user_id, rate, rate_count)
+WHERE user_rating.user_id = delta.user_id
+'''
+
+select_rating = '''SELECT rate, rate_count FROM user_rating WHERE user_id=$1'''
+
+notify = '''SELECT pg_notify($1, $2)'''
+
+#  position of primary which replicas are compared with
+select_primary_lsn = '''SELECT pg_current_wal_lsn()'''
+
+#  replica streams from primary and its seconds of lag. Replica which replayed position $1 of primary
+#  isn't lagging, otherwise lag is age of its last replayed transaction, NULL if it replayed none
+select_replica_lag = '''
+SELECT
+    EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') AS streaming,
+    CASE
+        WHEN pg_last_wal_replay_lsn() >= $1::pg_lsn THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END::float8 AS lag
+'''
 
 select_photo_count = '''SELECT COUNT(photo_id) FROM {photo_type}_photos WHERE {photo_type}_id=$1'''
 
-insert_photo = '''INSERT INTO {photo_type}_photos VALUES ($1, $2)'''
+insert_photo = '''INSERT INTO {photo_type}_photos (photo_id, {photo_type}_id, blob_hash) VALUES ($1, $2, $3)'''
+
+#  row is locked, so blob can't be collected until photo referencing it is committed
+upsert_photo_blob = '''
+    INSERT INTO photo_blobs (hash) VALUES ($1)
+    ON CONFLICT (hash) DO UPDATE SET hash=EXCLUDED.hash
+    RETURNING xmax = 0
+'''
 
-insert_profile = '''INSERT INTO profiles (profile_id, user_id, desired_gender, min_age, max_age, type, vehicle_type)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7)'''
+update_blob_variants = '''UPDATE photo_blobs SET variants=$2 WHERE hash=$1'''
 
-check_profile = '''SELECT profile_id FROM profiles WHERE user_id=$1 AND type=$2'''
+select_photo_sources = '''SELECT hash, blob_hash FROM photo_sources WHERE hash = ANY($1::char(64)[])'''
+
+#  the same upload processed concurrently keeps the first blob
+insert_photo_source = '''INSERT INTO photo_sources (hash, blob_hash) VALUES ($1, $2) ON CONFLICT (hash) DO NOTHING'''
+
+delete_photo = {
+    "user": '''DELETE FROM user_photos WHERE photo_id=$1 AND user_id=$2''',
+    "profile": '''
+        DELETE FROM profile_photos
+        WHERE photo_id=$1 AND profile_id IN (SELECT profile_id FROM profiles WHERE user_id=$2)
+    '''
+}
+
+delete_orphan_blobs = '''
+    DELETE FROM photo_blobs
+    WHERE hash IN (
+        SELECT hash FROM photo_blobs WHERE ref_count <= 0
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING hash
+'''
+
+insert_profile = '''WITH new_profile AS (
+                        INSERT INTO profiles (
+                            profile_id, user_id, desired_gender, min_age, max_age, type, vehicle_type,
+                            latitude, longitude, geo_cell
+                        )
+                        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10))
+                    SELECT gender, born_date FROM users WHERE user_id=$2'''
+
+#  pages are selected after cursor in order of ids, xmin is version of row
+select_user_profiles = '''
+    SELECT
+        profile_id::text, status, desired_gender, min_age, max_age, type, vehicle_type,
+        latitude, longitude, xmin::text AS version
+    FROM profiles
+    WHERE user_id=$1 AND ($2::uuid IS NULL OR profile_id > $2)
+    ORDER BY profile_id
+    LIMIT $3
+'''
+
+select_profiles_photos = '''
+    SELECT
+        profile_photos.profile_id::text AS subject_id, profile_photos.photo_id::text, profile_photos.blob_hash,
+        photo_blobs.variants, profile_photos.xmin::text AS version, photo_blobs.xmin::text AS blob_version
+    FROM profile_photos
+    LEFT JOIN photo_blobs ON photo_blobs.hash = profile_photos.blob_hash
+    WHERE profile_photos.profile_id = ANY($1::uuid[])
+    ORDER BY profile_photos.profile_id, profile_photos.photo_id
+'''
 
-create_or_get_session = '''
-DO
-$do$
-    BEGIN
-        IF EXISTS (
-            SELECT 
-                token 
-            FROM
-                sessions
-            LEFT JOIN users ON users.user_id = sessions.user_id
-            WHERE 
-                sessions.user_id='{user_id}'
-                AND device_id='{device_id}'
-                AND users.hashed_password='{hashed_password}') THEN
-            BEGIN
-                RETURN (SELECT token FROM sessions WHERE user_id='{user_id}');
-        ELSE        
-            IF ((SELECT user_id FROM users WHERE hashed_password = '{hashed_password}') = '{user_id}') THEN
-                INSERT INTO sessions VALUES ('{session_id}', '{user_id}', '{device_id}', '{start_time}', '{token}');
-            ELSE
-                RAISE EXCEPTION 'error';
-            END IF;
-        END IF;
-    END
-$do$
+select_photos = '''
+    SELECT
+        photos.photo_id::text, photos.blob_hash, photo_blobs.variants,
+        photos.xmin::text AS version, photo_blobs.xmin::text AS blob_version
+    FROM {photo_type}_photos AS photos
+    LEFT JOIN photo_blobs ON photo_blobs.hash = photos.blob_hash
+    WHERE photos.{photo_type}_id=$1 AND ($2::uuid IS NULL OR photos.photo_id > $2)
+    ORDER BY photos.photo_id
+    LIMIT $3
 '''
+
+select_active_profiles = '''
+    SELECT
+        profiles.profile_id::text, profiles.user_id::text, users.gender, users.born_date,
+        profiles.desired_gender, profiles.min_age, profiles.max_age,
+        profiles.type, profiles.vehicle_type,
+        profiles.latitude, profiles.longitude
+    FROM profiles
+    JOIN users ON users.user_id = profiles.user_id
+    WHERE profiles.status AND users.born_date IS NOT NULL
+'''
+
+update_location = '''UPDATE profiles SET latitude=$3, longitude=$4, geo_cell=$5 WHERE profile_id=$1 AND user_id=$2'''
+
+#  the same matching as search.ProfileIndex does, used for benchmarks
+search_opponents = '''
+WITH me AS (
+    SELECT profiles.*, users.gender, users.born_date, date_part('year', age($2::date, users.born_date)) AS age
+    FROM profiles
+    JOIN users ON users.user_id = profiles.user_id
+    WHERE profile_id=$1
+)
+SELECT profiles.profile_id::text
+FROM profiles
+JOIN users ON users.user_id = profiles.user_id
+CROSS JOIN me
+WHERE
+    profiles.status
+    AND profiles.user_id <> me.user_id
+    AND users.gender = me.desired_gender
+    AND profiles.desired_gender = me.gender
+    AND date_part('year', age($2::date, users.born_date)) BETWEEN me.min_age AND me.max_age
+    AND me.age BETWEEN profiles.min_age AND profiles.max_age
+    AND (
+        me.type = 'any' OR profiles.type = 'any'
+        OR (me.type, profiles.type) IN (('driver', 'companion'), ('companion', 'driver'), ('together', 'together'))
+    )
+    AND (me.vehicle_type = 'any' OR profiles.vehicle_type = 'any' OR me.vehicle_type = profiles.vehicle_type)
+'''
+
+check_profile = '''SELECT profile_id FROM profiles WHERE user_id=$1 AND type=$2'''
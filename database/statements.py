@@ -0,0 +1,91 @@
+from asyncpg import Connection
+from asyncpg.exceptions import PostgresError
+from typing import Optional
+
+from . import sql
+
+
+#  photo types of formatted statements
+PHOTO_TYPES = ("user", "profile")
+
+
+def _registry() -> dict[str, str]:
+    """
+    Name -> text of every statement from sql module. Statements of dicts and
+    formatted statements get key or photo type suffix
+    """
+    statements = {}
+    for name, statement in vars(sql).items():
+        if name.startswith("_"):
+            continue
+        if isinstance(statement, dict):
+            for key, value in statement.items():
+                statements[f"{name}.{key}"] = value
+        elif isinstance(statement, str):
+            if "{photo_type}" in statement:
+                for photo_type in PHOTO_TYPES:
+                    statements[f"{name}.{photo_type}"] = statement.format(photo_type=photo_type)
+            else:
+                statements[name] = statement
+    return statements
+
+
+statements = _registry()
+names = {text: name for name, text in statements.items()}
+
+
+class Statement:
+    """
+    Statement of connection by name. It runs by text, so it is taken from statement cache
+    of connection, executions are observed in query metrics by query logger
+    """
+    __slots__ = ("conn", "name", "text")
+
+    def __init__(self, conn: Connection, name: str, text: str):
+        self.conn = conn
+        self.name = name
+        self.text = text
+
+    async def fetch(self, *args, **kwargs) -> list:
+        return await self.conn.fetch(self.text, *args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        return await self.conn.fetchrow(self.text, *args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        return await self.conn.fetchval(self.text, *args, **kwargs)
+
+    async def execute(self, *args, **kwargs) -> str:
+        return await self.conn.execute(self.text, *args, **kwargs)
+
+    async def executemany(self, args: list, **kwargs):
+        return await self.conn.executemany(self.text, args, **kwargs)
+
+    def cursor(self, *args, prefetch: Optional[int] = None):
+        return self.conn.cursor(self.text, *args, prefetch=prefetch)
+
+
+class PreparedConnection(Connection):
+    """
+    Connection with all statements of sql module. Statements are prepared into statement
+    cache of connection when it is released the first time, so queries of later requests don't
+    parse and plan them. PreparedStatement objects aren't kept, asyncpg invalidates them when
+    connection is released to pool, while cached statements stay prepared
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = {name: Statement(self, name, text) for name, text in statements.items()}
+        self.prepared = False
+
+    async def prepare_statements(self):
+        """
+        Prepare statements into cache. executemany without arguments parses statement
+        and executes nothing. Ones on tables which don't exist are prepared on first use
+        """
+        for statement in self.statements.values():
+            try:
+                await self.executemany(statement.text, [])
+            except PostgresError:
+                #  database is not migrated yet
+                continue
+        self.prepared = True
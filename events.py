@@ -0,0 +1,113 @@
+from asyncpg import Connection, connect
+from typing import Awaitable, Callable, Optional
+from uuid import uuid4
+
+import asyncio
+import json
+import logging
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class Subscriber:
+    """Events of one websocket connection, queue is bounded by hub"""
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        #  None is put when subscriber is dropped
+        self.queue: asyncio.Queue[Optional[str]] = asyncio.Queue()
+        self.dropped = False
+
+
+class EventHub:
+    """
+    Fanout of events between workers. Messages are published by NOTIFY and received
+    by every worker on its own listening connection, then handled by on_message which
+    delivers events to websockets of this worker. Subscriber which doesn't read
+    queue_size events is dropped, so slow client never holds memory or the loop
+    """
+    def __init__(self, channel: str, queue_size: int, reconnect_delay: float):
+        self.channel = channel
+        self.queue_size = queue_size
+        self.reconnect_delay = reconnect_delay
+        #  messages published by this worker are marked to skip their local side effects
+        self.worker_id = uuid4().hex
+        self._subscribers: dict[str, set[Subscriber]] = {}
+
+    def connections(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def users(self) -> list[str]:
+        """Users connected to this worker"""
+        return list(self._subscribers)
+
+    def subscribe(self, user_id: str) -> Subscriber:
+        subscriber = Subscriber(user_id)
+        self._subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        subscribers = self._subscribers.get(subscriber.user_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._subscribers[subscriber.user_id]
+
+    def deliver(self, user_id: str, event: dict):
+        """Queue event to all connections of user in this worker"""
+        subscribers = self._subscribers.get(user_id)
+        if not subscribers:
+            return
+        text = json.dumps(event)
+        for subscriber in list(subscribers):
+            if subscriber.queue.qsize() >= self.queue_size:
+                self.drop(subscriber)
+            else:
+                subscriber.queue.put_nowait(text)
+
+    def drop(self, subscriber: Subscriber):
+        subscriber.dropped = True
+        self.unsubscribe(subscriber)
+        subscriber.queue.put_nowait(None)
+        metrics.events_dropped.inc()
+
+    def message(self, **fields) -> str:
+        return json.dumps({"origin": self.worker_id, **fields}, separators=(",", ":"))
+
+    async def listen(
+        self, destination: str, on_message: Callable[[dict], None], on_connect: Callable[[], Awaitable]
+    ):
+        """
+        Keep listening connection. on_connect is called after every connect, the first one
+        included, once listener is added, so state it loads misses no messages
+        """
+        while True:
+            conn: Optional[Connection] = None
+            try:
+                conn = await connect(destination)
+                closed = asyncio.get_running_loop().create_future()
+                conn.add_termination_listener(lambda _: closed.done() or closed.set_result(None))
+                await conn.add_listener(
+                    self.channel, lambda _conn, _pid, _channel, payload: self._received(payload, on_message)
+                )
+                await on_connect()
+                await closed
+                logger.warning("Events connection is lost, reconnecting")
+            except asyncio.CancelledError:
+                if conn is not None:
+                    await conn.close()
+                raise
+            except Exception:
+                logger.exception("Events connection failed")
+                if conn is not None:
+                    conn.terminate()
+            await asyncio.sleep(self.reconnect_delay)
+
+    @staticmethod
+    def _received(payload: str, on_message: Callable[[dict], None]):
+        try:
+            on_message(json.loads(payload))
+        except Exception:
+            logger.exception("Handling of event %s failed", payload)
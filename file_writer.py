@@ -0,0 +1,157 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Optional
+from uuid import uuid4
+
+import asyncio
+import logging
+import metrics
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+def sync_directory(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def changed_directories(directory: str) -> set[str]:
+    """Directories which get new entries when directory is created with missing parents"""
+    changed = set()
+    while directory and not os.path.isdir(directory):
+        changed.add(os.path.dirname(directory) or ".")
+        directory = os.path.dirname(directory)
+    return changed
+
+
+def write_file(path: str, data: bytes, fsync: bool):
+    """Write to temporary file in the same directory and rename it, so readers never see partial file"""
+    temp_path = os.path.join(os.path.dirname(path), f".{uuid4()}.tmp")
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_files(files: list[tuple[str, bytes]], fsync: bool) -> list[Optional[OSError]]:
+    """
+    Runs in writer thread. Write files which don't exist yet, with fsync directories
+    are synced once for the whole batch. Return error of every file or None
+    """
+    errors: list[Optional[OSError]] = []
+    directories: dict[str, list[int]] = {}
+    for number, (path, data) in enumerate(files):
+        try:
+            if os.path.exists(path):
+                errors.append(None)
+                continue
+            directory = os.path.dirname(path)
+            for changed in changed_directories(directory):
+                directories.setdefault(changed, [])
+            os.makedirs(directory, exist_ok=True)
+            write_file(path, data, fsync)
+            directories.setdefault(directory, []).append(number)
+            errors.append(None)
+        except OSError as exc:
+            errors.append(exc)
+
+    if fsync:
+        #  children first, so the whole new path is synced bottom up
+        for directory in sorted(directories, key=len, reverse=True):
+            try:
+                sync_directory(directory)
+            except OSError as exc:
+                for number in directories[directory]:
+                    errors[number] = exc
+    return errors
+
+
+class FileWriter:
+    """
+    Bounded queue of files written by fixed number of threads. Worker takes queued
+    files up to batch_size and writes them in one call in thread, so small files
+    don't cost a thread hop each. With fsync write is done after file and its
+    directory are on disk, otherwise after rename
+    """
+    def __init__(self, workers: int, queue_size: int, batch_size: int, fsync: bool):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self._queue: Optional[asyncio.Queue] = None
+        self._queue_size = queue_size
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="file-writer")
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        """Wait until queued files are written, but not longer than timeout"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("%s files left unwritten", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def write(self, path: str, data: bytes):
+        """
+        Queue file and wait until it is written, existing file is kept. Error of write is raised.
+        Cancelled caller still waits for queued file, so it can remove the file after
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((path, data, future, perf_counter()))
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                errors = await loop.run_in_executor(
+                    self._executor, write_files, [(path, data) for path, data, _, _ in batch], self.fsync
+                )
+            except Exception as exc:
+                errors = [exc] * len(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            written = perf_counter()
+            for (path, _, future, queued_at), error in zip(batch, errors):
+                metrics.file_write_seconds.observe(written - queued_at, "error" if error else "ok")
+                if error is not None:
+                    logger.error("Writing of %s failed: %s", path, error)
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
@@ -0,0 +1,116 @@
+from heapq import heappush, heappushpop
+from itertools import chain
+from math import asin, ceil, cos, floor, radians, sin, sqrt
+from typing import Callable, Hashable, Iterable, Optional
+
+
+EARTH_RADIUS_KM = 6371.0
+DEGREE_KM = 111.32
+
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance by haversine formula"""
+    lat1, lon1, lat2, lon2 = radians(lat1), radians(lon1), radians(lat2), radians(lon2)
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a)))
+
+
+class GeoGrid:
+    """
+    Uniform grid of latitude/longitude cells, every cell keeps set of keys placed in it.
+    Keys may be split to partitions, queries look only at given partitions.
+    Moving a key is O(1), queries visit rings of cells around the point
+    until nothing closer can be found
+    """
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.rows = ceil(180 / cell_size)
+        self.columns = ceil(360 / cell_size)
+        self._cells: dict[tuple[Hashable, int], set[int]] = {}
+        self._points: dict[int, tuple[float, float, tuple[Hashable, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def _row_column(self, latitude: float, longitude: float) -> tuple[int, int]:
+        row = min(floor((latitude + 90) / self.cell_size), self.rows - 1)
+        column = floor((longitude + 180) / self.cell_size) % self.columns
+        return row, column
+
+    def cell_id(self, latitude: float, longitude: float) -> int:
+        """Number of cell, the same number is stored in profiles.geo_cell"""
+        row, column = self._row_column(latitude, longitude)
+        return row * self.columns + column
+
+    def get(self, key: int) -> Optional[tuple[float, float]]:
+        point = self._points.get(key)
+        if point is None:
+            return None
+        return point[0], point[1]
+
+    def move(self, key: int, latitude: float, longitude: float, partition: Hashable = None):
+        """Place key to the point, key is removed from its previous cell"""
+        cell = (partition, self.cell_id(latitude, longitude))
+        previous = self._points.get(key)
+        if previous is not None and previous[2] != cell:
+            self._discard(key, previous[2])
+        self._cells.setdefault(cell, set()).add(key)
+        self._points[key] = (latitude, longitude, cell)
+
+    def remove(self, key: int):
+        previous = self._points.pop(key, None)
+        if previous is not None:
+            self._discard(key, previous[2])
+
+    def _discard(self, key: int, cell: tuple[Hashable, int]):
+        keys = self._cells[cell]
+        keys.discard(key)
+        if not keys:
+            del self._cells[cell]
+
+    def _ring(self, row: int, column: int, ring: int, column_ratio: float) -> list[int]:
+        """Cells on the border of rectangle ring cells high and ring * column_ratio cells wide"""
+        columns_span = min(ceil(ring * column_ratio), self.columns // 2)
+        previous_span = min(ceil((ring - 1) * column_ratio), self.columns // 2) if ring else -1
+        cells = []
+        for ring_row in range(max(row - ring, 0), min(row + ring, self.rows - 1) + 1):
+            if abs(ring_row - row) == ring:
+                offsets = range(-columns_span, columns_span + 1)
+            else:
+                offsets = [*range(-columns_span, -previous_span), *range(previous_span + 1, columns_span + 1)]
+            cells.extend(ring_row * self.columns + (column + offset) % self.columns for offset in offsets)
+        #  columns wrap around near the poles, do not visit cells twice
+        return list(dict.fromkeys(cells))
+
+    def nearest(
+        self, latitude: float, longitude: float, count: int, radius_km: float,
+        accept: Callable[[int], bool] = lambda key: True, partitions: Iterable[Hashable] = (None,)
+    ) -> list[tuple[float, int]]:
+        """Return up to count accepted keys within radius as (distance, key) sorted by distance"""
+        row, column = self._row_column(latitude, longitude)
+        cell_km = self.cell_size * DEGREE_KM
+        #  cells get narrower to the poles, take the narrowest within radius
+        polar_latitude = min(abs(latitude) + radius_km / DEGREE_KM, 89.0)
+        column_ratio = 1 / cos(radians(polar_latitude))
+        max_ring = ceil(radius_km / cell_km)
+        partitions = tuple(partitions)
+
+        found: list[tuple[float, int]] = []
+        for ring in range(max_ring + 1):
+            for cell in self._ring(row, column, ring, column_ratio):
+                for key in chain.from_iterable(self._cells.get((partition, cell), ()) for partition in partitions):
+                    if not accept(key):
+                        continue
+                    point = self._points[key]
+                    distance = distance_km(latitude, longitude, point[0], point[1])
+                    if distance > radius_km:
+                        continue
+                    if len(found) < count:
+                        heappush(found, (-distance, key))
+                    elif -found[0][0] > distance:
+                        heappushpop(found, (-distance, key))
+            #  everything outside of this ring is further than ring * cell_km
+            if len(found) >= count and -found[0][0] <= ring * cell_km:
+                break
+
+        return sorted((-distance, key) for distance, key in found)
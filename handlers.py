@@ -1,122 +1,638 @@
 from asyncpg import Pool
-from config import STATIC_FILES, DOMAIN_NAME
+from asyncpg.exceptions import PostgresError
+from batching import WriteBatcher
+from cache import TTLCache
+from config import (
+    STATIC_FILES, DOMAIN_NAME, SESSION_CACHE_SIZE, SESSION_CACHE_TTL,
+    SEARCH_INDEX_REFRESH, GEO_CELL_SIZE, MAX_PHOTO_SIZE, MAX_UPLOAD_PHOTOS,
+    PHOTO_QUALITY, THUMBNAIL_SIZES, PHOTO_WORKERS, PHOTO_QUEUE_SIZE,
+    BLOB_SWEEP_INTERVAL, BLOB_SWEEP_BATCH, STATIC_CACHE_SIZE, STATIC_CACHE_TTL,
+    WRITE_BATCH_SIZE, WRITE_BATCH_DELAY, TOKEN_KEYS, SIGNED_TOKENS, TOKEN_TTL,
+    REVOKED_TOKENS_SYNC_INTERVAL, SESSION_TTL, SESSION_REAP_INTERVAL, SESSION_REAP_BATCH, SESSION_REAP_PAUSE,
+    RATING_JOURNAL_DIR, RATING_FLUSH_INTERVAL, RATING_JOURNAL_FSYNC, RATING_JOURNALS_KEEP_DAYS,
+    DB_DESTINATION, EVENTS_CHANNEL, EVENTS_QUEUE_SIZE, EVENTS_SEND_TIMEOUT, EVENTS_RECONNECT_DELAY,
+    GEO_SEARCH_RADIUS, NICKNAME_FILTER_CAPACITY, NICKNAME_FILTER_ERROR_RATE, NICKNAME_CHECK_LIMIT,
+    FILE_WRITERS, FILE_WRITE_QUEUE_SIZE, FILE_WRITE_BATCH, FILE_WRITE_FSYNC
+)
+from contextvars import Context
 from database import queries
-from datetime import datetime, date
-from fastapi import BackgroundTasks
-from uuid import uuid4
-
-import aiofiles
+from datetime import datetime, date, timedelta
+from events import EventHub, Subscriber
+from fastapi import Request, WebSocket
+from file_writer import FileWriter
+from geo import distance_km
+from functools import partial
+from images import PhotoProcessor, ProcessedPhoto, variant_path
+from nicknames import MIN_LENGTH, MAX_LENGTH, NicknameFilter, variants
+from ratings import RatingAggregator
+from search import IndexedProfile, ProfileIndex, get_age
+from static_files import StaticPhotos, etag_matches
+from tokens import RevokedTokens, TokenSigner, is_signed
+from typing import Callable, Optional
+from uploads import PART_OVERHEAD, PhotoParser
+from uuid import UUID, uuid4
+
+import asyncio
+import hashlib
+import logging
 import models
 import my_exceptions
+import os
 import string
 import secrets
 
 
+logger = logging.getLogger(__name__)
+
+#  nicknames in one event, so it fits 8000 bytes of NOTIFY payload
+NICKNAMES_PER_EVENT = 30
+
+#  verified sessions, (user_id, device_id) -> token
+session_cache = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+#  signed tokens are checked without database, logged out ones are synced from revoked_tokens
+token_signer = TokenSigner(keys=TOKEN_KEYS, ttl=min(TOKEN_TTL, SESSION_TTL)) if TOKEN_KEYS else None
+revoked_tokens = RevokedTokens()
+#  active profiles for opponent search, rebuilt from database on startup
+profile_index = ProfileIndex(cell_size=GEO_CELL_SIZE)
+#  changes of index made while new ones are loaded, replayed on them before they replace the current one
+index_changes: list[list[Callable[[ProfileIndex], None]]] = []
+#  re-encoding and thumbnails of uploaded photos, started on startup
+photo_processor = PhotoProcessor(
+    workers=PHOTO_WORKERS, queue_size=PHOTO_QUEUE_SIZE,
+    quality=PHOTO_QUALITY, sizes=THUMBNAIL_SIZES
+)
+#  uploaded photos written to static directory in batches
+file_writer = FileWriter(
+    workers=FILE_WRITERS, queue_size=FILE_WRITE_QUEUE_SIZE, batch_size=FILE_WRITE_BATCH, fsync=FILE_WRITE_FSYNC
+)
+#  opened photo files served from static directory
+static_photos = StaticPhotos(directory=STATIC_FILES, cache_size=STATIC_CACHE_SIZE, cache_ttl=STATIC_CACHE_TTL)
+#  rates summed in memory and journaled until they are written to user_rating
+rating_aggregator = RatingAggregator(
+    directory=RATING_JOURNAL_DIR, flush_interval=RATING_FLUSH_INTERVAL, fsync=RATING_JOURNAL_FSYNC
+)
+#  profile events of all workers, pushed to websockets of this worker
+events_hub = EventHub(channel=EVENTS_CHANNEL, queue_size=EVENTS_QUEUE_SIZE, reconnect_delay=EVENTS_RECONNECT_DELAY)
+#  taken nicknames, loaded on startup and updated by registrations of all workers
+nickname_filter = NicknameFilter(capacity=NICKNAME_FILTER_CAPACITY, error_rate=NICKNAME_FILTER_ERROR_RATE)
+#  filter which is being loaded also gets nicknames taken meanwhile
+loading_nicknames: Optional[NicknameFilter] = None
+nicknames_reload: Optional[asyncio.Task] = None
+
+
+async def write_users(db_pool: Pool, users: list[tuple]) -> list[bool]:
+    created = await queries.create_users(db_pool=db_pool, users=users)
+    nicknames = [user[1] for user in users if user[0] in created]
+    if nicknames:
+        remember_nicknames(nicknames)
+        await publish_nicknames(db_pool=db_pool, nicknames=nicknames)
+    return [user[0] in created for user in users]
+
+
+async def write_sessions(db_pool: Pool, sessions: list[tuple]) -> list:
+    tokens = await queries.create_sessions(db_pool=db_pool, sessions=sessions, valid_since=sessions_valid_since())
+    return [tokens.get(session[0], my_exceptions.AuthError()) for session in sessions]
+
+
+def sessions_valid_since() -> datetime:
+    return datetime.now() - timedelta(seconds=SESSION_TTL)
+
+
+#  registrations and new sessions of concurrent requests are written together
+user_writer = WriteBatcher(flush=write_users, max_batch=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY)
+session_writer = WriteBatcher(flush=write_sessions, max_batch=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY)
+
+
 def generate_string(length):
     letters_and_digits = string.ascii_letters + string.digits
     return ''.join(secrets.choice(
         letters_and_digits) for _ in range(length))
 
 
-def gen_files_uuid(files: list[bytes]) -> tuple[tuple[str, bytes]]:
-    names = []
-    for file in files:
-        names.append((str(uuid4()), file))
+def blob_name(blob_hash: str) -> str:
+    """Blobs are sharded by first bytes of hash: ab/cd/abcd...ef.jpg"""
+    return f"{blob_hash[:2]}/{blob_hash[2:4]}/{blob_hash}.jpg"
 
-    return tuple(names)
 
-
-def gen_client_photos_name(files: tuple[tuple[str, bytes]]) -> list[str]:
-    names = []
-    for file in files:
-        name = f"{DOMAIN_NAME}/{STATIC_FILES}/{file[0]}.jpg"
-        names.append(name)
-    return names
+def gen_client_photos_name(hashes: list[str]) -> list[str]:
+    return [f"{DOMAIN_NAME}/{STATIC_FILES}/{blob_name(blob_hash)}" for blob_hash in hashes]
 
 
-def pack_photo_to_upload(files: tuple[tuple[str, bytes]], subject_id: str) -> tuple[tuple[str, str]]:
+def pack_photo_to_upload(photo_ids: list[str], hashes: list[str], subject_id: str) -> tuple[tuple[str, str, str]]:
     packed = []
-    for file in files:
-        packed.append((file[0], subject_id))
+    for photo_id, blob_hash in zip(photo_ids, hashes):
+        packed.append((photo_id, subject_id, blob_hash))
 
     return tuple(packed)
 
 
-async def write_files(files: tuple[tuple[str, bytes]], file_extension: str):
-    for file in files:
-        async with aiofiles.open(f"{STATIC_FILES}/{file[0]}{file_extension}", "wb") as f:
-            await f.write(file[1])
+def remove_files(paths: list[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_blobs(hashes: list[str]):
+    names = []
+    for blob_hash in hashes:
+        name = blob_name(blob_hash)
+        names.append(name)
+        names.extend(variant_path(name, size) for size in THUMBNAIL_SIZES)
+    for name in names:
+        static_photos.forget(name)
+    remove_files([f"{STATIC_FILES}/{name}" for name in names])
+
+
+async def read_photos(request: Request) -> list[tuple[bytes, str]]:
+    """
+    Parse photos from multipart body as it is received. Body which can't be
+    MAX_UPLOAD_PHOTOS photos is rejected by Content-Length before it is read,
+    wrong or too large photo stops reading at its first wrong byte.
+    Return content and hash of every photo
+    """
+    max_body = MAX_UPLOAD_PHOTOS * (MAX_PHOTO_SIZE + PART_OVERHEAD)
+    try:
+        length = int(request.headers.get("content-length", 0))
+    except ValueError:
+        raise my_exceptions.WrongPhoto("Wrong Content-Length")
+    if length > max_body:
+        raise my_exceptions.PhotoTooLarge(f"Photos must be smaller than {MAX_PHOTO_SIZE} bytes each")
+
+    parser = PhotoParser(
+        request.headers.get("content-type", ""), field="photos",
+        max_photos=MAX_UPLOAD_PHOTOS, max_size=MAX_PHOTO_SIZE
+    )
+    received = 0
+    #  chunked body has no Content-Length, so its size is counted as well
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_body:
+            raise my_exceptions.PhotoTooLarge(f"Photos must be smaller than {MAX_PHOTO_SIZE} bytes each")
+        parser.feed(chunk)
+    return parser.finish()
 
 
 async def authorization(db_pool: Pool, user: models.AskForAuthUser) -> str:
     session_id = str(uuid4())
     start_time = datetime.now()
-    token = generate_string(64)
-
-    token = await queries.create_or_get_session(
-        db_pool=db_pool, session_id=session_id, user_id=user.user_id,
-        device_id=user.device_id, start_time=start_time, token=token,
-        hashed_password=user.hashed_password
-    )
+    if SIGNED_TOKENS:
+        new_token = token_signer.issue(user_id=user.user_id, device_id=user.device_id)
+    else:
+        new_token = generate_string(64)
+
+    token = await session_writer.submit(db_pool, (
+        session_id, user.user_id, user.device_id, start_time, new_token, user.hashed_password
+    ))
+    if SIGNED_TOKENS and token != new_token and not is_valid_signed(token, user.user_id, user.device_id):
+        #  device has legacy, expired or revoked token
+        await queries.update_session_token(
+            db_pool=db_pool, user_id=user.user_id, device_id=user.device_id,
+            token=new_token, start_time=start_time
+        )
+        token = new_token
+    if token == new_token:
+        #  new session was issued, drop any cached token of this device
+        session_cache.invalidate((user.user_id, user.device_id))
 
     return ".".join([token, user.user_id, user.device_id])
 
 
 async def registration(db_pool: Pool, user: models.RegUser) -> str:
-    if not await queries.is_nickname_free(db_pool=db_pool, nickname=user.nickname):
-        raise my_exceptions.UserExists("User with the same nickname is already registered")
-
     user_id = str(uuid4())
     rating_id = str(uuid4())
     reg_time = datetime.now()
     born_date = date.fromtimestamp(user.born_date)
 
-    await queries.create_user(
-        db_pool=db_pool, user_id=user_id, nickname=user.nickname,
-        first_name=user.first_name, reg_time=reg_time, born_date=born_date,
-        gender=user.gender, hashed_password=user.hashed_password, rating_uuid=rating_id
-    )
+    #  nickname is checked by the insert itself
+    if not await user_writer.submit(db_pool, (
+        user_id, user.nickname, user.first_name, reg_time,
+        born_date, user.gender.value, user.hashed_password, rating_id
+    )):
+        raise my_exceptions.UserExists("User with the same nickname is already registered")
 
     return user_id
 
 
+def remember_nicknames(nicknames: list[str]):
+    for nickname in nicknames:
+        nickname_filter.add(nickname)
+        if loading_nicknames is not None:
+            loading_nicknames.add(nickname)
+
+
+async def load_nicknames(db_pool: Pool):
+    """Build filter of all taken nicknames with room for as many new users"""
+    global nickname_filter, loading_nicknames
+    count = await queries.count_users(db_pool=db_pool)
+    taken = NicknameFilter(capacity=max(NICKNAME_FILTER_CAPACITY, count * 2), error_rate=NICKNAME_FILTER_ERROR_RATE)
+    loading_nicknames = taken
+    try:
+        await queries.select_nicknames(db_pool=db_pool, callback=taken.add)
+    finally:
+        loading_nicknames = None
+    nickname_filter = taken
+
+
+async def reload_nicknames(db_pool: Pool):
+    try:
+        await load_nicknames(db_pool=db_pool)
+    except (PostgresError, OSError):
+        logger.exception("Nicknames filter is not reloaded")
+
+
+def reload_full_nicknames(db_pool: Pool):
+    """Rebuild filter in background when it has more nicknames than it is sized for"""
+    global nicknames_reload
+    if nickname_filter.full() and (nicknames_reload is None or nicknames_reload.done()):
+        #  reload runs in empty context, not on connection of request scope which started it
+        nicknames_reload = Context().run(asyncio.create_task, reload_nicknames(db_pool=db_pool))
+
+
+async def publish_nicknames(db_pool: Pool, nicknames: list[str]):
+    """Send nicknames taken on this worker to filters of other workers"""
+    for start in range(0, len(nicknames), NICKNAMES_PER_EVENT):
+        payload = events_hub.message(nicknames=nicknames[start:start + NICKNAMES_PER_EVENT])
+        try:
+            await queries.notify(db_pool=db_pool, channel=EVENTS_CHANNEL, payload=payload)
+        except PostgresError:
+            logger.exception("Event of taken nicknames is not published")
+
+
+async def check_nicknames(db_pool: Pool, nicknames: list[str], suggestions: int) -> list[dict]:
+    """
+    Tell which nicknames are free and suggest free variants of taken ones. Nicknames
+    not in filter are free, the rest and variants are checked in database by one query
+    """
+    if len(nicknames) > NICKNAME_CHECK_LIMIT:
+        raise my_exceptions.WrongNickname(f"Max count of nicknames {NICKNAME_CHECK_LIMIT}!")
+    for nickname in nicknames:
+        if not MIN_LENGTH <= len(nickname) <= MAX_LENGTH:
+            raise my_exceptions.WrongNickname(f"Nickname length must be from {MIN_LENGTH} to {MAX_LENGTH}")
+    reload_full_nicknames(db_pool=db_pool)
+
+    #  twice more variants than needed, some of them may be taken too
+    candidates = {
+        nickname: variants(nickname, suggestions * 2) for nickname in nicknames if nickname in nickname_filter
+    }
+    possible = [
+        candidate.lower() for nickname, nickname_variants in candidates.items()
+        for candidate in (nickname, *nickname_variants) if candidate in nickname_filter
+    ]
+    taken = await queries.select_taken_nicknames(db_pool=db_pool, nicknames=possible) if possible else set()
+
+    checked = []
+    for nickname in nicknames:
+        if nickname.lower() not in taken:
+            checked.append({"nickname": nickname, "free": True})
+            continue
+        free_variants = [variant for variant in candidates[nickname] if variant.lower() not in taken]
+        checked.append({"nickname": nickname, "free": False, "suggestions": free_variants[:suggestions]})
+    return checked
+
+
+def is_valid_signed(token: str, user_id: str, device_id: str) -> bool:
+    if token_signer is None:
+        return False
+    signed = token_signer.verify(token, user_id, device_id)
+    return signed is not None and signed.token_id not in revoked_tokens
+
+
 async def check_auth(db_pool: Pool, user_id: str, device_id: str, token: str):
+    if is_signed(token):
+        if not is_valid_signed(token, user_id, device_id):
+            raise my_exceptions.AuthError
+        return
+
+    key = (user_id, device_id)
+    if session_cache.get(key) == token:
+        return
 
-    if not await queries.his_authorized(
+    start_time = await queries.session_start_time(
         db_pool=db_pool, user_id=user_id,
-        device_id=device_id, token=token
-    ):
+        device_id=device_id, token=token, valid_since=sessions_valid_since()
+    )
+    if start_time is None and queries.has_replicas(db_pool):
+        #  session could be created right now and not replicated yet
+        start_time = await queries.session_start_time(
+            db_pool=db_pool, user_id=user_id,
+            device_id=device_id, token=token, valid_since=sessions_valid_since(), primary=True
+        )
+    if start_time is None:
         raise my_exceptions.AuthError
+    #  cached token must not outlive its session
+    expires_in = (start_time + timedelta(seconds=SESSION_TTL) - datetime.now()).total_seconds()
+    session_cache.set(key, token, ttl=min(SESSION_CACHE_TTL, expires_in))
+
+
+async def logout(db_pool: Pool, user_id: str, device_id: str, token: str):
+    """Delete device session, its token stops working in all workers"""
+    revoked = None
+    signed = token_signer.verify(token, user_id, device_id) if token_signer and is_signed(token) else None
+    if signed is not None:
+        revoked = (signed.token_id, signed.expires_at)
+    await queries.delete_session(db_pool=db_pool, user_id=user_id, device_id=device_id, revoked=revoked)
+    if signed is not None:
+        revoked_tokens.add(signed.token_id, signed.expires_at)
+    session_cache.invalidate((user_id, device_id))
+    #  other workers drop cached session and revoked token at once, not after cache ttl or sync
+    payload = events_hub.message(logout=[user_id, device_id], revoked=revoked)
+    try:
+        await queries.notify(db_pool=db_pool, channel=EVENTS_CHANNEL, payload=payload)
+    except PostgresError:
+        logger.exception("Event of logout is not published")
+
+
+async def sync_revoked_tokens(db_pool: Pool):
+    """Periodically load tokens revoked by other workers"""
+    since = datetime(1970, 1, 1)
+    while True:
+        try:
+            for record in await queries.select_revoked_tokens(db_pool=db_pool, since=since):
+                revoked_tokens.add(record["token_id"], record["expires_at"])
+                since = max(since, record["revoked_at"])
+        except (PostgresError, OSError):
+            logger.exception("Revoked tokens are not synced")
+        revoked_tokens.prune()
+        await asyncio.sleep(REVOKED_TOKENS_SYNC_INTERVAL)
 
 
 async def upload_photos(
     db_pool: Pool,
     subject_id: str, photo_type: str,
-    background_tasks: BackgroundTasks,
-    photos: list[bytes]
-) -> list[str]:
-
-    if len(photos) > 5:
-        raise my_exceptions.TooManyPhotos("You cannot upload more than 5 photos!")
-
-    files = gen_files_uuid(files=photos)
-    photos_to_upload = pack_photo_to_upload(files=files, subject_id=subject_id)
-
+    request: Request
+) -> tuple[list[str], list[str]]:
+    """
+    Photos are parsed from body to memory and hashed there. Uploads processed before
+    are found by that hash, others are processed in memory, so only photos without
+    metadata are ever stored to static directory, by hash of processed content.
+    Files of new blobs are written before photos are committed, so no photo points
+    to missing file. Return ids and urls of uploaded photos
+    """
+    #  connection taken by authentication is not held while body is received and photos are processed
+    await queries.release_request_connection()
+    photos = await read_photos(request=request)
+    if not photo_processor.reserve(len(photos)):
+        raise my_exceptions.ServerBusy("Too many photos are processing now, try again later")
+    try:
+        return await store_photos(db_pool=db_pool, subject_id=subject_id, photo_type=photo_type, photos=photos)
+    finally:
+        photo_processor.release(len(photos))
+
+
+async def store_photos(
+    db_pool: Pool, subject_id: str, photo_type: str, photos: list[tuple[bytes, str]]
+) -> tuple[list[str], list[str]]:
+    uploads = {source: data for data, source in photos}
+    #  hash of upload -> hash of its blob, from primary, so blobs of the last uploads are found
+    sources = await queries.select_photo_sources(db_pool=db_pool, hashes=list(uploads), primary=True)
+    await queries.release_request_connection()
+    new_sources = [source for source in uploads if source not in sources]
+    processed: dict[str, ProcessedPhoto] = {}
+    for source, photo in zip(
+        new_sources, await asyncio.gather(*(photo_processor.process(uploads[source]) for source in new_sources))
+    ):
+        sources[source] = photo.hash
+        processed[photo.hash] = photo
+
+    async def store(new_blobs: set[str]) -> dict[str, list[int]]:
+        #  blob of known upload was collected after it was found
+        for source, blob_hash in sources.items():
+            if blob_hash in new_blobs and blob_hash not in processed:
+                photo = await photo_processor.process(uploads[source])
+                if photo.hash != blob_hash:
+                    raise my_exceptions.PhotoNotSaved("Photos are not saved, try again later")
+                processed[blob_hash] = photo
+
+        results = await asyncio.gather(
+            *(file_writer.write(f"{STATIC_FILES}/{name}", data) for name, data in blob_files(processed, new_blobs)),
+            return_exceptions=True
+        )
+        if any(isinstance(result, Exception) for result in results):
+            raise my_exceptions.PhotoNotSaved("Photos are not saved, try again later")
+        return {blob_hash: sorted(processed[blob_hash].thumbnails) for blob_hash in new_blobs}
+
+    hashes = [sources[source] for _, source in photos]
+    photo_ids = [str(uuid4()) for _ in hashes]
     await queries.add_photo(
-        db_pool=db_pool, photos=photos_to_upload,
+        db_pool=db_pool, photos=pack_photo_to_upload(photo_ids=photo_ids, hashes=hashes, subject_id=subject_id),
         photo_type=photo_type,
-        subject_id=subject_id
+        subject_id=subject_id,
+        sources={source: sources[source] for source in new_sources},
+        store=store,
+        discard=remove_blobs
     )
+    return photo_ids, gen_client_photos_name(hashes=hashes)
+
+
+def blob_files(processed: dict[str, ProcessedPhoto], hashes: set[str]) -> list[tuple[str, bytes]]:
+    """Names and contents of processed photos of blobs and their thumbnails"""
+    files = []
+    for blob_hash in sorted(hashes):
+        photo = processed[blob_hash]
+        name = blob_name(blob_hash)
+        files.append((name, photo.data))
+        files.extend((variant_path(name, size), data) for size, data in photo.thumbnails.items())
+    return files
+
+
+def start_photo_processing():
+    file_writer.start()
+    photo_processor.start()
+
+
+async def delete_photo(db_pool: Pool, user_id: str, photo_id: str, photo_type: str):
+    if not await queries.delete_photo(db_pool=db_pool, photo_id=photo_id, photo_type=photo_type, user_id=user_id):
+        raise my_exceptions.PhotoNotFound("Photo not found")
+
+
+async def collect_photo_blobs(db_pool: Pool):
+    """Periodically remove files of blobs which are not referenced by any photo"""
+    while True:
+        await asyncio.sleep(BLOB_SWEEP_INTERVAL)
+        try:
+            while await queries.delete_orphan_blobs(
+                db_pool=db_pool, limit=BLOB_SWEEP_BATCH, remove_blobs=remove_blobs
+            ):
+                pass
+        except (PostgresError, OSError):
+            logger.exception("Orphan photo blobs are not collected")
+
+
+async def reap_sessions(db_pool: Pool):
+    """Periodically delete expired sessions in small batches with pauses between them"""
+    while True:
+        await asyncio.sleep(SESSION_REAP_INTERVAL)
+        try:
+            while await queries.delete_expired_sessions(
+                db_pool=db_pool, started_before=sessions_valid_since(), limit=SESSION_REAP_BATCH
+            ) == SESSION_REAP_BATCH:
+                await asyncio.sleep(SESSION_REAP_PAUSE)
+        except (PostgresError, OSError):
+            logger.exception("Expired sessions are not deleted")
+
+
+def parse_uuid(value: str) -> Optional[str]:
+    """Canonical form of id, None if it isn't uuid"""
+    try:
+        return str(UUID(value))
+    except ValueError:
+        return None
+
+
+async def write_ratings(db_pool: Pool, journal_id: str, deltas: dict[str, tuple[int, int]]):
+    await queries.apply_ratings(
+        db_pool=db_pool, journal_id=journal_id, deltas=deltas, keep_days=RATING_JOURNALS_KEEP_DAYS
+    )
+
 
-    background_tasks.add_task(write_files, files=files, file_extension=".jpg")
+async def start_ratings(db_pool: Pool):
+    """Replay journals left by stopped workers"""
+    await rating_aggregator.start(apply=partial(write_ratings, db_pool))
+
+
+async def flush_ratings(db_pool: Pool):
+    await rating_aggregator.run(apply=partial(write_ratings, db_pool))
+
+
+async def stop_ratings(db_pool: Pool):
+    await rating_aggregator.stop(apply=partial(write_ratings, db_pool))
+
+
+async def rate_user(user_id: str, rating: models.NewRating):
+    """Rate is acknowledged after it is journaled, user_rating is updated by the next flush"""
+    rated_id = parse_uuid(rating.user_id)
+    if rated_id is None:
+        raise my_exceptions.WrongRating("Wrong user_id")
+    if rated_id == parse_uuid(user_id):
+        raise my_exceptions.WrongRating("You cannot rate yourself")
+    await rating_aggregator.add(user_id=rated_id, rate=rating.rate)
+
+
+async def get_rating(db_pool: Pool, user_id: str) -> dict:
+    """Rating written to database with rates of this worker which are not written yet"""
+    user_id = parse_uuid(user_id)
+    record = await queries.select_rating(db_pool=db_pool, user_id=user_id) if user_id else None
+    if record is None and user_id and queries.has_replicas(db_pool):
+        #  user could be registered right now and not replicated yet
+        record = await queries.select_rating(db_pool=db_pool, user_id=user_id, primary=True)
+    if record is None:
+        raise my_exceptions.UserNotFound("User not found")
+
+    pending_total, pending_count = rating_aggregator.pending(user_id)
+    total = record["rate"] + pending_total
+    count = record["rate_count"] + pending_count
+    return {"user_id": user_id, "rating": round(total / count, 2) if count else None, "rate_count": count}
+
+
+def page_etag(*pages: list) -> str:
+    """Strong etag of page by ids and versions of its rows"""
+    digest = hashlib.blake2b(digest_size=16)
+    for records in pages:
+        for record in records:
+            digest.update("|".join(str(value) for value in record).encode())
+            digest.update(b"\n")
+        digest.update(b"\x00")
+    return f'"{digest.hexdigest()}"'
+
+
+def pack_photo(record) -> dict:
+    if record["blob_hash"] is None:
+        #  photo uploaded before blobs, stored by its id without thumbnails
+        return {"photo_id": record["photo_id"], "url": f"{DOMAIN_NAME}/{STATIC_FILES}/{record['photo_id']}.jpg"}
+
+    name = blob_name(record["blob_hash"])
+    return {
+        "photo_id": record["photo_id"],
+        "url": f"{DOMAIN_NAME}/{STATIC_FILES}/{name}",
+        "thumbnails": {
+            str(size): f"{DOMAIN_NAME}/{STATIC_FILES}/{variant_path(name, size)}" for size in record["variants"] or ()
+        }
+    }
+
+
+def parse_page(subject_id: str, cursor: Optional[str]) -> tuple[str, Optional[str]]:
+    subject_id = parse_uuid(subject_id)
+    if subject_id is None:
+        raise my_exceptions.WrongPage("Wrong id")
+    after = None
+    if cursor is not None:
+        after = parse_uuid(cursor)
+        if after is None:
+            raise my_exceptions.WrongPage("Wrong cursor")
+    return subject_id, after
+
+
+async def list_profiles(
+    db_pool: Pool, user_id: str, cursor: Optional[str], limit: int, if_none_match: Optional[str]
+) -> tuple[str, Optional[dict]]:
+    """
+    Page of user's profiles with their photos, fetched by two queries.
+    Return etag and page, page is None if client has it already
+    """
+    user_id, after = parse_page(user_id, cursor)
+    profiles, photos = await queries.select_user_profiles(db_pool=db_pool, user_id=user_id, after=after, limit=limit)
+    etag = page_etag(profiles, photos)
+    if etag_matches(if_none_match, etag):
+        return etag, None
+
+    has_next = len(profiles) > limit
+    profiles = profiles[:limit]
+    profile_photos = {}
+    for photo in photos:
+        profile_photos.setdefault(photo["subject_id"], []).append(pack_photo(photo))
+    page = {
+        "profiles": [
+            {
+                "profile_id": profile["profile_id"],
+                "active": profile["status"],
+                "desired_gender": profile["desired_gender"],
+                "min_age": profile["min_age"],
+                "max_age": profile["max_age"],
+                "profile_type": profile["type"],
+                "vehicle_type": profile["vehicle_type"],
+                "latitude": profile["latitude"],
+                "longitude": profile["longitude"],
+                "photos": profile_photos.get(profile["profile_id"], []),
+            }
+            for profile in profiles
+        ],
+        "next_cursor": profiles[-1]["profile_id"] if has_next else None,
+    }
+    return etag, page
+
+
+async def list_photos(
+    db_pool: Pool, subject_id: str, photo_type: str, cursor: Optional[str], limit: int, if_none_match: Optional[str]
+) -> tuple[str, Optional[dict]]:
+    """Page of photos of user or profile, return etag and page, page is None if client has it already"""
+    subject_id, after = parse_page(subject_id, cursor)
+    photos = await queries.select_photos(
+        db_pool=db_pool, subject_id=subject_id, photo_type=photo_type, after=after, limit=limit
+    )
+    etag = page_etag(photos)
+    if etag_matches(if_none_match, etag):
+        return etag, None
 
-    return gen_client_photos_name(files=files)
+    has_next = len(photos) > limit
+    photos = photos[:limit]
+    return etag, {
+        "photos": [pack_photo(photo) for photo in photos],
+        "next_cursor": photos[-1]["photo_id"] if has_next else None,
+    }
 
 
 async def create_profile(db_pool: Pool, profile: models.NewProfile):
+    if (profile.latitude is None) != (profile.longitude is None):
+        raise my_exceptions.WrongLocation("Both latitude and longitude are required")
+
     profile_id = str(uuid4())
+    geo_cell = None
+    if profile.latitude is not None:
+        geo_cell = profile_index.cell_id(profile.latitude, profile.longitude)
 
-    await queries.create_profile(
+    user = await queries.create_profile(
         db_pool=db_pool,
         profile_id=profile_id,
         user_id=profile.user_id,
@@ -124,5 +640,219 @@ async def create_profile(db_pool: Pool, profile: models.NewProfile):
         min_age=profile.min_age,
         max_age=profile.max_age,
         profile_type=profile.profile_type,
-        vehicle_type=profile.vehicle_type
+        vehicle_type=profile.vehicle_type,
+        latitude=profile.latitude,
+        longitude=profile.longitude,
+        geo_cell=geo_cell
     )
+
+    indexed = IndexedProfile(
+        profile_id=profile_id, user_id=profile.user_id,
+        gender=user["gender"], born_date=user["born_date"],
+        desired_gender=profile.desired_gender.value,
+        min_age=profile.min_age, max_age=profile.max_age,
+        profile_type=profile.profile_type.value, vehicle_type=profile.vehicle_type.value,
+        latitude=profile.latitude, longitude=profile.longitude
+    )
+    change_index(lambda index: index.add(indexed))
+    await publish_profile(db_pool=db_pool, action="created", profile=indexed)
+
+
+async def update_location(db_pool: Pool, user_id: str, location: models.ProfileLocation):
+    if not await queries.update_location(
+        db_pool=db_pool, profile_id=location.profile_id, user_id=user_id,
+        latitude=location.latitude, longitude=location.longitude,
+        geo_cell=profile_index.cell_id(location.latitude, location.longitude)
+    ):
+        raise my_exceptions.ProfileNotFound("Profile not found")
+
+    change_index(lambda index: index.move(location.profile_id, location.latitude, location.longitude))
+    profile = profile_index.get(location.profile_id)
+    if profile is not None:
+        await publish_profile(db_pool=db_pool, action="moved", profile=profile)
+
+
+def change_index(change: Callable[[ProfileIndex], None]):
+    """Apply change to index and to indexes which are being loaded"""
+    change(profile_index)
+    for changes in index_changes:
+        changes.append(change)
+
+
+async def rebuild_profile_index(db_pool: Pool):
+    global profile_index
+    profiles = []
+    changes = []
+
+    def add_profile(record):
+        profiles.append(IndexedProfile(*record))
+
+    index_changes.append(changes)
+    try:
+        await queries.select_active_profiles(db_pool=db_pool, callback=add_profile)
+    finally:
+        index_changes.remove(changes)
+    index = ProfileIndex(cell_size=GEO_CELL_SIZE)
+    index.load(profiles)
+    for change in changes:
+        change(index)
+    profile_index = index
+
+
+async def refresh_profile_index(db_pool: Pool):
+    """Periodically rebuild index to catch profiles created by other workers"""
+    while True:
+        await asyncio.sleep(SEARCH_INDEX_REFRESH)
+        try:
+            await rebuild_profile_index(db_pool=db_pool)
+        except (PostgresError, OSError):
+            logger.exception("Profile index is not refreshed")
+
+
+def pack_opponent(opponent: IndexedProfile, today: date, distance: Optional[float] = None) -> dict:
+    packed = {
+        "profile_id": opponent.profile_id,
+        "user_id": opponent.user_id,
+        "gender": opponent.gender,
+        "age": get_age(opponent.born_date, today),
+        "profile_type": opponent.profile_type,
+        "vehicle_type": opponent.vehicle_type
+    }
+    if distance is not None:
+        packed["distance_km"] = round(distance, 2)
+    return packed
+
+
+async def publish_profile(db_pool: Pool, action: str, profile: IndexedProfile):
+    """Send created or moved profile to all workers, they update their indexes and notify opponents"""
+    payload = events_hub.message(action=action, profile=[*profile[:3], profile.born_date.isoformat(), *profile[4:]])
+    try:
+        await queries.notify(db_pool=db_pool, channel=EVENTS_CHANNEL, payload=payload)
+    except PostgresError:
+        logger.exception("Event of profile %s is not published", profile.profile_id)
+
+
+def on_event(message: dict):
+    if "nicknames" in message:
+        if message["origin"] != events_hub.worker_id:
+            remember_nicknames(message["nicknames"])
+        return
+    if "logout" in message:
+        if message["origin"] != events_hub.worker_id:
+            forget_session(message["logout"], message["revoked"])
+        return
+    on_profile_event(message)
+
+
+def forget_session(device: list[str], revoked: Optional[list]):
+    """Drop session logged out in other worker"""
+    session_cache.invalidate(tuple(device))
+    if revoked is not None:
+        revoked_tokens.add(*revoked)
+
+
+def on_profile_event(message: dict):
+    """Apply profile published by other worker to index, push events to connected owner and opponents"""
+    fields = message["profile"]
+    profile = IndexedProfile(*fields[:3], date.fromisoformat(fields[3]), *fields[4:])
+    action = message["action"]
+    if message["origin"] != events_hub.worker_id:
+        if action == "created":
+            change_index(lambda index: index.add(profile))
+        else:
+            change_index(lambda index: index.move(profile.profile_id, profile.latitude, profile.longitude))
+
+    events_hub.deliver(profile.user_id, {"type": "profile", "action": action, "profile_id": profile.profile_id})
+    #  only profiles of connected users are checked, there are much fewer of them than matching profiles
+    today = date.today()
+    event_type = "match" if action == "created" else "opponent_moved"
+    for user_id in events_hub.users():
+        for opponent in profile_index.user_profiles(user_id):
+            if not profile_index.matches(opponent, profile, today):
+                continue
+            distance = None
+            if opponent.latitude is not None and profile.latitude is not None:
+                distance = distance_km(opponent.latitude, opponent.longitude, profile.latitude, profile.longitude)
+                if distance > GEO_SEARCH_RADIUS:
+                    continue
+            events_hub.deliver(user_id, {
+                "type": event_type, "profile_id": opponent.profile_id,
+                "opponent": pack_opponent(profile, today, distance)
+            })
+
+
+async def rebuild_from_database(db_pool: Pool):
+    """Load state which is kept up to date by events, when some of them could be missed"""
+    #  logouts could be missed too, sessions are checked in database again
+    session_cache.clear()
+    await rebuild_profile_index(db_pool=db_pool)
+    await load_nicknames(db_pool=db_pool)
+
+
+async def listen_events(db_pool: Pool, loaded: asyncio.Future):
+    """
+    Receive events of all workers. Index and nicknames are loaded every time listening
+    starts, so events sent before load or missed while disconnected are in them.
+    loaded is done after the first load
+    """
+    async def on_connect():
+        await rebuild_from_database(db_pool=db_pool)
+        if not loaded.done():
+            loaded.set_result(None)
+
+    await events_hub.listen(destination=DB_DESTINATION, on_message=on_event, on_connect=on_connect)
+
+
+async def receive_until_disconnect(websocket: WebSocket, subscriber: Subscriber):
+    try:
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    finally:
+        events_hub.unsubscribe(subscriber)
+        subscriber.queue.put_nowait(None)
+
+
+async def stream_events(websocket: WebSocket, user_id: str, subprotocol: Optional[str] = None):
+    """Push events of user to websocket until client disconnects or is dropped for not reading them"""
+    await websocket.accept(subprotocol=subprotocol)
+    subscriber = events_hub.subscribe(user_id)
+    receiving = asyncio.create_task(receive_until_disconnect(websocket, subscriber))
+    try:
+        while True:
+            text = await subscriber.queue.get()
+            if text is None:
+                break
+            try:
+                await asyncio.wait_for(websocket.send_text(text), EVENTS_SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                events_hub.drop(subscriber)
+                return
+        if subscriber.dropped:
+            #  try again later
+            await asyncio.wait_for(websocket.close(code=1013), EVENTS_SEND_TIMEOUT)
+    finally:
+        events_hub.unsubscribe(subscriber)
+        receiving.cancel()
+
+
+def search_opponents(user_id: str, profile_id: str, limit: int, radius_km: float) -> list[dict]:
+    """
+    Find opponents for profile. Profiles with location get
+    nearest opponents within radius sorted by distance
+    """
+    profile = profile_index.get(profile_id)
+    if profile is None or profile.user_id != user_id:
+        raise my_exceptions.ProfileNotFound("Profile not found")
+
+    today = date.today()
+    if profile.latitude is None:
+        return [
+            pack_opponent(opponent, today)
+            for opponent in profile_index.search(profile_id=profile_id, limit=limit, today=today)
+        ]
+    return [
+        pack_opponent(opponent, today, distance)
+        for distance, opponent in profile_index.nearest(
+            profile_id=profile_id, limit=limit, radius_km=radius_km, today=today
+        )
+    ]
@@ -0,0 +1,137 @@
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image, ImageOps
+from time import perf_counter
+from typing import NamedTuple, Optional
+
+import asyncio
+import hashlib
+import logging
+import metrics
+import my_exceptions
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessedPhoto(NamedTuple):
+    data: bytes
+    #  sha256 of data, processed photo is stored by it
+    hash: str
+    #  size -> content of thumbnail
+    thumbnails: dict[int, bytes]
+
+
+def variant_path(path: str, size: int) -> str:
+    """static/<name>.jpg -> static/<name>_<size>.jpg"""
+    root, extension = os.path.splitext(path)
+    return f"{root}_{size}{extension}"
+
+
+def encode_jpeg(image: Image.Image, quality: int) -> bytes:
+    output = BytesIO()
+    image.save(output, "JPEG", quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def process_photo(data: bytes, quality: int, sizes: tuple[int, ...]) -> ProcessedPhoto:
+    """
+    Runs in worker process. Re-encode uploaded photo in memory without metadata
+    and make thumbnails smaller than the photo, nothing is written to disk
+    """
+    try:
+        with Image.open(BytesIO(data)) as source:
+            #  apply orientation from exif before it is dropped
+            image = ImageOps.exif_transpose(source).convert("RGB")
+    except (OSError, Image.DecompressionBombError):
+        raise my_exceptions.WrongPhoto("Photo must be JPEG image")
+
+    processed = encode_jpeg(image, quality)
+    thumbnails = {}
+    for size in sorted(sizes, reverse=True):
+        if size >= max(image.size):
+            continue
+        image.thumbnail((size, size), Image.LANCZOS)
+        thumbnails[size] = encode_jpeg(image, quality)
+    return ProcessedPhoto(processed, hashlib.sha256(processed).hexdigest(), thumbnails)
+
+
+class PhotoProcessor:
+    """
+    Bounded queue of uploaded photos processed in process pool,
+    so event loop is never blocked by image encoding
+    """
+    def __init__(self, workers: int, queue_size: int, quality: int, sizes: tuple[int, ...]):
+        self.workers = workers
+        self.quality = quality
+        self.sizes = sizes
+        self._queue: Optional[asyncio.Queue] = None
+        self._queue_size = queue_size
+        #  places of photos taken by uploads in progress
+        self._reserved = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        #  size is bounded by reservations
+        self._queue = asyncio.Queue()
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        """Wait until queued photos are processed, but not longer than timeout"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("%s photos left unprocessed", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def reserve(self, count: int) -> bool:
+        """
+        Take places of count photos for one upload, False if queue has no room. Check and take
+        are done without await between them, so concurrent uploads can't take the same places
+        """
+        if self._reserved + count > self._queue_size:
+            return False
+        self._reserved += count
+        return True
+
+    def release(self, count: int):
+        self._reserved -= count
+
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def process(self, data: bytes) -> ProcessedPhoto:
+        """Queue photo of reserved place and wait until it is processed, error of processing is raised"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((data, future, perf_counter()))
+        return await future
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            data, future, queued_at = await self._queue.get()
+            started = perf_counter()
+            metrics.photo_queue_seconds.observe(started - queued_at)
+            try:
+                #  upload was cancelled while photo waited
+                if future.done():
+                    continue
+                processed = await loop.run_in_executor(self._executor, process_photo, data, self.quality, self.sizes)
+                metrics.photo_processing_seconds.observe(perf_counter() - started)
+                if not future.done():
+                    future.set_result(processed)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                if not isinstance(exc, my_exceptions.WrongPhoto):
+                    logger.exception("Processing of photo failed")
+                if not future.done():
+                    future.set_exception(exc)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,164 @@
+from bisect import bisect_left
+from time import perf_counter
+
+import asyncio
+
+
+#  seconds, like default buckets of prometheus client
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+#  starlette appends charset
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+_metrics = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Cumulative histogram per label values, observe() is a bisect and two additions"""
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        #  label values -> [counts of every bucket and +Inf, sum]
+        self._series: dict[tuple, list] = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        bounds = [f'le="{bound}"' for bound in self.buckets] + ['le="+Inf"']
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, bound)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Last set value per label values"""
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        _metrics.append(self)
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Counter:
+    """Monotonic count per label values"""
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        _metrics.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, value: float, *labels):
+        """Take count kept by other object, it must only grow"""
+        self._values[labels] = value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+request_seconds = Histogram(
+    "http_request_duration_seconds", "Time from request start to last byte of response",
+    labels=("method", "route", "status")
+)
+auth_seconds = Histogram(
+    "auth_duration_seconds", "Time spent in authentication middleware",
+    labels=("result",), buckets=FAST_BUCKETS
+)
+pool_acquire_seconds = Histogram(
+    "db_pool_acquire_seconds", "Wait for a connection from pool", buckets=FAST_BUCKETS
+)
+pool_connections = Gauge("db_pool_connections", "Connections of pool by state", labels=("state",))
+query_seconds = Histogram(
+    "db_query_duration_seconds", "Execution time of statements from database.sql",
+    labels=("statement", "result"), buckets=FAST_BUCKETS
+)
+replica_lag_seconds = Gauge("db_replica_lag_seconds", "Replay lag of read replica", labels=("replica",))
+db_reads = Counter("db_reads_total", "Read queries by pool they were sent to", labels=("target",))
+loop_lag_seconds = Histogram(
+    "event_loop_lag_seconds", "Delay of event loop callbacks over the expected time", buckets=FAST_BUCKETS
+)
+photo_queue_seconds = Histogram("photo_queue_seconds", "Time uploaded photos wait for processing")
+photo_processing_seconds = Histogram("photo_processing_seconds", "Re-encoding and thumbnails of one photo")
+photo_queue_size = Gauge("photo_queue_size", "Uploaded photos waiting for processing")
+admission_wait_seconds = Histogram(
+    "admission_wait_seconds", "Wait of admitted requests for free slot", labels=("priority",), buckets=FAST_BUCKETS
+)
+admission_rejected = Counter("admission_rejected_total", "Requests rejected by admission control", labels=("reason",))
+events_connections = Gauge("events_connections", "Websocket connections receiving events")
+events_dropped = Counter("events_dropped_total", "Websocket connections dropped for not reading events")
+admission_requests = Gauge("admission_requests", "Requests by admission state", labels=("state",))
+file_write_queue_size = Gauge("file_write_queue_size", "Files waiting for writer")
+file_write_seconds = Histogram(
+    "file_write_seconds", "Time from queueing of file until it is written", labels=("result",), buckets=FAST_BUCKETS
+)
+rate_limited = Counter("rate_limited_total", "Requests rejected by rate limits", labels=("limit",))
+session_cache_size = Gauge("session_cache_size", "Verified sessions in cache")
+session_cache_requests = Counter(
+    "session_cache_requests_total", "Lookups of sessions in cache by result", labels=("result",)
+)
+rate_limit_buckets = Gauge("rate_limit_buckets", "Active token buckets of rate limits", labels=("limit",))
+
+
+def observe_pool(db_pool):
+    size = db_pool.get_size()
+    idle = db_pool.get_idle_size()
+    pool_connections.set(size - idle, "in_use")
+    pool_connections.set(idle, "idle")
+    pool_connections.set(db_pool.get_max_size(), "max")
+
+
+async def watch_loop_lag(interval: float = 0.5):
+    """Sleep for interval and observe how late event loop wakes up"""
+    while True:
+        started = perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(perf_counter() - started - interval, 0.0))
+
+
+def render() -> str:
+    """All metrics in prometheus text format"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
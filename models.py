@@ -2,6 +2,7 @@ from pydantic import BaseModel
 from starlette.authentication import BaseUser
 from fastapi import Query
 from enum import Enum
+from typing import Optional
 
 
 class PhotoType(str, Enum):
@@ -68,6 +69,19 @@ class NewProfile(BaseModel):
     max_age: int = Query(..., ge=16, le=100)
     profile_type: ProfileType
     vehicle_type: VehicleType
+    latitude: Optional[float] = Query(None, ge=-90, le=90)
+    longitude: Optional[float] = Query(None, ge=-180, le=180)
+
+
+class ProfileLocation(BaseModel):
+    profile_id: str
+    latitude: float = Query(..., ge=-90, le=90)
+    longitude: float = Query(..., ge=-180, le=180)
+
+
+class NewRating(BaseModel):
+    user_id: str
+    rate: int = Query(..., ge=1, le=5)
 
 
 class User(BaseUser):
@@ -1,3 +1,6 @@
+from starlette.authentication import AuthenticationError
+
+
 class UserExists(Exception):
     def __init__(self, message):
         self.message = message
@@ -14,7 +17,80 @@ class TooManyPhotos(Exception):
         super().__init__(message)
 
 
+class WrongPhoto(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
+class PhotoTooLarge(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
+class ServerBusy(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
+class PhotoNotFound(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
 class ProfileAlreadyExists(Exception):
     def __init__(self, message):
         self.message = message
         super().__init__(message)
+
+
+class WrongLocation(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
+class WrongRating(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
+class UserNotFound(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
+class WrongPage(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
+class ProfileNotFound(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
+class WrongNickname(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
+class RateLimited(AuthenticationError):
+    def __init__(self, message, retry_after: float):
+        self.message = message
+        self.retry_after = retry_after
+        super().__init__(message)
+
+
+class PhotoNotSaved(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
@@ -0,0 +1,53 @@
+from math import ceil, log
+
+import hashlib
+import random
+
+
+#  limits of nickname in registration
+MIN_LENGTH = 3
+MAX_LENGTH = 35
+
+
+class NicknameFilter:
+    """
+    Bloom filter of taken nicknames, case-insensitive. Nickname which isn't in filter
+    is not taken, nickname in filter is taken or is a false positive with probability
+    error_rate while filter holds no more than capacity nicknames
+    """
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = max(capacity, 1)
+        self.size = ceil(-self.capacity * log(error_rate) / log(2) ** 2)
+        self.hashes = max(1, round(self.size / self.capacity * log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, nickname: str):
+        #  k positions from two halves of one digest
+        digest = hashlib.blake2b(nickname.lower().encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, nickname: str):
+        for position in self._positions(nickname):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, nickname: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(nickname))
+
+    def full(self) -> bool:
+        """Error rate grows past the configured one, filter should be rebuilt bigger"""
+        return self.count >= self.capacity
+
+
+def variants(nickname: str, count: int) -> list[str]:
+    """Nickname with random number suffixes, cut to fit max length"""
+    result = []
+    while len(result) < count:
+        suffix = random.choice(("", "_")) + str(random.randint(1, 9999))
+        variant = nickname[:MAX_LENGTH - len(suffix)] + suffix
+        if variant.lower() != nickname.lower() and variant not in result:
+            result.append(variant)
+    return result
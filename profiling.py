@@ -0,0 +1,195 @@
+from collections import Counter
+from contextvars import ContextVar
+from fastapi.routing import APIRoute
+from functools import wraps
+from heapq import heappush, heapreplace
+from itertools import count
+from time import perf_counter
+from types import FrameType
+from typing import Callable, Optional
+
+import asyncio
+import sys
+import threading
+
+
+class RequestTimings:
+    """
+    Time spent by request in its phases. pool is wait for connection and db is time
+    of queries, they are parts of auth and endpoint phases, the rest don't overlap
+    """
+    __slots__ = ("phases", "route_started", "endpoint_started", "endpoint_finished", "route_finished")
+
+    def __init__(self):
+        self.phases: dict[str, float] = {}
+        self.route_started: Optional[float] = None
+        self.endpoint_started: Optional[float] = None
+        self.endpoint_finished: Optional[float] = None
+        self.route_finished: Optional[float] = None
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+
+_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+def start_timings() -> RequestTimings:
+    timings = RequestTimings()
+    _timings.set(timings)
+    return timings
+
+
+def stop_timings():
+    _timings.set(None)
+
+
+def add_time(phase: str, seconds: float):
+    """Add time to phase of current request, if any"""
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+def timed_endpoint(endpoint: Callable) -> Callable:
+    @wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        timings = _timings.get()
+        if timings is None:
+            return await endpoint(*args, **kwargs)
+        timings.endpoint_started = perf_counter()
+        try:
+            return await endpoint(*args, **kwargs)
+        finally:
+            timings.endpoint_finished = perf_counter()
+    return wrapper
+
+
+class TimedRoute(APIRoute):
+    """
+    Route which splits its time into validation of request before endpoint,
+    endpoint itself and serialization of its result
+    """
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            endpoint = timed_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            timings = _timings.get()
+            if timings is None:
+                return await handler(request)
+            timings.route_started = perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                timings.route_finished = perf_counter()
+                if timings.endpoint_started is not None:
+                    timings.add("validation", timings.endpoint_started - timings.route_started)
+                    timings.add("endpoint", timings.endpoint_finished - timings.endpoint_started)
+                    timings.add("serialization", timings.route_finished - timings.endpoint_finished)
+        return timed_handler
+
+
+class SlowRequests:
+    """The slowest requests since start or reset, at most size of them"""
+    def __init__(self, size: int):
+        self.size = size
+        self._heap: list[tuple[float, int, dict]] = []
+        self._order = count()
+
+    def admits(self, seconds: float) -> bool:
+        """Request of this duration would be kept"""
+        if len(self._heap) < self.size:
+            return True
+        return self.size > 0 and seconds > self._heap[0][0]
+
+    def add(self, seconds: float, request: dict):
+        if not self.admits(seconds):
+            return
+        item = (seconds, next(self._order), request)
+        if len(self._heap) < self.size:
+            heappush(self._heap, item)
+        else:
+            heapreplace(self._heap, item)
+
+    def requests(self) -> list[dict]:
+        return [request for _, _, request in sorted(self._heap, reverse=True)]
+
+    def reset(self):
+        self._heap.clear()
+
+
+class SamplingProfiler:
+    """
+    Sample stacks of event loop thread from another thread. Stacks are collapsed
+    into "route;frame;frame" lines, route is taken from the request frame found
+    in stack, so flamegraph shows time of every route separately
+    """
+    def __init__(self, route: Callable[[dict], str]):
+        self.route = route
+        #  frames of requests in progress -> their asgi scopes
+        self.requests: dict[FrameType, dict] = {}
+        self.samples: Counter[str] = Counter()
+        self.interval: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: float):
+        """Start sampling of the calling thread, which should run event loop"""
+        if self._thread is not None:
+            return
+        self.interval = interval
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(threading.get_ident(), interval), name="sampling-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        self.requests.clear()
+
+    def _run(self, thread_id: int, interval: float):
+        while not self._stopped.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stack = self._collapse(frame)
+                with self._lock:
+                    self.samples[stack] += 1
+
+    def _collapse(self, frame: Optional[FrameType]) -> str:
+        names = []
+        route = "[loop]"
+        while frame is not None:
+            scope = self.requests.get(frame)
+            if scope is not None:
+                route = self.route(scope)
+                break
+            code = frame.f_code
+            names.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+            frame = frame.f_back
+        names.append(route)
+        return ";".join(reversed(names))
+
+    def collapsed(self) -> str:
+        """Samples in collapsed stacks format of flamegraph.pl and speedscope"""
+        with self._lock:
+            samples = self.samples.most_common()
+        return "".join(f"{stack} {number}\n" for stack, number in samples)
+
+    def reset(self):
+        with self._lock:
+            self.samples.clear()
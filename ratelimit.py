@@ -0,0 +1,39 @@
+from time import monotonic
+from typing import Hashable
+
+
+class TokenBuckets:
+    """
+    Token bucket per key. Bucket refills by rate tokens per second up to burst,
+    request takes its cost from bucket or is rejected. Buckets which are full
+    again are the same as missing ones, so they are removed by sweep
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        #  key -> (tokens, time of last update)
+        self._buckets: dict[Hashable, tuple[float, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: Hashable, cost: float) -> float:
+        """Take cost tokens, return 0 if they are taken or seconds until there are enough of them"""
+        now = monotonic()
+        cost = min(cost, self.burst)
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < cost:
+            self._buckets[key] = (tokens, now)
+            return (cost - tokens) / self.rate
+        self._buckets[key] = (tokens - cost, now)
+        return 0
+
+    def sweep(self):
+        now = monotonic()
+        refilled = [
+            key for key, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * self.rate >= self.burst
+        ]
+        for key in refilled:
+            del self._buckets[key]
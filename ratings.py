@@ -0,0 +1,177 @@
+from typing import Awaitable, Callable, Optional
+from uuid import uuid4
+
+import asyncio
+import fcntl
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_SUFFIX = ".journal"
+#  user_id -> (sum of rates, count of rates)
+Deltas = dict[str, tuple[int, int]]
+Apply = Callable[[str, Deltas], Awaitable]
+
+
+class Journal:
+    """
+    Append-only file of ratings not written to database yet. File is locked
+    by its worker while it is open, so other workers replay only files of dead ones
+    """
+    def __init__(self, path: str, fd: int):
+        self.path = path
+        self.fd = fd
+        self.journal_id = os.path.basename(path)[:-len(JOURNAL_SUFFIX)]
+        self.written = 0
+        self._synced = 0
+        self._sync_task: Optional[asyncio.Task] = None
+        self._removed = False
+
+    @classmethod
+    def create(cls, directory: str) -> "Journal":
+        path = os.path.join(directory, f"{uuid4()}{JOURNAL_SUFFIX}")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return cls(path, fd)
+
+    @classmethod
+    def take_over(cls, path: str) -> Optional["Journal"]:
+        """Lock journal left by other worker, None if its worker is alive"""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return cls(path, fd)
+
+    def append(self, user_id: str, rate: int):
+        os.write(self.fd, f"{user_id} {rate}\n".encode())
+        self.written += 1
+
+    async def sync(self, written: int):
+        """Wait until first written records are on disk, one fsync covers all records appended before it"""
+        while self._synced < written and not self._removed:
+            if self._sync_task is None:
+                self._sync_task = asyncio.create_task(self._fsync())
+            await asyncio.shield(self._sync_task)
+
+    async def _fsync(self):
+        written = self.written
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, os.fsync, self.fd)
+        finally:
+            self._sync_task = None
+        self._synced = max(self._synced, written)
+
+    def read(self) -> Deltas:
+        """Sum ratings of journal, line torn by crash is skipped"""
+        deltas = {}
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    continue
+                try:
+                    user_id, rate = line.decode().split()
+                    rate = int(rate)
+                except ValueError:
+                    continue
+                add_delta(deltas, user_id, rate)
+        return deltas
+
+    async def remove(self):
+        """Remove journal which is written to database, records of it don't need fsync anymore"""
+        self._removed = True
+        if self._sync_task is not None:
+            await asyncio.shield(self._sync_task)
+        os.remove(self.path)
+        os.close(self.fd)
+
+
+def add_delta(deltas: Deltas, user_id: str, rate: int):
+    total, count = deltas.get(user_id, (0, 0))
+    deltas[user_id] = (total + rate, count + 1)
+
+
+class RatingAggregator:
+    """
+    Write-behind of ratings. Rates are summed in memory per user and journaled,
+    every flush writes all sums of the journal in one statement and starts new journal.
+    Journal id is saved with the sums, so journal replayed after crash is applied once
+    """
+    def __init__(self, directory: str, flush_interval: float, fsync: bool):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._deltas: Deltas = {}
+        self._journal: Optional[Journal] = None
+        #  journal and sums which are being written to database
+        self._flushing: Optional[tuple[Journal, Deltas]] = None
+
+    async def start(self, apply: Apply):
+        """Replay journals of stopped workers and open own journal"""
+        os.makedirs(self.directory, exist_ok=True)
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(JOURNAL_SUFFIX):
+                continue
+            journal = Journal.take_over(os.path.join(self.directory, name))
+            if journal is None:
+                continue
+            deltas = journal.read()
+            if deltas:
+                await apply(journal.journal_id, deltas)
+            await journal.remove()
+            logger.info("Replayed %s ratings of journal %s", len(deltas), journal.journal_id)
+        self._journal = Journal.create(self.directory)
+
+    def pending(self, user_id: str) -> tuple[int, int]:
+        """Sum and count of rates of user not written to database yet"""
+        total, count = self._deltas.get(user_id, (0, 0))
+        if self._flushing is not None:
+            flushing_total, flushing_count = self._flushing[1].get(user_id, (0, 0))
+            total, count = total + flushing_total, count + flushing_count
+        return total, count
+
+    async def add(self, user_id: str, rate: int):
+        """Journal rate and add it to user's sum, with fsync rate is on disk when this returns"""
+        journal = self._journal
+        journal.append(user_id, rate)
+        add_delta(self._deltas, user_id, rate)
+        if self.fsync:
+            await journal.sync(journal.written)
+
+    async def flush(self, apply: Apply):
+        """Write sums to database, failed sums are written again by the next flush"""
+        if self._flushing is None:
+            if not self._deltas:
+                return
+            self._flushing = (self._journal, self._deltas)
+            self._journal = Journal.create(self.directory)
+            self._deltas = {}
+
+        journal, deltas = self._flushing
+        await apply(journal.journal_id, deltas)
+        self._flushing = None
+        await journal.remove()
+
+    async def run(self, apply: Apply):
+        """Periodically flush sums"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush(apply)
+            except Exception:
+                logger.exception("Flush of ratings failed")
+
+    async def stop(self, apply: Apply):
+        """Flush the rest of sums, journal is kept for replay if it fails"""
+        try:
+            await self.flush(apply)
+        except Exception:
+            logger.exception("Flush of ratings failed, journal is left for replay")
+        else:
+            if self._journal is not None and self._flushing is None and not self._deltas:
+                journal, self._journal = self._journal, None
+                await journal.remove()
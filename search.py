@@ -0,0 +1,292 @@
+from datetime import date
+from geo import GeoGrid
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+
+#  which opponent profile types fit profile type
+COMPATIBLE_TYPES = {
+    "driver": ("companion", "any"),
+    "companion": ("driver", "any"),
+    "together": ("together", "any"),
+    "any": ("driver", "companion", "together", "any"),
+}
+
+VEHICLE_TYPES = ("moto", "car", "bike", "scooter", "legs", "any")
+
+
+class IndexedProfile(NamedTuple):
+    profile_id: str
+    user_id: str
+    gender: str
+    born_date: date
+    desired_gender: str
+    min_age: int
+    max_age: int
+    profile_type: str
+    vehicle_type: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+
+def get_age(born_date: date, today: date) -> int:
+    return today.year - born_date.year - ((today.month, today.day) < (born_date.month, born_date.day))
+
+
+def iter_bits(bitmap: int) -> Iterator[int]:
+    """Yield numbers of set bits from lowest to highest"""
+    words = memoryview(bitmap.to_bytes((bitmap.bit_length() + 63) // 64 * 8, "little")).cast("Q")
+    for number, word in enumerate(words):
+        while word:
+            lowest = word & -word
+            yield number * 64 + lowest.bit_length() - 1
+            word ^= lowest
+
+
+def to_bitmap(slots: list[int], size: int) -> int:
+    bits = bytearray((size + 7) // 8)
+    for slot in slots:
+        bits[slot >> 3] |= 1 << (slot & 7)
+    return int.from_bytes(bits, "little")
+
+
+def compatible_vehicles(vehicle_type: str) -> tuple[str, ...]:
+    if vehicle_type == "any":
+        return VEHICLE_TYPES
+    return vehicle_type, "any"
+
+
+class ProfileIndex:
+    """
+    In-memory index of active profiles for opponent search.
+    Every profile gets a slot, sets of profiles are stored as int bitmaps
+    where bit number is the slot. Birth dates are bucketed by year,
+    profiles from boundary years are checked exactly.
+    Profiles with location are also placed to geo grid by their slots,
+    grid is partitioned by gender, desired gender, type and vehicle type
+    """
+    def __init__(self, cell_size: float = 0.05):
+        self._grid = GeoGrid(cell_size=cell_size)
+        self._profiles: list[Optional[IndexedProfile]] = []
+        self._slots: dict[str, int] = {}
+        self._free_slots: list[int] = []
+        self._gender: dict[str, int] = {}
+        self._desired_gender: dict[str, int] = {}
+        self._type: dict[str, int] = {}
+        self._vehicle: dict[str, int] = {}
+        self._born_year: dict[int, int] = {}
+        self._accepts_age: dict[int, int] = {}
+        self._by_user: dict[str, set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._slots)
+
+    def __contains__(self, profile_id: str) -> bool:
+        return profile_id in self._slots
+
+    def get(self, profile_id: str) -> Optional[IndexedProfile]:
+        slot = self._slots.get(profile_id)
+        if slot is None:
+            return None
+        return self._profiles[slot]
+
+    def user_profiles(self, user_id: str) -> list[IndexedProfile]:
+        return [self._profiles[self._slots[profile_id]] for profile_id in self._by_user.get(user_id, ())]
+
+    @staticmethod
+    def matches(me: IndexedProfile, profile: IndexedProfile, today: date) -> bool:
+        """Check one pair of profiles by the same rules as search"""
+        return (
+            profile.user_id != me.user_id
+            and profile.gender == me.desired_gender and me.gender == profile.desired_gender
+            and profile.profile_type in COMPATIBLE_TYPES[me.profile_type]
+            and profile.vehicle_type in compatible_vehicles(me.vehicle_type)
+            and me.min_age <= get_age(profile.born_date, today) <= me.max_age
+            and profile.min_age <= get_age(me.born_date, today) <= profile.max_age
+        )
+
+    @staticmethod
+    def _keys(profile: IndexedProfile) -> Iterator[tuple[str, object]]:
+        """Yield names of bitmaps dicts and keys in them where profile has to be set"""
+        yield "_gender", profile.gender
+        yield "_desired_gender", profile.desired_gender
+        yield "_type", profile.profile_type
+        yield "_vehicle", profile.vehicle_type
+        yield "_born_year", profile.born_date.year
+        for age in range(profile.min_age, profile.max_age + 1):
+            yield "_accepts_age", age
+
+    def add(self, profile: IndexedProfile):
+        """Add profile to index or replace it if already indexed"""
+        if profile.profile_id in self._slots:
+            self.remove(profile.profile_id)
+
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            self._profiles[slot] = profile
+        else:
+            slot = len(self._profiles)
+            self._profiles.append(profile)
+        self._slots[profile.profile_id] = slot
+        self._by_user.setdefault(profile.user_id, set()).add(profile.profile_id)
+
+        bit = 1 << slot
+        for name, key in self._keys(profile):
+            bitmaps = getattr(self, name)
+            bitmaps[key] = bitmaps.get(key, 0) | bit
+        if profile.latitude is not None:
+            self._grid.move(slot, profile.latitude, profile.longitude, self._partition(profile))
+
+    def load(self, profiles: Iterable[IndexedProfile]):
+        """
+        Add many profiles at once. Bitmaps are built once at the end,
+        so loading is linear instead of copying bitmaps on every add
+        """
+        slots: dict[tuple[str, object], list[int]] = {}
+        for profile in profiles:
+            if profile.profile_id in self._slots:
+                self.remove(profile.profile_id)
+            slot = len(self._profiles)
+            self._profiles.append(profile)
+            self._slots[profile.profile_id] = slot
+            self._by_user.setdefault(profile.user_id, set()).add(profile.profile_id)
+            for name_key in self._keys(profile):
+                slots.setdefault(name_key, []).append(slot)
+            if profile.latitude is not None:
+                self._grid.move(slot, profile.latitude, profile.longitude, self._partition(profile))
+
+        size = len(self._profiles)
+        for (name, key), key_slots in slots.items():
+            bitmaps = getattr(self, name)
+            bitmaps[key] = bitmaps.get(key, 0) | to_bitmap(key_slots, size)
+
+    def remove(self, profile_id: str):
+        slot = self._slots.pop(profile_id, None)
+        if slot is None:
+            return
+
+        profile = self._profiles[slot]
+        mask = ~(1 << slot)
+        for name, key in self._keys(profile):
+            getattr(self, name)[key] &= mask
+        self._grid.remove(slot)
+        self._profiles[slot] = None
+        self._free_slots.append(slot)
+        user_profiles = self._by_user[profile.user_id]
+        user_profiles.discard(profile_id)
+        if not user_profiles:
+            del self._by_user[profile.user_id]
+
+    @staticmethod
+    def _partition(profile: IndexedProfile) -> tuple[str, str, str, str]:
+        return profile.gender, profile.desired_gender, profile.profile_type, profile.vehicle_type
+
+    def cell_id(self, latitude: float, longitude: float) -> int:
+        return self._grid.cell_id(latitude, longitude)
+
+    def move(self, profile_id: str, latitude: float, longitude: float):
+        """Update profile location, bitmaps are not touched"""
+        slot = self._slots.get(profile_id)
+        if slot is None:
+            return
+        profile = self._profiles[slot]._replace(latitude=latitude, longitude=longitude)
+        self._profiles[slot] = profile
+        self._grid.move(slot, latitude, longitude, self._partition(profile))
+
+    def _born_between(self, min_age: int, max_age: int, today: date) -> tuple[int, int]:
+        """
+        Return bitmap of profiles which years of birth fit ages entirely
+        and bitmap of profiles from boundary years to check one by one
+        """
+        youngest_year = today.year - min_age
+        oldest_year = today.year - max_age - 1
+        exact = 0
+        for year in range(oldest_year + 1, youngest_year):
+            exact |= self._born_year.get(year, 0)
+        boundary = self._born_year.get(oldest_year, 0) | self._born_year.get(youngest_year, 0)
+        return exact, boundary
+
+    def _candidates(self, me: IndexedProfile, today: date) -> tuple[int, int]:
+        """
+        Return bitmap of profiles matching each other with me and bitmap
+        of profiles which match if their exact age fits
+        """
+        candidates = self._gender.get(me.desired_gender, 0) & self._desired_gender.get(me.gender, 0)
+        candidates &= self._accepts_age.get(get_age(me.born_date, today), 0)
+        if not candidates:
+            return 0, 0
+
+        types = 0
+        for profile_type in COMPATIBLE_TYPES[me.profile_type]:
+            types |= self._type.get(profile_type, 0)
+        vehicles = 0
+        for vehicle_type in compatible_vehicles(me.vehicle_type):
+            vehicles |= self._vehicle.get(vehicle_type, 0)
+        candidates &= types & vehicles
+
+        exact, boundary = self._born_between(me.min_age, me.max_age, today)
+        return candidates & exact, candidates & boundary
+
+    def _fits(self, me: IndexedProfile, profile: IndexedProfile, in_boundary: bool, today: date) -> bool:
+        if profile.user_id == me.user_id:
+            return False
+        return not in_boundary or me.min_age <= get_age(profile.born_date, today) <= me.max_age
+
+    def search(self, profile_id: str, limit: Optional[int] = None, today: Optional[date] = None) -> list[IndexedProfile]:
+        """
+        Find profiles matching each other: opponent fits profile preferences
+        and profile fits opponent preferences
+        """
+        me = self.get(profile_id)
+        if me is None:
+            return []
+        today = today or date.today()
+        candidates, boundary = self._candidates(me, today)
+
+        found = []
+        for slot in iter_bits(candidates | boundary):
+            profile = self._profiles[slot]
+            if not self._fits(me, profile, bool((1 << slot) & boundary), today):
+                continue
+            found.append(profile)
+            if limit is not None and len(found) >= limit:
+                break
+        return found
+
+    def nearest(
+        self, profile_id: str, limit: int, radius_km: float, today: Optional[date] = None
+    ) -> list[tuple[float, IndexedProfile]]:
+        """
+        Find nearest matching profiles within radius, return them
+        with distances in km. Profile has to have location
+        """
+        me = self.get(profile_id)
+        if me is None or me.latitude is None:
+            return []
+        today = today or date.today()
+        candidates, boundary = self._candidates(me, today)
+        if not candidates | boundary:
+            return []
+
+        size = (len(self._profiles) + 7) // 8
+        candidates_bits = candidates.to_bytes(size, "little")
+        boundary_bits = boundary.to_bytes(size, "little")
+
+        def accept(slot: int) -> bool:
+            in_candidates = candidates_bits[slot >> 3] >> (slot & 7) & 1
+            in_boundary = boundary_bits[slot >> 3] >> (slot & 7) & 1
+            if not in_candidates and not in_boundary:
+                return False
+            return self._fits(me, self._profiles[slot], bool(in_boundary), today)
+
+        found = self._grid.nearest(
+            me.latitude, me.longitude, count=limit, radius_km=radius_km,
+            accept=accept, partitions=(
+                (me.desired_gender, me.gender, profile_type, vehicle_type)
+                for profile_type in COMPATIBLE_TYPES[me.profile_type]
+                for vehicle_type in compatible_vehicles(me.vehicle_type)
+            )
+        )
+        return [(distance, self._profiles[slot]) for distance, slot in found]
@@ -0,0 +1,206 @@
+from cache import TTLCache
+from email.utils import formatdate, parsedate_to_datetime
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+from typing import Optional
+
+import os
+import re
+
+
+#  blobs ab/cd/<sha256>.jpg and legacy <uuid>.jpg, both with optional _<size> of thumbnail
+PHOTO_NAME = re.compile(r"(?:[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}|[0-9a-f-]{36})(?:_\d+)?\.jpg")
+BLOB_NAME = re.compile(r"[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(?:_\d+)?\.jpg")
+CHUNK_SIZE = 65536
+#  blobs are written only after processing, under hash of their content, so they can be cached forever
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+#  legacy photos are stored as uploaded, so they are revalidated by etag
+LEGACY_CACHE_CONTROL = "public, no-cache"
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check etag against If-None-Match header, weak comparison"""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+class OpenFile:
+    """
+    Opened photo with its stat. File is shared between requests,
+    descriptor is closed when file is evicted from cache and nobody reads it
+    """
+    def __init__(self, path: str):
+        self.fd = os.open(path, os.O_RDONLY)
+        stat = os.fstat(self.fd)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        #  files of collected blobs can be written again, so etag depends on inode too
+        self.etag = f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        self._refs = 0
+        self._evicted = False
+
+    def acquire(self) -> "OpenFile":
+        self._refs += 1
+        return self
+
+    def release(self):
+        self._refs -= 1
+        self._close_if_unused()
+
+    def evict(self):
+        self._evicted = True
+        self._close_if_unused()
+
+    def _close_if_unused(self):
+        if self._evicted and self._refs == 0 and self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    Parse single "bytes=start-end" range into (start, end inclusive).
+    Return None for unsatisfiable range, raise ValueError for header to ignore
+    """
+    unit, _, ranges = header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        raise ValueError(header)
+    start, _, end = ranges.strip().partition("-")
+    if not start:
+        length = int(end)
+        if length == 0:
+            return None
+        return max(size - length, 0), size - 1
+    start = int(start)
+    if start >= size:
+        return None
+    end = int(end) if end else size - 1
+    if start > end:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+class PhotoResponse(Response):
+    """Send part of opened file, with zero-copy extension if server supports it"""
+    def __init__(self, file: OpenFile, status_code: int, headers: dict, offset: int, count: int, send_body: bool):
+        super().__init__(status_code=status_code, headers=headers)
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.send_body = send_body
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if not self.send_body or not self.count:
+                await send({"type": "http.response.body", "body": b""})
+            elif "http.response.zerocopy" in scope.get("extensions", {}):
+                with open(self.file.fd, "rb", closefd=False) as file:
+                    await send({
+                        "type": "http.response.zerocopy", "file": file,
+                        "offset": self.offset, "count": self.count
+                    })
+            else:
+                await self._send_chunks(send)
+        finally:
+            self.file.release()
+
+    async def _send_chunks(self, send: Send):
+        offset, left = self.offset, self.count
+        while left:
+            chunk = await run_in_threadpool(os.pread, self.file.fd, min(CHUNK_SIZE, left), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            left -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": bool(left)})
+        if left:
+            #  file was truncated under us, finish response anyway
+            await send({"type": "http.response.body", "body": b""})
+
+
+class StaticPhotos:
+    """
+    Serve photos from static directory: conditional requests by strong etag,
+    byte ranges and cache of opened files
+    """
+    def __init__(self, directory: str, cache_size: int, cache_ttl: float):
+        self.directory = directory
+        self._files = TTLCache(maxsize=cache_size, ttl=cache_ttl, on_evict=OpenFile.evict)
+
+    def open(self, name: str) -> Optional[OpenFile]:
+        file = self._files.get(name)
+        if file is None:
+            try:
+                file = OpenFile(os.path.join(self.directory, name))
+            except (FileNotFoundError, NotADirectoryError):
+                return None
+            file.acquire()
+            self._files.set(name, file)
+            file.release()
+        return file.acquire()
+
+    def forget(self, name: str):
+        """Drop cached file after it was replaced or removed on disk"""
+        self._files.invalidate(name)
+
+    def close(self):
+        self._files.clear()
+
+    def response(self, request: Request, name: str) -> Response:
+        if not PHOTO_NAME.fullmatch(name):
+            return Response(status_code=404)
+        file = self.open(name)
+        if file is None:
+            return Response(status_code=404)
+
+        headers = {
+            "etag": file.etag,
+            "cache-control": CACHE_CONTROL if BLOB_NAME.fullmatch(name) else LEGACY_CACHE_CONTROL,
+            "last-modified": formatdate(file.mtime, usegmt=True),
+            "accept-ranges": "bytes",
+            "content-type": "image/jpeg",
+        }
+        send_body = request.method != "HEAD"
+
+        if self._not_modified(request, file):
+            del headers["content-type"]
+            return PhotoResponse(file, 304, headers, 0, 0, send_body=False)
+
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (if_range is None or if_range == file.etag):
+            try:
+                byte_range = parse_range(range_header, file.size)
+            except ValueError:
+                pass
+            else:
+                if byte_range is None:
+                    headers["content-range"] = f"bytes */{file.size}"
+                    headers["content-length"] = "0"
+                    return PhotoResponse(file, 416, headers, 0, 0, send_body=False)
+                start, end = byte_range
+                headers["content-range"] = f"bytes {start}-{end}/{file.size}"
+                headers["content-length"] = str(end - start + 1)
+                return PhotoResponse(file, 206, headers, start, end - start + 1, send_body)
+
+        headers["content-length"] = str(file.size)
+        return PhotoResponse(file, 200, headers, 0, file.size, send_body)
+
+    @staticmethod
+    def _not_modified(request: Request, file: OpenFile) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            return etag_matches(if_none_match, file.etag)
+
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since is not None:
+            try:
+                return int(file.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
@@ -0,0 +1,239 @@
+from PIL import Image
+from seed_database import HASHED_PASSWORD, SeedOptions, merge_credentials, prepare_database, seed_job
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from uuid import uuid4
+
+import app
+import argparse
+import asyncio
+import config
+import csv
+import httpx
+import io
+import json
+import os
+import random
+import sys
+import uvicorn
+
+
+ENDPOINTS = ("registration", "authorization", "create_profile", "upload_photo")
+#  share of each endpoint in traffic
+DEFAULT_MIX = {"registration": 1, "authorization": 4, "create_profile": 2, "upload_photo": 1}
+
+
+def make_photo() -> bytes:
+    image = Image.effect_noise((640, 480), 50).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def unique_photo(photo: bytes) -> bytes:
+    """Photo with random comment segment after start marker, so every upload is a new blob"""
+    comment = uuid4().bytes
+    return photo[:2] + b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment + photo[2:]
+
+
+class Traffic:
+    """
+    Requests of every endpoint, response with status False counts as failure.
+    Uploads differ in bytes, otherwise all but the first are deduplicated and nothing is written
+    """
+    def __init__(self, client: httpx.AsyncClient, credentials: list[dict], photo: bytes):
+        self.client = client
+        self.credentials = credentials
+        self.photo = photo
+
+    @staticmethod
+    def header(user: dict) -> dict:
+        return {"Authorization": f"{user['token']}.{user['user_id']}.{user['device_id']}"}
+
+    async def registration(self) -> httpx.Response:
+        return await self.client.post("/registration", json={
+            "nickname": f"bench_{uuid4().hex[:24]}", "first_name": "bench",
+            "hashed_password": HASHED_PASSWORD, "born_date": random.randint(0, 900000000),
+            "gender": random.choice(("male", "female"))
+        })
+
+    async def authorization(self) -> httpx.Response:
+        user = random.choice(self.credentials)
+        return await self.client.request("GET", "/authorization", json={
+            "user_id": user["user_id"], "device_id": user["device_id"], "hashed_password": user["hashed_password"]
+        })
+
+    async def create_profile(self) -> httpx.Response:
+        user = random.choice(self.credentials)
+        min_age = random.randint(16, 60)
+        return await self.client.post("/create_profile", headers=self.header(user), json={
+            "user_id": user["user_id"], "desired_gender": random.choice(("male", "female")),
+            "min_age": min_age, "max_age": random.randint(min_age, 100),
+            "profile_type": random.choice(("driver", "companion", "together", "any")),
+            "vehicle_type": random.choice(("moto", "car", "bike", "scooter", "legs", "any")),
+            "latitude": random.uniform(55.0, 56.5), "longitude": random.uniform(36.8, 38.4)
+        })
+
+    async def upload_photo(self) -> httpx.Response:
+        user = random.choice(self.credentials)
+        return await self.client.post(
+            "/upload_photo", headers=self.header(user),
+            params={"subject_id": user["user_id"], "photo_type": "user"},
+            files=[("photos", ("photo.jpg", unique_photo(self.photo), "image/jpeg"))]
+        )
+
+
+async def drive(traffic: Traffic, mix: dict[str, int], duration: float, concurrency: int) -> dict[str, dict]:
+    """Send requests from concurrent workers until duration is over, collect latencies"""
+    latencies = {endpoint: [] for endpoint in mix}
+    failures = dict.fromkeys(mix, 0)
+    endpoints = list(mix)
+    weights = [mix[endpoint] for endpoint in endpoints]
+    deadline = perf_counter() + duration
+
+    async def worker():
+        while perf_counter() < deadline:
+            endpoint = random.choices(endpoints, weights)[0]
+            started = perf_counter()
+            try:
+                response = await getattr(traffic, endpoint)()
+                failed = response.status_code != 200 or not response.json().get("status")
+            except httpx.HTTPError:
+                failed = True
+            latencies[endpoint].append(perf_counter() - started)
+            failures[endpoint] += failed
+
+    started = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = perf_counter() - started
+    return {endpoint: summarize(latencies[endpoint], failures[endpoint], elapsed) for endpoint in endpoints}
+
+
+def percentile(values: list[float], share: float) -> float:
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def summarize(latencies: list[float], failures: int, elapsed: float) -> dict:
+    if not latencies:
+        return {"requests": 0, "failures": 0, "rps": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0}
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "failures": failures,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def print_results(results: dict[str, dict]):
+    print(f"{'endpoint':<16}{'requests':>10}{'failures':>10}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, result in results.items():
+        print(
+            f"{endpoint:<16}{result['requests']:>10}{result['failures']:>10}{result['rps']:>10}"
+            f"{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}"
+        )
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    """Return regressions: p95 slower or throughput lower than baseline by more than tolerance"""
+    regressions = []
+    for endpoint, result in results.items():
+        before = baseline.get(endpoint)
+        if not before or not before["requests"] or not result["requests"]:
+            continue
+        p95_change = result["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0.0
+        rps_change = result["rps"] / before["rps"] - 1 if before["rps"] else 0.0
+        print(f"{endpoint:<16}p95 {p95_change:+.1%}, rps {rps_change:+.1%}")
+        if p95_change > tolerance:
+            regressions.append(f"{endpoint} p95 {before['p95_ms']} -> {result['p95_ms']} ms")
+        if rps_change < -tolerance:
+            regressions.append(f"{endpoint} rps {before['rps']} -> {result['rps']}")
+    return regressions
+
+
+async def seed(users: int, directory: str) -> list[dict]:
+    """Seed users with sessions and one profile each, return their credentials"""
+    await prepare_database()
+    path = os.path.join(directory, "credentials.csv")
+    options = SeedOptions(
+        users=users, profiles=1, sessions=1, user_photos=0, profile_photos=0,
+        batch=10000, jobs=1, nickname_prefix=f"bench_{uuid4().hex[:8]}_",
+        import_users=None, credentials=path, triggers=True,
+        bounds=(55.0, 36.8, 56.5, 38.4)
+    )
+    await seed_job(options, 0)
+    merge_credentials(path, 1)
+    with open(path, newline="") as file:
+        return list(csv.DictReader(file))
+
+
+async def serve(port: int) -> tuple[uvicorn.Server, asyncio.Task]:
+    server = uvicorn.Server(uvicorn.Config(app.app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Mixed traffic against the app started in-process")
+    parser.add_argument("--users", type=int, default=10000, help="seeded users with sessions and profiles")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument(
+        "--mix", type=json.loads, default=DEFAULT_MIX,
+        help=f"json with share of each endpoint, default {json.dumps(DEFAULT_MIX)}"
+    )
+    parser.add_argument("--output", default="bench_api.json", help="write results to json")
+    parser.add_argument("--baseline", help="json of previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed regression, 0.1 is 10%%")
+    parser.add_argument(
+        "--rate-limits", action="store_true",
+        help="keep rate limits, all traffic comes from one address, so it mostly gets 429"
+    )
+    args = parser.parse_args()
+    config.RATE_LIMITS = args.rate_limits
+
+    unknown = set(args.mix) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints in mix: {', '.join(unknown)}")
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    with TemporaryDirectory() as directory:
+        #  uploaded photos are written to static directory of working directory
+        os.chdir(directory)
+        os.mkdir("static")
+        credentials = await seed(args.users, directory)
+        server, task = await serve(args.port)
+        try:
+            limits = httpx.Limits(max_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", limits=limits, timeout=30) as client:
+                traffic = Traffic(client, credentials, make_photo())
+                if args.warmup:
+                    await drive(traffic, args.mix, args.warmup, args.concurrency)
+                results = await drive(traffic, args.mix, args.duration, args.concurrency)
+        finally:
+            server.should_exit = True
+            await task
+
+    print_results(results)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    if baseline_path:
+        with open(baseline_path) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print("regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,48 @@
+from concurrent.futures import ProcessPoolExecutor
+from config import PHOTO_QUALITY, THUMBNAIL_SIZES
+from images import process_photo
+from io import BytesIO
+from PIL import Image
+from time import perf_counter
+
+import argparse
+import os
+import random
+
+
+def make_photos(count: int, width: int, height: int) -> list[bytes]:
+    photos = []
+    for _ in range(count):
+        image = Image.effect_noise((width, height), random.randint(10, 100)).convert("RGB")
+        output = BytesIO()
+        image.save(output, "JPEG", quality=95)
+        photos.append(output.getvalue())
+    return photos
+
+
+def bench(photos: list[bytes], workers: int) -> float:
+    """Return processed photos per second"""
+    started = perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_photo, data, PHOTO_QUALITY, THUMBNAIL_SIZES) for data in photos]
+        for future in futures:
+            future.result()
+    return len(photos) / (perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of photo re-encoding and thumbnails")
+    parser.add_argument("--photos", type=int, default=50)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1440)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    args = parser.parse_args()
+
+    for workers in sorted(set(args.workers)):
+        photos = make_photos(args.photos, args.width, args.height)
+        throughput = bench(photos, workers)
+        print(f"{workers} workers: {throughput:.1f} photos/s, {throughput / workers:.1f} photos/s per core")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+from database import queries
+from datetime import date, timedelta
+from handlers import rebuild_profile_index
+from search import IndexedProfile, ProfileIndex, COMPATIBLE_TYPES, VEHICLE_TYPES
+from config import GEO_CELL_SIZE, GEO_SEARCH_RADIUS
+from create_pool import get_pool
+from time import perf_counter
+from uuid import uuid4
+
+import argparse
+import asyncio
+import handlers
+import random
+
+
+def synthetic_index(count: int) -> ProfileIndex:
+    profiles = []
+    today = date.today()
+    for _ in range(count):
+        min_age = random.randint(16, 60)
+        profiles.append(IndexedProfile(
+            profile_id=str(uuid4()), user_id=str(uuid4()),
+            gender=random.choice(("male", "female")),
+            born_date=today - timedelta(days=random.randint(16 * 365, 70 * 365)),
+            desired_gender=random.choice(("male", "female")),
+            min_age=min_age, max_age=random.randint(min_age, 100),
+            profile_type=random.choice(tuple(COMPATIBLE_TYPES)),
+            vehicle_type=random.choice(VEHICLE_TYPES),
+            latitude=random.uniform(55.0, 56.5), longitude=random.uniform(36.8, 38.4)
+        ))
+    index = ProfileIndex(cell_size=GEO_CELL_SIZE)
+    index.load(profiles)
+    return index
+
+
+def bench_index(index: ProfileIndex, profile_ids: list[str], limit: int) -> dict[str, set[str]]:
+    started = perf_counter()
+    for profile_id in profile_ids:
+        index.search(profile_id, limit=limit)
+    elapsed = perf_counter() - started
+    print(f"index: {len(profile_ids)} searches, {elapsed / len(profile_ids) * 1000:.3f} ms per search of {limit}")
+
+    found = {}
+    started = perf_counter()
+    for profile_id in profile_ids:
+        found[profile_id] = {profile.profile_id for profile in index.search(profile_id)}
+    elapsed = perf_counter() - started
+    print(f"index: {len(profile_ids)} searches, {elapsed / len(profile_ids) * 1000:.3f} ms per search of all")
+    return found
+
+
+def bench_nearest(index: ProfileIndex, profile_ids: list[str], limit: int, radius_km: float):
+    started = perf_counter()
+    for profile_id in profile_ids:
+        index.nearest(profile_id, limit=limit, radius_km=radius_km)
+    elapsed = perf_counter() - started
+    print(
+        f"index: {len(profile_ids)} nearest searches, "
+        f"{elapsed / len(profile_ids) * 1000:.3f} ms per search of {limit} within {radius_km} km"
+    )
+
+    started = perf_counter()
+    for profile_id in profile_ids:
+        profile = index.get(profile_id)
+        index.move(profile_id, profile.latitude + random.uniform(-0.01, 0.01), profile.longitude)
+    elapsed = perf_counter() - started
+    print(f"index: {len(profile_ids)} location updates, {elapsed / len(profile_ids) * 1000:.4f} ms per update")
+
+
+async def bench_sql(profile_ids: list[str]) -> dict[str, set[str]]:
+    pool = await get_pool()
+    found = {}
+    today = date.today()
+    started = perf_counter()
+    for profile_id in profile_ids:
+        found[profile_id] = set(await queries.search_opponents(db_pool=pool, profile_id=profile_id, today=today))
+    elapsed = perf_counter() - started
+    print(f"sql: {len(profile_ids)} searches, {elapsed / len(profile_ids) * 1000:.3f} ms per search")
+    await pool.close()
+    return found
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Compare opponent search in memory index with SQL query")
+    parser.add_argument("--synthetic", type=int, help="search in random profiles without database")
+    parser.add_argument("--searches", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--radius", type=float, default=GEO_SEARCH_RADIUS)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        started = perf_counter()
+        index = synthetic_index(args.synthetic)
+        print(f"built index of {len(index)} profiles in {perf_counter() - started:.2f} s")
+        profile_ids = random.sample(list(index), min(args.searches, len(index)))
+        bench_index(index, profile_ids, args.limit)
+        bench_nearest(index, profile_ids, args.limit, args.radius)
+        return
+
+    pool = await get_pool()
+    started = perf_counter()
+    await rebuild_profile_index(db_pool=pool)
+    await pool.close()
+    index = handlers.profile_index
+    print(f"loaded index of {len(index)} profiles in {perf_counter() - started:.2f} s")
+    profile_ids = random.sample(list(index), min(args.searches, len(index)))
+
+    from_index = bench_index(index, profile_ids, args.limit)
+    from_sql = await bench_sql(profile_ids)
+    mismatched = [profile_id for profile_id in profile_ids if from_index[profile_id] != from_sql[profile_id]]
+    print(f"mismatched results: {len(mismatched)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +1,8 @@
 from asyncpg import create_pool
 from config import DB_DESTINATION
+from database.queries import init_connection
+from database.statements import PreparedConnection
 
 
 async def get_pool():
-    return await create_pool(DB_DESTINATION)
+    return await create_pool(DB_DESTINATION, connection_class=PreparedConnection, init=init_connection)
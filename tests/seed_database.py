@@ -0,0 +1,238 @@
+from asyncpg import Connection, connect
+from concurrent.futures import ProcessPoolExecutor
+from config import DB_DESTINATION, GEO_CELL_SIZE, THUMBNAIL_SIZES
+from create_pool import get_pool
+from database.queries import init_database
+from datetime import date, datetime, timedelta
+from geo import GeoGrid
+from search import COMPATIBLE_TYPES, VEHICLE_TYPES
+from time import perf_counter
+from typing import Iterator, NamedTuple, Optional
+from uuid import UUID
+
+import argparse
+import asyncio
+import csv
+import os
+import random
+
+
+#  the same password for every generated user, as in register_user.py
+HASHED_PASSWORD = "8ea9c7b1333371918d1b23ee6e768077db28da162709007825a4c3ad4cdb47e1"
+DEVICE_ID = "seed_device"
+
+columns = {
+    "users": ("user_id", "nickname", "first_name", "reg_time", "born_date", "gender", "hashed_password"),
+    "user_rating": ("rating_id", "user_id"),
+    "profiles": (
+        "profile_id", "user_id", "status", "desired_gender", "min_age", "max_age",
+        "type", "vehicle_type", "latitude", "longitude", "geo_cell"
+    ),
+    "sessions": ("session_id", "user_id", "device_id", "start_time", "token"),
+    "photo_blobs": ("hash", "ref_count", "variants"),
+    "user_photos": ("photo_id", "user_id", "blob_hash"),
+    "profile_photos": ("photo_id", "profile_id", "blob_hash"),
+}
+
+
+class SeedOptions(NamedTuple):
+    users: int
+    profiles: int
+    sessions: int
+    user_photos: int
+    profile_photos: int
+    batch: int
+    jobs: int
+    nickname_prefix: str
+    import_users: Optional[str]
+    credentials: Optional[str]
+    triggers: bool
+    #  area of generated profile locations: south, west, north, east
+    bounds: tuple[float, float, float, float]
+
+
+def random_uuid() -> UUID:
+    return UUID(int=random.getrandbits(128), version=4)
+
+
+def random_hex(length: int) -> str:
+    return f"{random.getrandbits(length * 4):0{length}x}"
+
+
+def generated_users(options: SeedOptions, job: int) -> Iterator[tuple]:
+    """Users of one job, jobs take every jobs-th number so nicknames never collide"""
+    today = date.today()
+    for number in range(job, options.users, options.jobs):
+        yield (
+            f"{options.nickname_prefix}{number}", f"seed {number}", HASHED_PASSWORD,
+            today - timedelta(days=random.randint(16 * 365, 70 * 365)),
+            random.choice(("male", "female"))
+        )
+
+
+def imported_users(options: SeedOptions, job: int) -> Iterator[tuple]:
+    """Users from csv with nickname, first_name, hashed_password, born_date (YYYY-MM-DD) and gender columns"""
+    with open(options.import_users, newline="") as file:
+        for number, row in enumerate(csv.DictReader(file)):
+            if number % options.jobs != job:
+                continue
+            yield (
+                row["nickname"], row["first_name"], row["hashed_password"],
+                date.fromisoformat(row["born_date"]), row["gender"]
+            )
+
+
+def make_batch(users: list[tuple], options: SeedOptions, grid: GeoGrid, now: datetime) -> dict[str, list[tuple]]:
+    """Rows of all tables for the users, every reference points to a row of the same batch"""
+    rows = {table: [] for table in columns}
+    blob_refs = 0 if options.triggers else 1
+    variants = list(THUMBNAIL_SIZES)
+    south, west, north, east = options.bounds
+
+    for nickname, first_name, hashed_password, born_date, gender in users:
+        user_id = random_uuid()
+        rows["users"].append((user_id, nickname, first_name, now, born_date, gender, hashed_password))
+        rows["user_rating"].append((random_uuid(), user_id))
+
+        for number in range(options.sessions):
+            rows["sessions"].append((random_uuid(), user_id, f"{DEVICE_ID}_{number}", now, random_hex(64)))
+
+        for _ in range(options.user_photos):
+            blob_hash = random_hex(64)
+            rows["photo_blobs"].append((blob_hash, blob_refs, variants))
+            rows["user_photos"].append((random_uuid(), user_id, blob_hash))
+
+        for _ in range(options.profiles):
+            profile_id = random_uuid()
+            min_age = random.randint(16, 60)
+            latitude, longitude = random.uniform(south, north), random.uniform(west, east)
+            rows["profiles"].append((
+                profile_id, user_id, True, random.choice(("male", "female")),
+                min_age, random.randint(min_age, 100),
+                random.choice(tuple(COMPATIBLE_TYPES)), random.choice(VEHICLE_TYPES),
+                latitude, longitude, grid.cell_id(latitude, longitude)
+            ))
+            for _ in range(options.profile_photos):
+                blob_hash = random_hex(64)
+                rows["photo_blobs"].append((blob_hash, blob_refs, variants))
+                rows["profile_photos"].append((random_uuid(), profile_id, blob_hash))
+
+    return rows
+
+
+async def copy_batch(conn: Connection, rows: dict[str, list[tuple]]):
+    """Copy batch in one transaction, tables are ordered so foreign keys are satisfied"""
+    async with conn.transaction():
+        for table, records in rows.items():
+            if records:
+                await conn.copy_records_to_table(table, records=records, columns=columns[table])
+
+
+def save_credentials(writer, rows: dict[str, list[tuple]]):
+    """user_id, device_id, token of every session and id of the first user's profile for api benchmarks"""
+    passwords = {user[0]: user[6] for user in rows["users"]}
+    profiles = {}
+    for profile in rows["profiles"]:
+        profiles.setdefault(profile[1], profile[0])
+    for _, user_id, device_id, _, token in rows["sessions"]:
+        writer.writerow((user_id, device_id, token, passwords[user_id], profiles.get(user_id, "")))
+
+
+async def seed_job(options: SeedOptions, job: int) -> dict[str, int]:
+    conn = await connect(DB_DESTINATION)
+    if not options.triggers:
+        #  skips triggers and foreign key checks, ref_count of blobs is written directly
+        await conn.execute('''SET session_replication_role = replica''')
+
+    credentials_file = None
+    writer = None
+    if options.credentials:
+        credentials_file = open(f"{options.credentials}.{job}", "w", newline="")
+        writer = csv.writer(credentials_file)
+
+    grid = GeoGrid(cell_size=GEO_CELL_SIZE)
+    users = imported_users(options, job) if options.import_users else generated_users(options, job)
+    counts = dict.fromkeys(columns, 0)
+    try:
+        while True:
+            chunk = [user for _, user in zip(range(options.batch), users)]
+            if not chunk:
+                break
+            rows = make_batch(chunk, options, grid, datetime.now())
+            await copy_batch(conn, rows)
+            if writer is not None:
+                save_credentials(writer, rows)
+            for table, records in rows.items():
+                counts[table] += len(records)
+    finally:
+        if credentials_file is not None:
+            credentials_file.close()
+        await conn.close()
+    return counts
+
+
+def run_job(options: SeedOptions, job: int) -> dict[str, int]:
+    return asyncio.run(seed_job(options, job))
+
+
+def merge_credentials(path: str, jobs: int):
+    with open(path, "w", newline="") as file:
+        csv.writer(file).writerow(("user_id", "device_id", "token", "hashed_password", "profile_id"))
+        for job in range(jobs):
+            with open(f"{path}.{job}") as part:
+                file.write(part.read())
+    for job in range(jobs):
+        os.remove(f"{path}.{job}")
+
+
+async def prepare_database():
+    pool = await get_pool()
+    await init_database(db_pool=pool)
+    await pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill database with synthetic or imported users through COPY")
+    parser.add_argument("--users", type=int, default=100000, help="number of generated users")
+    parser.add_argument("--import-users", help="csv with users instead of generated ones")
+    parser.add_argument("--profiles", type=int, default=1, help="profiles per user")
+    parser.add_argument("--sessions", type=int, default=1, help="sessions per user")
+    parser.add_argument("--user-photos", type=int, default=1, help="photos per user")
+    parser.add_argument("--profile-photos", type=int, default=1, help="photos per profile")
+    parser.add_argument("--batch", type=int, default=10000, help="users copied in one transaction")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="processes with own connection")
+    parser.add_argument("--nickname-prefix", default=f"seed_{int(datetime.now().timestamp()):x}_")
+    parser.add_argument("--credentials", help="write sessions of seeded users to csv")
+    parser.add_argument(
+        "--no-triggers", action="store_true",
+        help="skip triggers and foreign key checks while copying, needs superuser"
+    )
+    parser.add_argument("--bounds", type=float, nargs=4, default=(55.0, 36.8, 56.5, 38.4))
+    args = parser.parse_args()
+
+    options = SeedOptions(
+        users=args.users, profiles=args.profiles, sessions=args.sessions,
+        user_photos=args.user_photos, profile_photos=args.profile_photos,
+        batch=args.batch, jobs=args.jobs, nickname_prefix=args.nickname_prefix,
+        import_users=args.import_users, credentials=args.credentials,
+        triggers=not args.no_triggers, bounds=tuple(args.bounds)
+    )
+    asyncio.run(prepare_database())
+
+    started = perf_counter()
+    with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        results = list(executor.map(run_job, [options] * options.jobs, range(options.jobs)))
+    elapsed = perf_counter() - started
+
+    if options.credentials:
+        merge_credentials(options.credentials, options.jobs)
+    total = 0
+    for table in columns:
+        count = sum(result[table] for result in results)
+        total += count
+        print(f"{table}: {count} rows")
+    print(f"{total} rows in {elapsed:.2f} s, {total / elapsed:.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+from ratelimit import TokenBuckets
+
+import ratelimit
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_buckets(monkeypatch, rate: float = 2, burst: float = 4) -> tuple[TokenBuckets, Clock]:
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "monotonic", clock)
+    return TokenBuckets(rate=rate, burst=burst), clock
+
+
+def test_burst_is_taken_then_rejected(monkeypatch):
+    buckets, _ = make_buckets(monkeypatch)
+    assert [buckets.take("a", 1) for _ in range(4)] == [0, 0, 0, 0]
+    assert buckets.take("a", 1) == 0.5
+    assert buckets.take("b", 1) == 0
+
+
+def test_bucket_refills_by_rate(monkeypatch):
+    buckets, clock = make_buckets(monkeypatch)
+    assert buckets.take("a", 4) == 0
+    clock.now += 1
+    assert buckets.take("a", 3) == 0.5
+    assert buckets.take("a", 2) == 0
+
+
+def test_cost_above_burst_is_capped(monkeypatch):
+    buckets, _ = make_buckets(monkeypatch)
+    assert buckets.take("a", 10) == 0
+    assert buckets.take("a", 10) == 2
+
+
+def test_sweep_removes_only_refilled_buckets(monkeypatch):
+    buckets, clock = make_buckets(monkeypatch)
+    buckets.take("a", 4)
+    buckets.take("b", 1)
+    assert len(buckets) == 2
+    clock.now += 0.5
+    buckets.sweep()
+    assert len(buckets) == 1
+    clock.now += 2
+    buckets.sweep()
+    assert len(buckets) == 0
@@ -0,0 +1,44 @@
+from database.queries import RequestScope
+
+import asyncio
+
+
+class FakePool:
+    def __init__(self):
+        self.acquired = 0
+        self.released = []
+
+    async def acquire(self):
+        await asyncio.sleep(0.01)
+        self.acquired += 1
+        return object()
+
+    async def release(self, conn):
+        self.released.append(conn)
+
+
+def test_concurrent_first_queries_share_connection():
+    async def run():
+        pool = FakePool()
+        scope = RequestScope(pool)
+        first, second = await asyncio.gather(scope.connection(), scope.connection())
+        assert first is second
+        await scope.close()
+        assert pool.acquired == 1
+        assert pool.released == [first]
+
+    asyncio.run(run())
+
+
+def test_close_during_acquire_releases_connection():
+    async def run():
+        pool = FakePool()
+        scope = RequestScope(pool)
+        pending = asyncio.create_task(scope.connection())
+        await asyncio.sleep(0)
+        await scope.close()
+        conn = await pending
+        assert pool.released == [conn]
+        assert scope.conn is None
+
+    asyncio.run(run())
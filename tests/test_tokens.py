@@ -0,0 +1,71 @@
+from tokens import TokenSigner, is_signed
+
+import time
+
+
+USER_ID = "6f1c2b34-8d4e-4b8a-9a51-2f3c4d5e6f70"
+DEVICE_ID = "device"
+
+
+def make_signer(ttl: int = 60) -> TokenSigner:
+    return TokenSigner({"k2": "new secret", "k1": "old secret"}, ttl=ttl)
+
+
+def replace_signature(token: str, signature: str) -> str:
+    return token.rsplit(":", 1)[0] + ":" + signature
+
+
+def test_issued_token_is_verified():
+    signer = make_signer()
+    token = signer.issue(USER_ID, DEVICE_ID)
+    assert is_signed(token)
+    parsed = signer.verify(token, USER_ID, DEVICE_ID)
+    assert parsed is not None
+    assert parsed.key_id == "k2"
+    assert parsed.expires_at - parsed.issued_at == 60
+
+
+def test_token_of_other_device_or_user_is_rejected():
+    signer = make_signer()
+    token = signer.issue(USER_ID, DEVICE_ID)
+    assert signer.verify(token, USER_ID, "other") is None
+    assert signer.verify(token, "7f1c2b34-8d4e-4b8a-9a51-2f3c4d5e6f70", DEVICE_ID) is None
+
+
+def test_tampered_token_is_rejected():
+    signer = make_signer()
+    token = signer.issue(USER_ID, DEVICE_ID)
+    prefix, key_id, issued_at, expires_at, nonce, signature = token.split(":")
+    longer = f"{prefix}:{key_id}:{issued_at}:{int(expires_at) + 3600}:{nonce}:{signature}"
+    assert signer.verify(longer, USER_ID, DEVICE_ID) is None
+    flipped = signature[:-1] + ("A" if signature[-1] != "A" else "B")
+    assert signer.verify(replace_signature(token, flipped), USER_ID, DEVICE_ID) is None
+    assert signer.verify(replace_signature(token, ""), USER_ID, DEVICE_ID) is None
+
+
+def test_non_ascii_signature_is_rejected():
+    signer = make_signer()
+    token = signer.issue(USER_ID, DEVICE_ID)
+    assert signer.verify(replace_signature(token, "подпись"), USER_ID, DEVICE_ID) is None
+    assert signer.verify(replace_signature(token, "ÿ" * 43), USER_ID, DEVICE_ID) is None
+
+
+def test_malformed_token_is_rejected():
+    signer = make_signer()
+    for token in ("", "s1", "s1:k2:x:y:n:s", "s1:k2:1:2:n:s:extra", "legacy-token"):
+        assert signer.verify(token, USER_ID, DEVICE_ID) is None
+
+
+def test_unknown_key_and_expired_token_are_rejected():
+    signer = make_signer()
+    token = signer.issue(USER_ID, DEVICE_ID)
+    assert TokenSigner({"k3": "other"}, ttl=60).verify(token, USER_ID, DEVICE_ID) is None
+    expired = make_signer(ttl=-1).issue(USER_ID, DEVICE_ID)
+    assert signer.verify(expired, USER_ID, DEVICE_ID) is None
+
+
+def test_token_of_rotated_key_is_verified():
+    old = TokenSigner({"k1": "old secret"}, ttl=60)
+    token = old.issue(USER_ID, DEVICE_ID)
+    assert make_signer().verify(token, USER_ID, DEVICE_ID) is not None
+    assert time.time() < make_signer().verify(token, USER_ID, DEVICE_ID).expires_at
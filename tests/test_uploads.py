@@ -0,0 +1,73 @@
+from uploads import JPEG_SIGNATURE, PhotoParser
+
+import hashlib
+import my_exceptions
+import pytest
+
+
+BOUNDARY = "boundary"
+CONTENT_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+
+
+def part(name: str, data: bytes) -> bytes:
+    return (
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="{name}"; filename="photo.jpg"\r\n'
+        "Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + data + b"\r\n"
+
+
+def body(*parts: bytes) -> bytes:
+    return b"".join(parts) + f"--{BOUNDARY}--\r\n".encode()
+
+
+def make_parser(max_photos: int = 5, max_size: int = 100) -> PhotoParser:
+    return PhotoParser(CONTENT_TYPE, field="photos", max_photos=max_photos, max_size=max_size)
+
+
+def test_photos_are_parsed_and_hashed_byte_by_byte():
+    first, second = JPEG_SIGNATURE + b"first", JPEG_SIGNATURE + b"second"
+    parser = make_parser()
+    for byte in body(part("photos", first), part("other", b"skipped"), part("photos", second)):
+        parser.feed(bytes([byte]))
+    assert parser.finish() == [
+        (first, hashlib.sha256(first).hexdigest()), (second, hashlib.sha256(second).hexdigest())
+    ]
+
+
+def test_wrong_signature_is_rejected_at_first_byte():
+    parser = make_parser()
+    head = part("photos", b"\xff\xd8")
+    parser.feed(head[:-2])
+    with pytest.raises(my_exceptions.WrongPhoto):
+        parser.feed(b"GIF")
+
+
+def test_large_photo_is_rejected_before_body_ends():
+    parser = make_parser(max_size=10)
+    with pytest.raises(my_exceptions.PhotoTooLarge):
+        parser.feed(part("photos", JPEG_SIGNATURE + b"x" * 20)[:-2])
+
+
+def test_short_photo_is_wrong():
+    parser = make_parser()
+    with pytest.raises(my_exceptions.WrongPhoto):
+        parser.feed(body(part("photos", b"\xff")))
+
+
+def test_too_many_parts_are_rejected():
+    parser = make_parser(max_photos=2)
+    with pytest.raises(my_exceptions.TooManyPhotos):
+        parser.feed(body(*(part("photos", JPEG_SIGNATURE) for _ in range(3))))
+
+
+def test_body_without_photos_is_wrong():
+    parser = make_parser()
+    parser.feed(body(part("other", JPEG_SIGNATURE)))
+    with pytest.raises(my_exceptions.WrongPhoto):
+        parser.finish()
+
+
+def test_not_multipart_body_is_wrong():
+    with pytest.raises(my_exceptions.WrongPhoto):
+        PhotoParser("application/json", field="photos", max_photos=5, max_size=100)
@@ -0,0 +1,88 @@
+from base64 import urlsafe_b64encode
+from typing import NamedTuple, Optional
+
+import hashlib
+import hmac
+import secrets
+import time
+
+
+#  s1:<key id>:<issued at>:<expires at>:<nonce>:<signature>, has no dots so it fits "token.user_id.device_id" header
+PREFIX = "s1"
+#  part of signature which identifies token in revocation set
+TOKEN_ID_LENGTH = 22
+
+
+class SignedToken(NamedTuple):
+    key_id: str
+    issued_at: int
+    expires_at: int
+    token_id: str
+
+
+def is_signed(token: str) -> bool:
+    return token.startswith(PREFIX + ":")
+
+
+class TokenSigner:
+    """
+    Issue and verify session tokens signed by HMAC-SHA256. Tokens are verified
+    by any key of the ring, so keys are rotated by putting new key first
+    and removing old one after its tokens expired
+    """
+    def __init__(self, keys: dict[str, str], ttl: int):
+        self.keys = {key_id: secret.encode() for key_id, secret in keys.items()}
+        self.active_key = next(iter(self.keys))
+        self.ttl = ttl
+
+    def _signature(
+        self, key: bytes, key_id: str, issued_at: int, expires_at: int, nonce: str, user_id: str, device_id: str
+    ) -> str:
+        message = f"{key_id}:{issued_at}:{expires_at}:{nonce}:{user_id}:{device_id}".encode()
+        digest = hmac.new(key, message, hashlib.sha256).digest()
+        return urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+    def issue(self, user_id: str, device_id: str) -> str:
+        issued_at = int(time.time())
+        expires_at = issued_at + self.ttl
+        #  tokens issued to the same device in the same second differ
+        nonce = secrets.token_urlsafe(6)
+        signature = self._signature(
+            self.keys[self.active_key], self.active_key, issued_at, expires_at, nonce, user_id, device_id
+        )
+        return f"{PREFIX}:{self.active_key}:{issued_at}:{expires_at}:{nonce}:{signature}"
+
+    def verify(self, token: str, user_id: str, device_id: str) -> Optional[SignedToken]:
+        """Return parsed token if it is signed by known key for this device and not expired"""
+        try:
+            prefix, key_id, issued_at, expires_at, nonce, signature = token.split(":")
+            issued_at, expires_at = int(issued_at), int(expires_at)
+        except ValueError:
+            return None
+        key = self.keys.get(key_id)
+        if prefix != PREFIX or key is None or expires_at <= time.time():
+            return None
+        expected = self._signature(key, key_id, issued_at, expires_at, nonce, user_id, device_id)
+        #  compare_digest of str accepts ASCII only, signature of forged token may be anything
+        if not hmac.compare_digest(expected.encode(), signature.encode()):
+            return None
+        return SignedToken(key_id=key_id, issued_at=issued_at, expires_at=expires_at, token_id=signature[:TOKEN_ID_LENGTH])
+
+
+class RevokedTokens:
+    """Ids of revoked tokens until they expire anyway"""
+    def __init__(self):
+        self._tokens: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def __contains__(self, token_id: str) -> bool:
+        return token_id in self._tokens
+
+    def add(self, token_id: str, expires_at: int):
+        self._tokens[token_id] = expires_at
+
+    def prune(self):
+        now = time.time()
+        self._tokens = {token_id: expires_at for token_id, expires_at in self._tokens.items() if expires_at > now}
@@ -0,0 +1,111 @@
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+from typing import Optional
+
+import hashlib
+import my_exceptions
+
+
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+#  bytes of boundary and headers of one part, allowed in Content-Length on top of photos
+PART_OVERHEAD = 1024
+
+
+class PhotoPart:
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        #  the first bytes, checked against signature
+        self.head = b""
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+
+class PhotoParser:
+    """
+    Incremental parser of multipart body with photos in field. Photos are checked for
+    jpeg signature and size and hashed as their bytes arrive, so bad upload is rejected
+    at the first wrong byte, before the rest of body is received. Other fields are skipped
+    """
+    def __init__(self, content_type: str, field: str, max_photos: int, max_size: int):
+        media_type, options = parse_options_header(content_type)
+        boundary = options.get(b"boundary")
+        if media_type != b"multipart/form-data" or not boundary:
+            raise my_exceptions.WrongPhoto("Photos must be sent as multipart/form-data")
+        self.field = field.encode()
+        self.max_photos = max_photos
+        self.max_size = max_size
+        self.photos: list[PhotoPart] = []
+        self._part: Optional[PhotoPart] = None
+        self._parts = 0
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: dict[bytes, bytes] = {}
+        self._parser = MultipartParser(boundary, callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+
+    def feed(self, chunk: bytes):
+        try:
+            self._parser.write(chunk)
+        except MultipartParseError:
+            raise my_exceptions.WrongPhoto("Wrong multipart body")
+
+    def finish(self) -> list[tuple[bytes, str]]:
+        """Content and hash of every photo"""
+        try:
+            self._parser.finalize()
+        except MultipartParseError:
+            raise my_exceptions.WrongPhoto("Wrong multipart body")
+        if not self.photos:
+            raise my_exceptions.WrongPhoto("No photos")
+        return [(b"".join(photo.chunks), photo.digest.hexdigest()) for photo in self.photos]
+
+    def _on_part_begin(self):
+        self._parts += 1
+        #  every part costs memory of its headers
+        if self._parts > self.max_photos:
+            raise my_exceptions.TooManyPhotos(f"You cannot upload more than {self.max_photos} photos!")
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if options.get(b"name") == self.field:
+            self._part = PhotoPart()
+            self.photos.append(self._part)
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._part is None:
+            return
+        chunk = data[start:end]
+        if len(self._part.head) < len(JPEG_SIGNATURE):
+            self._part.head += chunk[:len(JPEG_SIGNATURE) - len(self._part.head)]
+            if not JPEG_SIGNATURE.startswith(self._part.head):
+                raise my_exceptions.WrongPhoto("Photo must be JPEG image")
+        self._part.size += len(chunk)
+        if self._part.size > self.max_size:
+            raise my_exceptions.PhotoTooLarge(f"Photo must be smaller than {self.max_size} bytes")
+        self._part.digest.update(chunk)
+        self._part.chunks.append(chunk)
+
+    def _on_part_end(self):
+        if self._part is not None:
+            if len(self._part.head) < len(JPEG_SIGNATURE):
+                raise my_exceptions.WrongPhoto("Photo must be JPEG image")
+            self._part = None